@@ -0,0 +1,9 @@
+from django.db.backends.mysql import base
+from socialapp.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    # django.db.backends.mysql with pooled connections, ENGINE = 'socialapp.db.backends.mysql'
+
+    def ping(self, connection):
+        connection.ping()
@@ -0,0 +1,10 @@
+from django.db.backends.sqlite3 import base
+from socialapp.db.pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    # django.db.backends.sqlite3 with pooled connections, for trying the pool without MySQL
+
+    def pooling_enabled(self):
+        # in-memory databases (tests) live and die with their single connection
+        return super().pooling_enabled() and not self.is_in_memory_db()
@@ -0,0 +1,243 @@
+import os
+import threading
+import time
+from collections import deque
+from django.db.utils import OperationalError
+
+# Per-process pool of open database connections, one per database alias. Django still "closes" its
+# connection at the end of every request (CONN_MAX_AGE = 0), the pooled backends hand it back here
+# instead, and the next connect() in any thread of the process gets it back without the connect and
+# authentication handshake. The pool is thread safe, a connection is only ever used by the thread
+# that checked it out, which is what lets the async views (running their queries in worker threads)
+# share it with the sync ones.
+DEFAULT_OPTIONS = {
+    'max_size': 10,       # open connections per process and alias, checked out or idle
+    'timeout': 10,        # seconds to wait for a connection when all of them are checked out
+    'max_idle': 300,      # idle connections are closed after this many seconds
+    'max_lifetime': 3600,  # connections are recycled after this many seconds, keep it below wait_timeout
+    'check_after': 1,     # connections idle for longer than this are pinged on checkout
+}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class PooledConnection:
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created = self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+
+    def __init__(self, alias, options):
+        self.alias = alias
+        self.options = dict(DEFAULT_OPTIONS, **options)
+        self.pid = os.getpid()
+        self.lock = threading.Condition()
+        self.idle = deque()
+        self.in_use = {}
+        self.opening = 0
+        self.opened = 0
+        self.closed = {}
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    @property
+    def size(self):
+        return len(self.idle) + len(self.in_use) + self.opening
+
+    def expired(self, entry, now):
+        if now - entry.created > self.options['max_lifetime']:
+            return 'lifetime'
+        if now - entry.last_used > self.options['max_idle']:
+            return 'idle'
+        return None
+
+    def checkout(self, connect, ping):
+        started = time.monotonic()
+        while True:
+            entry, stale = self.reserve(started)
+            self.close(stale)
+            if entry is None:
+                return self.open(connect)
+            if time.monotonic() - entry.last_used > self.options['check_after']:
+                try:
+                    ping(entry.raw)
+                except Exception:
+                    self.checkin(entry.raw, discard='broken')
+                    continue
+            return entry.raw
+
+    def reserve(self, started):
+        # an idle connection, or None when the caller may open a new one
+        stale = []
+        waited = False
+        with self.lock:
+            try:
+                while True:
+                    now = time.monotonic()
+                    while self.idle:
+                        # most recently used first, the others age out
+                        entry = self.idle.pop()
+                        reason = self.expired(entry, now)
+                        if reason:
+                            stale.append((entry, reason))
+                            continue
+                        self.in_use[id(entry.raw)] = entry
+                        return entry, stale
+                    if self.size < self.options['max_size']:
+                        self.opening += 1
+                        return None, stale
+                    remaining = started + self.options['timeout'] - now
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f'No database connection free in the {self.alias} pool after '
+                                          f'{self.options["timeout"]}s ({self.options["max_size"]} in use).')
+                    if not waited:
+                        waited = True
+                        self.waits += 1
+                    self.lock.wait(remaining)
+            finally:
+                if waited:
+                    self.wait_seconds += time.monotonic() - started
+
+    def open(self, connect):
+        try:
+            raw = connect()
+        except BaseException:
+            with self.lock:
+                self.opening -= 1
+                self.lock.notify()
+            raise
+        entry = PooledConnection(raw)
+        with self.lock:
+            self.opening -= 1
+            self.opened += 1
+            self.in_use[id(raw)] = entry
+        return raw
+
+    def checkin(self, raw, discard=None):
+        stale = []
+        with self.lock:
+            entry = self.in_use.pop(id(raw), None)
+            if entry is None:
+                # not ours, for example inherited from the parent process
+                stale.append((PooledConnection(raw), 'foreign'))
+            else:
+                now = time.monotonic()
+                reason = discard or self.expired(entry, now)
+                if reason is None and os.getpid() == self.pid:
+                    entry.last_used = now
+                    self.idle.append(entry)
+                else:
+                    stale.append((entry, reason or 'foreign'))
+                while self.idle and self.expired(self.idle[0], now):
+                    oldest = self.idle.popleft()
+                    stale.append((oldest, self.expired(oldest, now)))
+            self.lock.notify()
+        self.close(stale)
+
+    def close(self, entries):
+        for entry, reason in entries:
+            try:
+                entry.raw.close()
+            except Exception:
+                pass
+            with self.lock:
+                self.closed[reason] = self.closed.get(reason, 0) + 1
+
+    def close_idle(self):
+        with self.lock:
+            entries = [(entry, 'shutdown') for entry in self.idle]
+            self.idle.clear()
+        self.close(entries)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_use': len(self.in_use),
+                'idle': len(self.idle),
+                'opening': self.opening,
+                'max_size': self.options['max_size'],
+                'opened': self.opened,
+                'closed': dict(self.closed),
+                'waits': self.waits,
+                'wait_seconds': self.wait_seconds,
+                'timeouts': self.timeouts,
+            }
+
+
+def get_pool(alias, settings_dict):
+    # keyed on the connection target too, the test runner points the same alias at another database
+    key = (alias, settings_dict['ENGINE'], str(settings_dict['NAME']), settings_dict['HOST'],
+           settings_dict['PORT'], settings_dict['USER'])
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.pid != os.getpid():
+            # a forked worker starts with pools of its own, connections are not shared across processes
+            pool = _pools[key] = ConnectionPool(alias, settings_dict.get('POOL') or {})
+        return pool
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = [pool for pool in _pools.values() if pool.pid == os.getpid()]
+    return [(pool.alias, pool.stats()) for pool in pools]
+
+
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_idle()
+
+
+class PooledDatabaseWrapperMixin:
+    # Mixed into a backend DatabaseWrapper: connect() checks a connection out of the pool of the
+    # alias and close() hands it back. Connections that saw an error or were closed inside a
+    # transaction are never reused. Disable with 'POOL': False in the DATABASES entry.
+
+    def pooling_enabled(self):
+        return self.settings_dict.get('POOL', {}) is not False
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict)
+
+    def ping(self, connection):
+        # any DB-API connection, backends with a cheaper check of their own override it
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def get_new_connection(self, conn_params):
+        connect = super().get_new_connection
+        if not self.pooling_enabled():
+            return connect(conn_params)
+        return self.pool.checkout(lambda: connect(conn_params), self.ping)
+
+    def _close(self):
+        if not self.pooling_enabled() or self.connection is None:
+            return super()._close()
+        discard = None
+        if self.errors_occurred:
+            discard = 'error'
+        elif self.in_atomic_block:
+            # Django keeps a reference to it until the transaction is left
+            discard = 'transaction'
+        elif not self.autocommit:
+            try:
+                self.connection.rollback()
+            except Exception:
+                discard = 'error'
+        self.pool.checkin(self.connection, discard=discard)
@@ -0,0 +1,2 @@
+# Settings profiles, pick one with DJANGO_SETTINGS_MODULE: socialapp.settings.dev (the default),
+# socialapp.settings.prod or socialapp.settings.api. Shared settings live in base.py.
@@ -0,0 +1,19 @@
+from .prod import *  # noqa
+
+# API-only production workers: DJANGO_SETTINGS_MODULE=socialapp.settings.api. The prod profile
+# without the admin, messages and static files apps, which the JSON API does not use; /admin/ and
+# the browsable API login are not routed (see socialapp/urls.py). Run the admin on prod workers.
+API_ONLY_EXCLUDED_APPS = ('django.contrib.admin', 'django.contrib.messages', 'django.contrib.staticfiles')
+
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in API_ONLY_EXCLUDED_APPS]
+
+MIDDLEWARE = [middleware for middleware in MIDDLEWARE
+              if middleware != 'django.contrib.messages.middleware.MessageMiddleware']
+
+TEMPLATES = [
+    dict(template, OPTIONS=dict(template['OPTIONS'], context_processors=[
+        processor for processor in template['OPTIONS']['context_processors']
+        if processor != 'django.contrib.messages.context_processors.messages'
+    ]))
+    for template in TEMPLATES
+]
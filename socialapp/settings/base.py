@@ -0,0 +1,271 @@
+"""
+Django settings for socialapp project, shared by every profile of this package: dev (local
+development, the default of manage.py, asgi.py and wsgi.py), prod (production) and api (API-only
+production workers).
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/topics/settings/
+
+For the full list of settings and their values, see
+https://docs.djangoproject.com/en/4.2/ref/settings/
+"""
+import os
+from pathlib import Path
+
+# Build paths inside the project like this: BASE_DIR / 'subdir'.
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+
+
+# See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
+
+# SECURITY WARNING: keep the secret key used in production secret!
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', 'django-insecure-^-u9lrqhh^kxe5_a@o6ppa3stz+p1!f#az@l1ne8%t9hf(52tr')
+
+# SECURITY WARNING: don't run with debug turned on in production!
+# With DEBUG on, Django also keeps the SQL of every query of a request in memory.
+DEBUG = False
+
+ALLOWED_HOSTS = [host.strip() for host in os.environ.get('DJANGO_ALLOWED_HOSTS', '').split(',') if host.strip()]
+
+
+# Application definition
+
+INSTALLED_APPS = [
+    'django.contrib.admin',
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'django.contrib.staticfiles',
+    'rest_framework',
+    'base',
+    'users',
+]
+
+MIDDLEWARE = [
+    'users.middleware.RequestMetricsMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'users.middleware.ReplicaPinMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+]
+
+ROOT_URLCONF = 'socialapp.urls'
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.debug',
+                'django.template.context_processors.request',
+                'django.contrib.auth.context_processors.auth',
+                'django.contrib.messages.context_processors.messages',
+            ],
+        },
+    },
+]
+
+WSGI_APPLICATION = 'socialapp.wsgi.application'
+
+
+# Database
+# https://docs.djangoproject.com/en/4.2/ref/settings/#databases
+
+# DB_ENGINE=sqlite runs on local SQLite files instead of MySQL, for development and for trying the
+# replica setup below without a MySQL cluster.
+
+if os.environ.get('DB_ENGINE', 'mysql') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'socialapp.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'socialapp.db.backends.mysql',
+            'NAME': os.environ['DB_NAME'],
+            'USER': os.environ['DB_USER'],
+            'PASSWORD': os.environ['DB_PASSWORD'],
+        }
+    }
+
+# Both engines are the Django backends with a per-process connection pool, see socialapp/db/pool.py.
+# CONN_MAX_AGE stays 0, connections go back to the pool at the end of each request. Keep max_size
+# times the number of worker processes below the max_connections of the MySQL server.
+DATABASES['default']['POOL'] = {
+    'max_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'timeout': 10,
+    'max_idle': 300,
+    'max_lifetime': 3600,
+    'check_after': 1,
+}
+
+# Read replicas, see users/routers.py. DB_REPLICA_HOSTS is a comma separated list of MySQL hosts
+# replicating the default database, with DB_ENGINE=sqlite DB_SQLITE_REPLICAS is the number of
+# db.replica_<n>.sqlite3 files standing in for them (refreshed by the sync_sqlite_replicas command).
+# In tests every replica mirrors the default database.
+DATABASE_REPLICAS = []
+if os.environ.get('DB_ENGINE', 'mysql') == 'sqlite':
+    replica_count = int(os.environ.get('DB_SQLITE_REPLICAS', 0))
+    replica_settings = [{'NAME': BASE_DIR / f'db.replica_{n}.sqlite3'} for n in range(1, replica_count + 1)]
+else:
+    replica_hosts = [host.strip() for host in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if host.strip()]
+    replica_settings = [{'HOST': host} for host in replica_hosts]
+for n, replica in enumerate(replica_settings, start=1):
+    DATABASES[f'replica_{n}'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'}, **replica)
+    DATABASE_REPLICAS.append(f'replica_{n}')
+
+DATABASE_ROUTERS = ['users.routers.ReplicaRouter']
+
+# After writing, a client reads from the primary for this many seconds, longer than the replication lag.
+DATABASE_REPLICA_PIN_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Local memory by default, point CACHE_BACKEND/CACHE_LOCATION at a shared cache (for example
+# django.core.cache.backends.memcached.PyMemcacheCache) when running several workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# Per-user cache of friend lists and friend request listings, see users/cache.py.
+USERS_CACHE_ALIAS = 'default'
+USERS_CACHE_TIMEOUT = 300
+
+
+# Password validation
+# https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
+
+AUTH_PASSWORD_VALIDATORS = [
+    {
+        'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
+    },
+    {
+        'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator',
+    },
+    {
+        'NAME': 'django.contrib.auth.password_validation.CommonPasswordValidator',
+    },
+    {
+        'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator',
+    },
+]
+
+
+# Internationalization
+# https://docs.djangoproject.com/en/4.2/topics/i18n/
+
+LANGUAGE_CODE = 'en-us'
+
+TIME_ZONE = 'UTC'
+
+USE_I18N = True
+
+USE_TZ = True
+
+
+# Static files (CSS, JavaScript, Images)
+# https://docs.djangoproject.com/en/4.2/howto/static-files/
+
+STATIC_URL = 'static/'
+
+# Default primary key field type
+# https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
+
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+AUTH_USER_MODEL = 'users.User'
+LOGOUT_REDIRECT_URL = '/'
+LOGIN_REDIRECT_URL = '/'
+
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'PAGE_SIZE': 10,
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'users.authentication.SignedTokenAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+    ]
+}
+
+# Lifetime in seconds of the signed API tokens returned by the login endpoint, see users/authentication.py.
+# Token versions are cached for USERS_TOKEN_VERSION_TIMEOUT seconds, with a cache shared between workers
+# (CACHE_BACKEND) a logout or password change revokes tokens at once, otherwise within that delay.
+USERS_TOKEN_MAX_AGE = 60 * 60 * 24 * 7
+USERS_TOKEN_VERSION_TIMEOUT = 60
+
+# Upper bound for the page_size query parameter on list endpoints, in both page number and cursor mode.
+USERS_MAX_PAGE_SIZE = 100
+
+# Maximum number of items in one call to the bulk friend request endpoint.
+FRIEND_REQUEST_BULK_MAX = 50
+
+# Token bucket (GCRA) throttles, see users/throttler.py. Each scope takes one limit or a list of
+# limits (burst and sustained), a request has to fit in all of them. Bucket state lives in the
+# ThrottleBucket table so it is shared by every worker.
+THROTTLE_BUCKET_STORE = 'users.throttler.DatabaseBucketStore'
+THROTTLE_BUCKETS = {
+    'friend_request': {'rate': '3/minute', 'burst': 3},
+    'login': [{'rate': '10/minute', 'burst': 5}, {'rate': '200/day', 'burst': 50}],
+    'register': [{'rate': '5/minute', 'burst': 5}, {'rate': '50/day', 'burst': 20}],
+}
+
+# Backend answering the search parameter of the user list, see users/search.py.
+# 'users.search.SimpleSearchBackend' runs the plain icontains filters without an index.
+USERS_SEARCH_BACKEND = 'users.search.NgramSearchBackend'
+
+# In-memory friend graph behind suggestions and mutual friends, see users/graph.py.
+# New friendships from other processes are pulled in every FRIEND_GRAPH_REFRESH_SECONDS,
+# and the whole graph is rebuilt every FRIEND_GRAPH_REBUILD_SECONDS to pick up removals.
+FRIEND_GRAPH_REFRESH_SECONDS = 30
+FRIEND_GRAPH_REBUILD_SECONDS = 900
+FRIEND_GRAPH_MAX_OVERLAY = 10000
+
+# Serve the user list, user detail, friend list and friend request list GETs from the native async
+# views in users/async_views.py. Only worth it under ASGI (socialapp/asgi.py), under WSGI every
+# async view runs in its own event loop.
+USERS_ASYNC_VIEWS = os.environ.get('USERS_ASYNC_VIEWS', '').lower() in ('1', 'true', 'yes')
+
+# Transactional outbox of friend request changes, drained by the outbox_worker command, see
+# users/outbox.py. Consumers are name -> dotted path of a callable taking a list of OutboxEvents;
+# a renamed consumer starts over from the first event still in the outbox. Ids a consumer moved past
+# without seeing them are waited for USERS_OUTBOX_GAP_SECONDS (the longest a transaction writing
+# events may stay open), a worker has USERS_OUTBOX_CLAIM_SECONDS to hand a batch to its consumer.
+USERS_OUTBOX_CONSUMERS = {
+    'log': 'users.outbox.log_events',
+}
+USERS_OUTBOX_MAX_ATTEMPTS = 5
+USERS_OUTBOX_SETTLE_SECONDS = 5
+USERS_OUTBOX_GAP_SECONDS = 3600
+USERS_OUTBOX_CLAIM_SECONDS = 300
+USERS_OUTBOX_RETENTION_DAYS = 7
+
+# Server-Sent Events stream of incoming friend requests (/api/users/requests/events/), see
+# users/events.py. Each ASGI process polls the outbox once per USERS_EVENTS_POLL_SECONDS for all
+# of its open streams; streams send a keepalive comment every USERS_EVENTS_HEARTBEAT_SECONDS and
+# end after USERS_EVENTS_MAX_SECONDS (clients reconnect with Last-Event-ID).
+USERS_EVENTS_POLL_SECONDS = 1.0
+USERS_EVENTS_HEARTBEAT_SECONDS = 15
+USERS_EVENTS_MAX_SECONDS = 300
+
+# Days friend requests are kept before the archive_friend_requests command moves them to the
+# archive table, per retention rule (users/archive.py): 'cancelled' from their cancellation,
+# 'expired' pending requests from their creation. None keeps them forever.
+USERS_FRIEND_REQUEST_RETENTION = {
+    'cancelled': 30,
+    'expired': 180,
+}
@@ -0,0 +1,11 @@
+from dotenv import load_dotenv
+
+# Development profile, the default of manage.py, asgi.py and wsgi.py. Reads the .env file of the
+# project first, the shared settings take their database and cache configuration from it.
+load_dotenv()
+
+from .base import *  # noqa
+
+DEBUG = True
+
+ALLOWED_HOSTS = []
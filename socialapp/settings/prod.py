@@ -0,0 +1,22 @@
+import os
+from .base import *  # noqa
+
+# Production profile: DJANGO_SETTINGS_MODULE=socialapp.settings.prod. DEBUG is off (no per-request
+# query log), no .env file is read: DB_*, DJANGO_SECRET_KEY and DJANGO_ALLOWED_HOSTS come from the
+# environment of the process.
+SECRET_KEY = os.environ['DJANGO_SECRET_KEY']
+
+# JSON only, encoded and decoded by users/renderers.py (with orjson when it is installed). The
+# browsable API and its template and form rendering are not served; form and multipart request
+# bodies are still accepted.
+REST_FRAMEWORK = {
+    **REST_FRAMEWORK,
+    'DEFAULT_RENDERER_CLASSES': [
+        'users.renderers.FastJSONRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'users.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
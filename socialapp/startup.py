@@ -0,0 +1,65 @@
+import time
+
+STARTED = time.perf_counter()
+
+import io  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import resource  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+from wsgiref.util import setup_testing_defaults  # noqa: E402
+
+# Cold start of one worker: `python -m socialapp.startup` imports Django under DJANGO_SETTINGS_MODULE,
+# builds the WSGI application and serves GET /api/ (APIBaseView) to an anonymous client, then prints
+# the time it took from the first line of this module, the peak RSS and the number of modules
+# imported as JSON. Run in a fresh interpreter each time, see measure(), the bench_startup command
+# and StartupBudgetTests.
+
+# Budget of the API-only profile (socialapp/settings/api.py), enforced by StartupBudgetTests. The
+# module count is exact, it moves when an import is added at startup; time and memory leave room
+# for slower machines.
+STARTUP_BUDGET = {
+    'seconds': 1.5,
+    'rss_mb': 80,
+    'modules': 800,
+}
+
+
+def serve_first_request(path='/api/'):
+    from django.core.wsgi import get_wsgi_application
+
+    application = get_wsgi_application()
+    ready = time.perf_counter()
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'HTTP_ACCEPT': 'application/json',
+               'wsgi.input': io.BytesIO()}
+    setup_testing_defaults(environ)
+    statuses = []
+    body = b''.join(application(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+    finished = time.perf_counter()
+    return {
+        'status': int(statuses[0].split()[0]),
+        'bytes': len(body),
+        'setup_seconds': ready - STARTED,
+        'seconds': finished - STARTED,
+        # kilobytes on Linux
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'modules': len(sys.modules),
+        # the admin app was set up (autodiscover imports the admin modules of the apps)
+        'admin': 'users.admin' in sys.modules,
+    }
+
+
+def measure(settings_module, env=None):
+    """Start a fresh interpreter under the given settings and return what it measured."""
+    env = dict(os.environ, **(env or {}), DJANGO_SETTINGS_MODULE=settings_module)
+    # the WSGI test defaults send Host: 127.0.0.1
+    env.setdefault('DJANGO_ALLOWED_HOSTS', '127.0.0.1')
+    env.setdefault('DJANGO_SECRET_KEY', 'startup-measurement')
+    result = subprocess.run([sys.executable, '-m', 'socialapp.startup'], env=env, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True)
+    return json.loads(result.stdout)
+
+
+if __name__ == '__main__':
+    print(json.dumps(serve_first_request()))
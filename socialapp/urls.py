@@ -16,11 +16,18 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
+from django.apps import apps
 from django.urls import path
 
 urlpatterns = [
     path('api/', include('users.urls')),
-    path('api-auth', include('rest_framework.urls', namespace='rest_framework')),
-    path('admin/', admin.site.urls),
 ]
+
+# the API-only profile (socialapp/settings/api.py) serves neither the admin nor the browsable API login
+if apps.is_installed('django.contrib.admin'):
+    from django.contrib import admin
+
+    urlpatterns += [
+        path('api-auth', include('rest_framework.urls', namespace='rest_framework')),
+        path('admin/', admin.site.urls),
+    ]
@@ -1,17 +1,94 @@
+from functools import partial
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from django.utils.html import format_html
 from django.urls import reverse
 from django.contrib import messages
+from .authentication import forget_token_version
+from .models import ArchivedFriendRequest
 from .models import FriendRequest
 from .models import User
+from .outbox import EVENT_CANCELLED
+from .search import get_search_backend
+from .signals import friend_requests_bulk_changed
 
+# Changelists of tables with millions of rows: no exact COUNT(*) beyond ADMIN_COUNT_LIMIT rows
+# (an InnoDB count scans a whole index), indexed ordering and search, related rows joined instead
+# of fetched one by one, and actions that walk the selection in primary key chunks.
+ADMIN_COUNT_LIMIT = 10000
+ADMIN_ACTION_CHUNK_SIZE = 1000
 
-class CustomUserAdmin(UserAdmin):
+
+def estimated_count(queryset):
+    # row count estimate kept in the table statistics, None where the backend has none
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'mysql':
+        sql = 'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'
+    elif connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s'
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    # An unfiltered list past ADMIN_COUNT_LIMIT rows reports the table estimate, anything else is
+    # counted up to ADMIN_COUNT_LIMIT rows only (pages past it are not offered).
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset)
+            if estimate is not None and estimate > ADMIN_COUNT_LIMIT:
+                return estimate
+        return queryset.order_by()[:ADMIN_COUNT_LIMIT].count()
+
+
+def pk_chunks(queryset, chunk_size=ADMIN_ACTION_CHUNK_SIZE):
+    # primary keys of the selection, one keyset query per chunk instead of loading it all
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        chunk = list((pks if last_pk is None else pks.filter(pk__gt=last_pk))[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1]
+
+
+class LargeTableAdminMixin:
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ('-id',)
+
+    def delete_queryset(self, request, queryset):
+        for chunk in pk_chunks(queryset):
+            with transaction.atomic():
+                queryset.model.objects.filter(pk__in=chunk).delete()
+
+
+class CustomUserAdmin(LargeTableAdminMixin, UserAdmin):
     list_display = ('username', 'email', 'full_name', 'login_count', 'is_active', 'is_staff')
     list_display_links = ('username', 'email',)
-    actions= ['send_newsletter_issue']
+    actions= ['send_newsletter_issue', 'activate_users', 'deactivate_users']
+    # matched through the search backend, see get_search_results
+    search_fields = ('email',)
+    search_help_text = _('Email, first or last name.')
 
     fieldsets = (
         (None, {'fields': ('username', 'password')}),
@@ -31,6 +108,31 @@ class CustomUserAdmin(UserAdmin):
     def full_name(self, obj):
         return obj.get_full_name()
 
+    def get_search_results(self, request, queryset, search_term):
+        # the n-gram index instead of icontains over four columns, also serves the autocomplete widgets
+        if not search_term.strip():
+            return queryset, False
+        return get_search_backend().search(queryset, search_term), False
+
+    @admin.action(description=_('Activate selected users'))
+    def activate_users(self, request, queryset):
+        updated = 0
+        for chunk in pk_chunks(queryset.filter(is_active=False)):
+            updated += User.objects.filter(pk__in=chunk).update(is_active=True)
+        self.message_user(request, f'{updated} users activated.', messages.SUCCESS)
+
+    @admin.action(description=_('Deactivate selected users'))
+    def deactivate_users(self, request, queryset):
+        updated = 0
+        for chunk in pk_chunks(queryset.filter(is_active=True)):
+            with transaction.atomic():
+                # what revoke_tokens does for one user, update() skips the post_save handler
+                updated += User.objects.filter(pk__in=chunk).update(is_active=False,
+                                                                    token_version=F('token_version') + 1)
+                for user_id in chunk:
+                    transaction.on_commit(partial(forget_token_version, user_id))
+        self.message_user(request, f'{updated} users deactivated.', messages.SUCCESS)
+
     # @admin.action(description='Send Newsletter Issue to Subscribers')
     # def send_newsletter_issue(self, request, queryset):
     #     subscribers = queryset.filter(is_active=True, groups__name__in=['Subscriber'])
@@ -45,11 +147,58 @@ class CustomUserAdmin(UserAdmin):
 
 
 
-class FriendRequestAdmin(admin.ModelAdmin):
+class FriendRequestAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('sender', 'receiver', 'is_accepted', 'is_cancelled',)
     list_display_links = ('sender', 'receiver',)
+    list_select_related = ('sender', 'receiver')
+    autocomplete_fields = ('sender', 'receiver')
+    actions = ['cancel_friend_requests']
+    search_fields = ('sender__email', 'receiver__email')
+    search_help_text = _('Exact email of the sender or the receiver.')
+
+    def get_search_results(self, request, queryset, search_term):
+        # resolved to a user id first, so that each side is served by its own index
+        # instead of an OR across two joins
+        email = search_term.strip()
+        if not email:
+            return queryset, False
+        user_id = User.objects.filter(email__iexact=email).values_list('id', flat=True).first()
+        if user_id is None:
+            return queryset.none(), False
+        return queryset.filter(Q(sender_id=user_id) | Q(receiver_id=user_id)), False
+
+    @admin.action(description=_('Cancel selected pending friend requests'))
+    def cancel_friend_requests(self, request, queryset):
+        now = timezone.now()
+        cancelled = 0
+        for chunk in pk_chunks(queryset.filter(is_accepted=False, is_cancelled=False)):
+            with transaction.atomic():
+                friend_requests = list(FriendRequest.objects.select_for_update()
+                                       .filter(pk__in=chunk, is_accepted=False, is_cancelled=False))
+                for friend_request in friend_requests:
+                    friend_request.is_cancelled = True
+                    friend_request.modified_on = now
+                FriendRequest.objects.bulk_update(friend_requests, ['is_cancelled', 'modified_on'])
+                friend_requests_bulk_changed.send(sender=FriendRequest, friend_requests=friend_requests,
+                                                  event=EVENT_CANCELLED)
+            cancelled += len(friend_requests)
+        self.message_user(request, f'{cancelled} friend requests cancelled.', messages.SUCCESS)
+
+
+class ArchivedFriendRequestAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    # read only, rows only get here through the archive_friend_requests command
+    list_display = ('id', 'sender', 'receiver', 'is_cancelled', 'reason', 'archived_on')
+    list_select_related = ('sender', 'receiver')
+    list_filter = ('reason',)
+    raw_id_fields = ('sender', 'receiver')
+
+    def has_add_permission(self, request):
+        return False
 
+    def has_change_permission(self, request, obj=None):
+        return False
 
 
 admin.site.register(User, CustomUserAdmin)
-admin.site.register(FriendRequest, FriendRequestAdmin)
\ No newline at end of file
+admin.site.register(FriendRequest, FriendRequestAdmin)
+admin.site.register(ArchivedFriendRequest, ArchivedFriendRequestAdmin)
\ No newline at end of file
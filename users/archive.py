@@ -0,0 +1,65 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import ArchivedFriendRequest
+from .models import FriendRequest
+from .signals import archiving
+from .signals import friend_requests_archived
+
+# Retention of finished friend requests. The archive_friend_requests command walks FriendRequest in
+# primary key order and moves the rows matched by a rule of USERS_FRIEND_REQUEST_RETENTION to
+# ArchivedFriendRequest, one short transaction per batch. Cancelled requests are final; pending ones
+# expire (rejecting a request in this API leaves it pending). Archived cancelled requests keep
+# blocking their pair (FriendRequest.pair_taken), after an expired request a new one can be sent.
+# Accepted requests are never archived, they are the friendships.
+RULE_CANCELLED = 'cancelled'
+RULE_EXPIRED = 'expired'
+
+
+def retention_rules():
+    # rule name -> days a friend request is kept, None turns the rule off
+    rules = getattr(settings, 'USERS_FRIEND_REQUEST_RETENTION', {RULE_CANCELLED: 30, RULE_EXPIRED: 180})
+    return {rule: days for rule, days in rules.items() if days is not None}
+
+
+def rule_filter(rule, days, now=None):
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    # rows from before the timestamps existed have none and count as old
+    if rule == RULE_CANCELLED:
+        return Q(is_cancelled=True) & (Q(modified_on__lt=cutoff) | Q(modified_on__isnull=True))
+    if rule == RULE_EXPIRED:
+        return Q(is_accepted=False, is_cancelled=False) & (Q(created_on__lt=cutoff) | Q(created_on__isnull=True))
+    raise ImproperlyConfigured(f'Unknown friend request retention rule {rule!r}')
+
+
+def archive_batch(rule, days, after_id=0, batch_size=1000, dry_run=False):
+    """Archive the next batch of friend requests matched by the rule, returns (last id scanned, rows archived).
+
+    The last id is None once the rule has nothing left after after_id.
+    """
+    now = timezone.now()
+    matched = FriendRequest.objects.filter(rule_filter(rule, days, now))
+    ids = list(matched.filter(id__gt=after_id).order_by('id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return None, 0
+    if dry_run:
+        return ids[-1], len(ids)
+    with transaction.atomic():
+        # matched again under the lock, a request answered since it was picked stays; rows locked by a
+        # write in progress are skipped instead of waited for, the next run gets them
+        friend_requests = list(matched.select_for_update(skip_locked=True).filter(id__in=ids))
+        ArchivedFriendRequest.objects.bulk_create(
+            [ArchivedFriendRequest.from_friend_request(friend_request, rule, now) for friend_request in friend_requests]
+        )
+        # a normal delete, so the friendship edges a cancelled request may still have cascade; the
+        # per row post_delete handlers are replaced by friend_requests_archived, which handles the batch
+        token = archiving.set(True)
+        try:
+            FriendRequest.objects.filter(id__in=[friend_request.id for friend_request in friend_requests]).delete()
+        finally:
+            archiving.reset(token)
+        friend_requests_archived.send(sender=FriendRequest, friend_requests=friend_requests)
+    return ids[-1], len(friend_requests)
@@ -0,0 +1,354 @@
+import asyncio
+from abc import ABC
+from abc import abstractmethod
+from collections import deque
+import json
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.http import HttpResponseBase
+from django.http import HttpResponseNotAllowed
+from django.http import StreamingHttpResponse
+from rest_framework import status
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.exceptions import NotAuthenticated
+from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import exception_handler
+from .models import OutboxEvent
+from .models import User
+from .cache import acached_response_data
+from .conditional import afriend_list_state
+from .conditional import friend_list_etag
+from .conditional import not_modified
+from .conditional import set_validators
+from .conditional import user_etag
+from .events import EVENT_FIELDS
+from .events import RecentIds
+from .events import get_hub
+from .pagination import ClampedPageNumberPagination
+from .pagination import KeysetPagination
+from .pagination import wants_cursor_pagination
+from .search import get_search_backend
+from .serializers import UserSerializer
+from .serializers import UserRowSerializer
+from .serializers import FriendRequestRowSerializer
+from .views import UserListAPIView
+from .views import UserAPIView
+from .views import FriendListAPIView
+from .views import FriendRequestAPIView
+
+
+class AsyncReadAPIView(ABC):
+    # Native async GET for a read endpoint, served through the async ORM so an ASGI worker does not
+    # hold a thread while it waits on the database. Only JSON GETs are handled here, every other
+    # method and the browsable API are handed to sync_view_class, so both views answer the same URL
+    # with the same payloads, status codes and permissions. Enabled with USERS_ASYNC_VIEWS.
+    sync_view_class = None
+
+    @classmethod
+    def as_view(cls):
+        sync_view = sync_to_async(cls.sync_view_class.as_view())
+        allowed_methods = ', '.join(cls.sync_view_class().allowed_methods)
+
+        async def view(request, *args, **kwargs):
+            self = cls()
+            self.authenticators = [authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+            self.allowed_methods = allowed_methods
+            if request.method != 'GET':
+                return await sync_view(request, *args, **kwargs)
+            drf_request = Request(request, negotiator=api_settings.DEFAULT_CONTENT_NEGOTIATION_CLASS())
+            if not self.accepts_json(drf_request):
+                return await sync_view(request, *args, **kwargs)
+            return await self.dispatch(drf_request, *args, **kwargs)
+
+        view.view_class = cls
+        # same as the DRF views: SessionAuthentication enforces CSRF itself on unsafe methods
+        view.csrf_exempt = True
+        return view
+
+    @staticmethod
+    def accepts_json(request):
+        renderers = [renderer() for renderer in api_settings.DEFAULT_RENDERER_CLASSES]
+        try:
+            renderer, _ = request.negotiator.select_renderer(request, renderers)
+        except NotAcceptable:
+            return False
+        return isinstance(renderer, JSONRenderer)
+
+    @staticmethod
+    def json_renderer():
+        # the first JSON renderer configured, FastJSONRenderer under the production profile
+        for renderer_class in api_settings.DEFAULT_RENDERER_CLASSES:
+            if issubclass(renderer_class, JSONRenderer):
+                return renderer_class()
+        return JSONRenderer()
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user = await self.authenticate(request)
+            # get() returns the response data, or a response of its own such as a 304
+            data = await self.get(request, *args, **kwargs)
+            response = data if isinstance(data, HttpResponseBase) else Response(data, status=status.HTTP_200_OK)
+        except Exception as exc:
+            response = self.handle_exception(request, exc)
+        return self.finalize_response(request, response)
+
+    async def authenticate(self, request):
+        # DEFAULT_AUTHENTICATION_CLASSES in order, the first one returning a user wins
+        for authenticator in self.authenticators:
+            if hasattr(authenticator, 'aauthenticate'):
+                user_auth = await authenticator.aauthenticate(request)
+            elif isinstance(authenticator, SessionAuthentication):
+                # without the lazy request.user, which cannot be touched from async code
+                user = await sync_to_async(get_user)(request._request)
+                user_auth = (user, None) if user.is_authenticated and user.is_active else None
+            else:
+                user_auth = await sync_to_async(authenticator.authenticate)(request)
+            if user_auth is not None:
+                request._authenticator = authenticator
+                request.auth = user_auth[1]
+                return user_auth[0]
+        raise NotAuthenticated()
+
+    @abstractmethod
+    async def get(self, request, *args, **kwargs):
+        pass
+
+    def handle_exception(self, request, exc):
+        if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+            # same as APIView.handle_exception, 401 only with a challenge to send back
+            auth_header = self.authenticators[0].authenticate_header(request) if self.authenticators else None
+            if auth_header:
+                exc.auth_header = auth_header
+            else:
+                exc.status_code = status.HTTP_403_FORBIDDEN
+        response = exception_handler(exc, {'request': request, 'view': self})
+        if response is None:
+            raise exc
+        return response
+
+    def finalize_response(self, request, response):
+        response['Allow'] = self.allowed_methods
+        response['Vary'] = 'Accept'
+        if not isinstance(response, Response):
+            return response
+        response.accepted_renderer = self.json_renderer()
+        response.accepted_media_type = response.accepted_renderer.media_type
+        response.renderer_context = {'request': request, 'response': response, 'view': self}
+        return response.render()
+
+
+class AsyncUserListAPIView(AsyncReadAPIView):
+    sync_view_class = UserListAPIView
+
+    async def get(self, request, *args, **kwargs):
+        users = UserListAPIView.user_queryset(request)
+        search_query = request.query_params.get('search', '').strip().lower()
+        if search_query:
+            users = await get_search_backend().asearch(users, search_query)
+
+        users = users.values(*UserRowSerializer.values_fields)
+        paginator = KeysetPagination() if wants_cursor_pagination(request) else ClampedPageNumberPagination()
+        page = await paginator.apaginate_queryset(users, request)
+        context = {
+            'request': request,
+        }
+        serializer = UserRowSerializer(page, context=context)
+        return paginator.get_paginated_response(serializer.data).data
+
+
+class AsyncUserAPIView(AsyncReadAPIView):
+    sync_view_class = UserAPIView
+
+    async def get(self, request, *args, **kwargs):
+        user = await User.objects.filter(id=kwargs.get('pk')).afirst()
+        if user is None:
+            raise NotFound()
+        etag = user_etag(request, user)
+        response = not_modified(request, etag, user.modified_on)
+        if response is not None:
+            return response
+        context = {
+            'request': request,
+        }
+        return set_validators(Response(UserSerializer(user, context=context).data, status=status.HTTP_200_OK),
+                              etag, user.modified_on)
+
+
+class AsyncFriendListAPIView(AsyncReadAPIView):
+    sync_view_class = FriendListAPIView
+
+    async def get(self, request, *args, **kwargs):
+        etag = friend_list_etag(request, await afriend_list_state(request.user))
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+        data = await acached_response_data('friend-list', request.user.id, request,
+                                           lambda: self.list_friends(request), variant=etag)
+        return set_validators(Response(data, status=status.HTTP_200_OK), etag)
+
+    async def list_friends(self, request):
+        friends = request.user.friends().values(*UserRowSerializer.values_fields)
+        paginator = ClampedPageNumberPagination()
+        page = await paginator.apaginate_queryset(friends, request)
+        context = {
+            'request': request,
+        }
+        serializer = UserRowSerializer(page, context=context)
+        return paginator.get_paginated_response(serializer.data).data
+
+
+class AsyncFriendRequestAPIView(AsyncReadAPIView):
+    sync_view_class = FriendRequestAPIView
+
+    async def get(self, request, *args, **kwargs):
+        return await acached_response_data('friend-requests', request.user.id, request,
+                                           lambda: self.list_friend_requests(request))
+
+    async def list_friend_requests(self, request):
+        friend_requests = FriendRequestAPIView.friend_request_queryset(request)
+        paginator = KeysetPagination() if wants_cursor_pagination(request) else ClampedPageNumberPagination()
+        page = await paginator.apaginate_queryset(friend_requests, request)
+        context = {
+            'request': request,
+        }
+        serializer = FriendRequestRowSerializer(page, context=context)
+        return paginator.get_paginated_response(serializer.data).data
+
+
+class FriendRequestEventStreamView(AsyncReadAPIView):
+    # Server-Sent Events stream of the friend requests addressed to the user: one event per new or
+    # changed request, fed by the in-process hub of users/events.py instead of polling the pending
+    # list. Outbox ids commit out of order, so an event id is a resume cursor rather than the outbox
+    # id: "<floor>[:<id>,...]", the oldest outbox id not settled yet when the event was sent minus one,
+    # then the ids above it the client has. A reconnecting client sends the last one back in
+    # Last-Event-ID (or ?last_event_id=) and gets what it missed first. A reset event asks the client
+    # to reload the list, when it fell too far behind or its events were pruned. Meant for the ASGI app: under
+    # WSGI every open stream holds a worker thread. Streams end after USERS_EVENTS_MAX_SECONDS,
+    # EventSource reconnects on its own, which bounds streams left behind by vanished clients.
+    allowed_methods = 'GET'
+    backlog_limit = 500
+    # ids above the floor a cursor carries at most, the client gets the older ones again
+    cursor_ids = 50
+
+    @classmethod
+    def as_view(cls):
+
+        async def view(request, *args, **kwargs):
+            if request.method != 'GET':
+                return HttpResponseNotAllowed(['GET'])
+            self = cls()
+            self.authenticators = [authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+            drf_request = Request(request, negotiator=api_settings.DEFAULT_CONTENT_NEGOTIATION_CLASS())
+            return await self.dispatch(drf_request, *args, **kwargs)
+
+        view.view_class = cls
+        view.csrf_exempt = True
+        return view
+
+    @classmethod
+    def last_event_id(cls, request):
+        # (floor, ids the client has above it) of the cursor sent back by the client, None without one
+        value = request.META.get('HTTP_LAST_EVENT_ID') or request.query_params.get('last_event_id')
+        if not value:
+            return None
+        floor, _, ids = value.partition(':')
+        try:
+            return int(floor), [int(event_id) for event_id in ids.split(',') if event_id][:cls.cursor_ids]
+        except ValueError:
+            raise ValidationError({'last_event_id': 'Must be an event id.'})
+
+    @classmethod
+    def cursor(cls, floor, sent):
+        ids = sorted(event_id for event_id in sent if event_id > floor)[-cls.cursor_ids:]
+        return f'{floor}:{",".join(map(str, ids))}' if ids else str(floor)
+
+    async def get(self, request, *args, **kwargs):
+        last_event_id = self.last_event_id(request)
+        hub = get_hub()
+        # subscribed before the backlog is read, an event committed in between comes through both
+        # and the second copy is dropped by id
+        subscription = await hub.subscribe(request.user.id)
+        try:
+            backlog, reset = await self.backlog(request.user.id, last_event_id)
+        except BaseException:
+            hub.unsubscribe(subscription)
+            raise
+        response = StreamingHttpResponse(self.stream(request, hub, subscription, backlog, reset, last_event_id),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # nginx would otherwise hold the events back in its buffer
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def backlog(self, user_id, last_event_id):
+        if last_event_id is None:
+            return [], False
+        floor, seen = last_event_id
+        oldest = await OutboxEvent.objects.order_by('id').values_list('id', flat=True).afirst()
+        if oldest is not None and floor < oldest - 1:
+            return [], True
+        events = OutboxEvent.objects.filter(recipient_id=user_id, id__gt=floor).exclude(id__in=seen).order_by('id')
+        rows = [row async for row in events.values(*EVENT_FIELDS)[:self.backlog_limit + 1]]
+        if len(rows) > self.backlog_limit:
+            return [], True
+        return rows, False
+
+    async def stream(self, request, hub, subscription, backlog, reset, last_event_id):
+        serializer = FriendRequestRowSerializer([], context={'request': request})
+        urls = serializer.get_urls()
+        heartbeat = getattr(settings, 'USERS_EVENTS_HEARTBEAT_SECONDS', 15)
+        ends_at = time.monotonic() + getattr(settings, 'USERS_EVENTS_MAX_SECONDS', 300)
+        # the client has every event up to the floor of its cursor and the ids listed after it; the hub
+        # can hand over an event twice, and a lower id after a higher one
+        floor, seen = last_event_id or (0, [])
+        sent = RecentIds(seen)
+        unsent = deque(row['id'] for row in backlog)
+
+        def next_cursor():
+            # below the events still on their way to the client, the ones not settled yet and the
+            # ones waiting in the backlog or the queue
+            waiting = [hub.position or 0, *(event_id - 1 for event_id in subscription.queued)]
+            if unsent:
+                waiting.append(unsent[0] - 1)
+            return self.cursor(max(floor, min(waiting)), sent)
+
+        try:
+            yield 'retry: 3000\n\n'
+            if reset:
+                yield 'event: reset\ndata: {}\n\n'
+            for row in backlog:
+                unsent.popleft()
+                sent.add(row['id'])
+                yield self.format_event(serializer, urls, row, next_cursor())
+            while not subscription.overflowed:
+                remaining = ends_at - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    row = await asyncio.wait_for(subscription.get(), min(heartbeat, remaining))
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                if row['id'] <= floor or row['id'] in sent:
+                    continue
+                sent.add(row['id'])
+                yield self.format_event(serializer, urls, row, next_cursor())
+            yield 'event: reset\ndata: {}\n\n'
+        finally:
+            hub.unsubscribe(subscription)
+
+    @staticmethod
+    def format_event(serializer, urls, row, cursor):
+        payload = row['payload']
+        friend_request = serializer.to_representation(dict(payload, created_on=None), urls)
+        data = json.dumps({'event': row['event_type'], 'friend_request': friend_request}, separators=(',', ':'))
+        return f'id: {cursor}\nevent: friend_request\ndata: {data}\n\n'
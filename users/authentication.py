@@ -0,0 +1,119 @@
+from functools import partial
+from django.conf import settings
+from django.core import signing
+from django.db import router
+from django.db import transaction
+from django.db.models import F
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.authentication import get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+from .cache import get_cache
+from .models import User
+
+# Signed API tokens. A token is [user id, is_active, token version] signed with SECRET_KEY and
+# timestamped, so checking one costs an HMAC and a cache read for the current token version of
+# the user, with no session or user row read. Bumping User.token_version (logout, password
+# change) revokes every token issued before.
+TOKEN_SALT = 'users.authentication.SignedTokenAuthentication'
+TOKEN_VERSION_KEY = 'users:token-version:{user_id}'
+
+
+def token_max_age():
+    return getattr(settings, 'USERS_TOKEN_MAX_AGE', 60 * 60 * 24 * 7)
+
+
+def token_version_timeout():
+    # bounds how long a revoked token keeps working on a worker whose cache is not shared
+    return getattr(settings, 'USERS_TOKEN_VERSION_TIMEOUT', 60)
+
+
+def issue_token(user):
+    return signing.dumps([user.id, int(user.is_active), user.token_version], salt=TOKEN_SALT)
+
+
+def token_version(user_id):
+    cache = get_cache()
+    key = TOKEN_VERSION_KEY.format(user_id=user_id)
+    version = cache.get(key)
+    if version is None:
+        version = User.objects.filter(id=user_id).values_list('token_version', flat=True).first()
+        if version is not None:
+            cache.set(key, version, timeout=token_version_timeout())
+    return version
+
+
+async def atoken_version(user_id):
+    cache = get_cache()
+    key = TOKEN_VERSION_KEY.format(user_id=user_id)
+    version = await cache.aget(key)
+    if version is None:
+        version = await User.objects.filter(id=user_id).values_list('token_version', flat=True).afirst()
+        if version is not None:
+            await cache.aset(key, version, timeout=token_version_timeout())
+    return version
+
+
+def forget_token_version(user_id):
+    get_cache().delete(TOKEN_VERSION_KEY.format(user_id=user_id))
+
+
+def revoke_tokens(user):
+    User.objects.filter(id=user.id).update(token_version=F('token_version') + 1)
+    user.token_version = User.objects.filter(id=user.id).values_list('token_version', flat=True).first()
+    transaction.on_commit(partial(forget_token_version, user.id))
+
+
+def token_user(user_id, version):
+    # A User holding only the fields carried by the token. It is a real model instance, so it works
+    # as a foreign key value and in lookups, and any other field is loaded on first access.
+    values = {'id': user_id, 'is_active': True, 'token_version': version}
+    return User.from_db(router.db_for_read(User), list(values), list(values.values()))
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    # Authorization: Token <token>, tokens are returned by the login endpoint
+    keyword = 'Token'
+
+    def get_token(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed(_('Invalid token header.'))
+        try:
+            return auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed(_('Invalid token header.'))
+
+    def verify(self, token):
+        try:
+            user_id, is_active, version = signing.loads(token, salt=TOKEN_SALT, max_age=token_max_age())
+        except signing.SignatureExpired:
+            raise AuthenticationFailed(_('Token has expired.'))
+        except (signing.BadSignature, TypeError, ValueError):
+            raise AuthenticationFailed(_('Invalid token.'))
+        if not is_active:
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+        return user_id, version
+
+    def authenticate(self, request):
+        token = self.get_token(request)
+        if token is None:
+            return None
+        user_id, version = self.verify(token)
+        if token_version(user_id) != version:
+            raise AuthenticationFailed(_('Token has been revoked.'))
+        return token_user(user_id, version), token
+
+    async def aauthenticate(self, request):
+        token = self.get_token(request)
+        if token is None:
+            return None
+        user_id, version = self.verify(token)
+        if await atoken_version(user_id) != version:
+            raise AuthenticationFailed(_('Token has been revoked.'))
+        return token_user(user_id, version), token
+
+    def authenticate_header(self, request):
+        return self.keyword
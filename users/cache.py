@@ -0,0 +1,122 @@
+import hashlib
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import caches
+from .routers import pin_seconds
+from .routers import replicas
+
+# Every cached entry embeds the current version of the user it belongs to, so invalidating a user
+# is a single version bump and stale entries are simply never read again (they expire on their own).
+VERSION_KEY = 'users:version:{user_id}'
+ENTRY_KEY = 'users:{namespace}:{user_id}:{version}:{digest}'
+# until when the reads of a user go to the primary, see ReplicaPinMiddleware
+PRIMARY_PIN_KEY = 'users:primary-pin:{user_id}'
+
+_stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[getattr(settings, 'USERS_CACHE_ALIAS', 'default')]
+
+
+def cache_timeout():
+    return getattr(settings, 'USERS_CACHE_TIMEOUT', 300)
+
+
+def new_version():
+    # seeded from the clock so a version key that was evicted can never come back as an old value
+    return time.time_ns()
+
+
+def get_version(user_id):
+    cache = get_cache()
+    key = VERSION_KEY.format(user_id=user_id)
+    version = cache.get(key)
+    if version is None:
+        version = new_version()
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+    return version
+
+
+async def aget_version(user_id):
+    cache = get_cache()
+    key = VERSION_KEY.format(user_id=user_id)
+    version = await cache.aget(key)
+    if version is None:
+        version = new_version()
+        if not await cache.aadd(key, version, timeout=None):
+            version = await cache.aget(key, version)
+    return version
+
+
+def invalidate(*user_ids):
+    cache = get_cache()
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    for user_id in user_ids:
+        key = VERSION_KEY.format(user_id=user_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, new_version(), timeout=None)
+    # the next read of every one of them fills the cache under the new version, from a replica that
+    # may not have the write yet it would keep the stale data there until the entry expires
+    if replicas():
+        pin_to_primary(user_ids)
+
+
+def pin_to_primary(user_ids):
+    seconds = pin_seconds()
+    pinned_until = time.time() + seconds
+    get_cache().set_many({PRIMARY_PIN_KEY.format(user_id=user_id): pinned_until for user_id in user_ids},
+                         timeout=seconds)
+    return pinned_until
+
+
+def record(namespace, hit):
+    with _stats_lock:
+        _stats[namespace]['hits' if hit else 'misses'] += 1
+
+
+def cache_stats():
+    with _stats_lock:
+        return {namespace: dict(counts) for namespace, counts in _stats.items()}
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def entry_key(namespace, user_id, version, request, variant=''):
+    digest = hashlib.md5(f'{request.build_absolute_uri()}{variant}'.encode('utf-8')).hexdigest()
+    return ENTRY_KEY.format(namespace=namespace, user_id=user_id, version=version, digest=digest)
+
+
+def cached_response_data(namespace, user_id, request, build, variant=''):
+    # Response data for a read endpoint, keyed on the user version and the full request URL
+    # (host, path and query string, since the payload holds absolute hyperlinks and pages),
+    # plus variant, for example the ETag of the data, when the version alone does not cover it.
+    cache = get_cache()
+    key = entry_key(namespace, user_id, get_version(user_id), request, variant)
+    data = cache.get(key)
+    record(namespace, data is not None)
+    if data is None:
+        data = build()
+        cache.set(key, data, timeout=cache_timeout())
+    return data
+
+
+async def acached_response_data(namespace, user_id, request, build, variant=''):
+    # cached_response_data for the async views, build is a coroutine function
+    cache = get_cache()
+    key = entry_key(namespace, user_id, await aget_version(user_id), request, variant)
+    data = await cache.aget(key)
+    record(namespace, data is not None)
+    if data is None:
+        data = await build()
+        await cache.aset(key, data, timeout=cache_timeout())
+    return data
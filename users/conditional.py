@@ -0,0 +1,66 @@
+import hashlib
+from django.db.models import Count
+from django.db.models import Max
+from django.utils.cache import get_conditional_response
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date
+from django.utils.http import quote_etag
+from .counters import COUNTER_FIELDS
+from .models import Friendship
+
+# Conditional GET for the user, friend list and friend request endpoints. The validators come from
+# the row itself or from one aggregate query, so a client polling with If-None-Match or
+# If-Modified-Since gets its 304 before anything is serialized (or read from the response cache).
+# Counter updates bump User.modified_on too, see users/counters.py.
+
+FRIEND_LIST_AGGREGATES = {
+    'count': Count('id'),
+    'last_friendship': Max('created_on'),
+    'last_modified': Max('friend__modified_on'),
+}
+
+
+def make_etag(request, *parts):
+    # the same validators on another page or for another user describe another representation
+    source = repr((request.get_full_path(), request.user.id) + parts)
+    return quote_etag(hashlib.md5(source.encode('utf-8')).hexdigest())
+
+
+def user_etag(request, user):
+    return make_etag(request, user.id, user.modified_on, *[getattr(user, field) for field in COUNTER_FIELDS])
+
+
+def friend_request_etag(request, friend_request):
+    return make_etag(request, friend_request.id, friend_request.modified_on)
+
+
+def friend_list_state(user):
+    return Friendship.objects.filter(user=user).aggregate(**FRIEND_LIST_AGGREGATES)
+
+
+async def afriend_list_state(user):
+    return await Friendship.objects.filter(user=user).aaggregate(**FRIEND_LIST_AGGREGATES)
+
+
+def friend_list_etag(request, state):
+    # the count catches removed friends, which leave no timestamp behind; for the same reason the
+    # friend list sends no Last-Modified
+    return make_etag(request, state['count'], state['last_friendship'], state['last_modified'])
+
+
+def not_modified(request, etag, last_modified=None):
+    # a 304 response when the copy of the client is current, None otherwise
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified=None):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    # clients may keep the body, but have to revalidate it before every use
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
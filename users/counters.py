@@ -0,0 +1,78 @@
+from collections import Counter
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.utils import timezone
+from .models import User
+from .models import FriendRequest
+from .models import Friendship
+
+# Denormalized friend_count, pending_incoming_count and pending_outgoing_count on User. Single
+# friend request writes move them with F() updates in the transaction of the write (see the
+# FriendRequest signal handlers in users/signals.py), bulk writes and the reconcile_counters
+# command recount them from the FriendRequest and Friendship tables. Every change bumps
+# User.modified_on, which the conditional GET validators rely on.
+COUNTER_FIELDS = ('friend_count', 'pending_incoming_count', 'pending_outgoing_count')
+
+
+def counted_fields(sender_id, receiver_id, state):
+    # (user id, counter) pairs a friend request in the given state counts towards
+    if state == FriendRequest.STATE_FRIENDS:
+        return [(sender_id, 'friend_count'), (receiver_id, 'friend_count')]
+    if state == FriendRequest.STATE_PENDING:
+        return [(sender_id, 'pending_outgoing_count'), (receiver_id, 'pending_incoming_count')]
+    return []
+
+
+def apply_state_change(sender_id, receiver_id, previous, current):
+    if previous == current:
+        return
+    deltas = defaultdict(Counter)
+    for user_id, field in counted_fields(sender_id, receiver_id, previous):
+        deltas[user_id][field] -= 1
+    for user_id, field in counted_fields(sender_id, receiver_id, current):
+        deltas[user_id][field] += 1
+    now = timezone.now()
+    # users are always locked in id order, so two concurrent changes cannot deadlock
+    for user_id in sorted(deltas):
+        changes = {field: F(field) + delta for field, delta in deltas[user_id].items() if delta}
+        if changes:
+            User.objects.filter(id=user_id).update(modified_on=now, **changes)
+
+
+def actual_counts(user_ids):
+    counts = {user_id: dict.fromkeys(COUNTER_FIELDS, 0) for user_id in user_ids}
+    friends = (Friendship.objects.filter(user_id__in=user_ids)
+               .values_list('user_id').annotate(count=Count('id')).order_by())
+    pending = FriendRequest.objects.filter(is_accepted=False, is_cancelled=False)
+    outgoing = (pending.filter(sender_id__in=user_ids)
+                .values_list('sender_id').annotate(count=Count('id')).order_by())
+    incoming = (pending.filter(receiver_id__in=user_ids)
+                .values_list('receiver_id').annotate(count=Count('id')).order_by())
+    for field, rows in (('friend_count', friends), ('pending_outgoing_count', outgoing),
+                        ('pending_incoming_count', incoming)):
+        for user_id, count in rows:
+            counts[user_id][field] = count
+    return counts
+
+
+def recount(user_ids):
+    """Set the counters of the given users to their actual values, returns the users that had drifted."""
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return []
+    with transaction.atomic():
+        # locked before counting, a concurrent F() update waits and lands on top of the recount
+        users = list(User.objects.select_for_update().filter(id__in=user_ids).only('id', 'modified_on', *COUNTER_FIELDS).order_by('id'))
+        counts = actual_counts([user.id for user in users])
+        drifted = []
+        now = timezone.now()
+        for user in users:
+            if any(getattr(user, field) != counts[user.id][field] for field in COUNTER_FIELDS):
+                for field in COUNTER_FIELDS:
+                    setattr(user, field, counts[user.id][field])
+                user.modified_on = now
+                drifted.append(user)
+        User.objects.bulk_update(drifted, COUNTER_FIELDS + ('modified_on',))
+    return drifted
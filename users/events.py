@@ -0,0 +1,157 @@
+import asyncio
+import weakref
+from collections import defaultdict
+from collections import deque
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import OutboxEvent
+from .outbox import settle_seconds
+
+# In-process fan-out of the friend request outbox to the event streams of connected users. One hub
+# per event loop (so one per ASGI worker process) runs a single poller over the outbox, whatever the
+# number of open streams, and hands every event to the queues of the streams of its recipient. A
+# commit in the same process wakes the poller at once, events written by other processes arrive
+# within USERS_EVENTS_POLL_SECONDS. The poller stops when the last stream of the process closes.
+EVENT_FIELDS = ('id', 'event_type', 'recipient_id', 'payload', 'created_on')
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def poll_seconds():
+    return getattr(settings, 'USERS_EVENTS_POLL_SECONDS', 1.0)
+
+
+class RecentIds:
+    # set of the last maxlen ids added, older ones are forgotten
+
+    def __init__(self, ids=(), maxlen=1000):
+        self.maxlen = maxlen
+        self.order = deque()
+        self.ids = set()
+        for event_id in ids:
+            self.add(event_id)
+
+    def add(self, event_id):
+        if event_id in self.ids:
+            return
+        self.order.append(event_id)
+        self.ids.add(event_id)
+        if len(self.order) > self.maxlen:
+            self.ids.discard(self.order.popleft())
+
+    def __contains__(self, event_id):
+        return event_id in self.ids
+
+    def __iter__(self):
+        return iter(self.order)
+
+
+class Subscription:
+
+    def __init__(self, user_id, maxsize=100):
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize)
+        # ids of the events in the queue
+        self.queued = set()
+        # set when the stream fell too far behind, it has to tell the client to reload instead
+        self.overflowed = False
+
+    def put(self, event):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+        else:
+            self.queued.add(event['id'])
+
+    async def get(self):
+        event = await self.queue.get()
+        self.queued.discard(event['id'])
+        return event
+
+
+class EventHub:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.wake = asyncio.Event()
+        self.subscriptions = defaultdict(set)
+        self.task = None
+        # every event up to position was dispatched and is older than the outbox settle delay, the
+        # ones above it that were dispatched already are in dispatched
+        self.position = None
+        self.dispatched = set()
+
+    async def subscribe(self, user_id):
+        if self.position is None:
+            # the events that can still be joined by a lower id are read again by the first poll
+            settled = timezone.now() - timedelta(seconds=settle_seconds())
+            self.position = await (OutboxEvent.objects.filter(created_on__lte=settled).order_by('-id')
+                                   .values_list('id', flat=True).afirst()) or 0
+        subscription = Subscription(user_id)
+        self.subscriptions[user_id].add(subscription)
+        if self.task is None:
+            self.task = self.loop.create_task(self.run())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+
+    async def run(self):
+        try:
+            while self.subscriptions:
+                self.wake.clear()
+                await self.poll()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), poll_seconds())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # the next stream starts over from the newest event
+            self.task = None
+            self.position = None
+            self.dispatched.clear()
+
+    async def poll(self):
+        # only the last few seconds of events are read again: ids are allocated at insert but
+        # committed in any order, an id below a dispatched one can still show up until it settles
+        events = OutboxEvent.objects.filter(id__gt=self.position, recipient_id__isnull=False).order_by('id')
+        rows = [row async for row in events.values(*EVENT_FIELDS)]
+        for row in rows:
+            if row['id'] not in self.dispatched:
+                self.dispatched.add(row['id'])
+                for subscription in list(self.subscriptions.get(row['recipient_id'], ())):
+                    subscription.put(row)
+        settled = timezone.now() - timedelta(seconds=settle_seconds())
+        for row in rows:
+            if row['created_on'] > settled:
+                break
+            self.position = row['id']
+            self.dispatched.discard(row['id'])
+
+
+def get_hub():
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = EventHub(loop)
+    return hub
+
+
+def wake_hubs():
+    # called after a commit that wrote outbox events, from any thread
+    for loop, hub in list(_hubs.items()):
+        if hub.task is None:
+            continue
+        try:
+            loop.call_soon_threadsafe(hub.wake.set)
+        except RuntimeError:
+            # the loop was closed meanwhile
+            pass
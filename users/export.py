@@ -0,0 +1,151 @@
+import csv
+from datetime import datetime
+from django.core.serializers.json import DjangoJSONEncoder
+from .models import User
+from .models import FriendRequest
+from .models import Friendship
+
+# Streamed exports of friends and friend requests, shared by the export endpoint and the export_graph
+# command. Rows are read in keyset batches along an index (never OFFSET, never the whole result set,
+# which the MySQL driver would buffer client side even through QuerySet.iterator()) and encoded as
+# they are read, so memory stays flat whatever the number of rows.
+EXPORT_BATCH_SIZE = 2000
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+FRIEND_FIELDS = ('id', 'email', 'first_name', 'last_name', 'friends_since')
+FRIEND_REQUEST_FIELDS = ('id', 'sender_id', 'receiver_id', 'is_accepted', 'is_cancelled', 'created_on', 'modified_on')
+FRIENDSHIP_FIELDS = ('user_id', 'friend_id', 'friend_request_id', 'created_on')
+USER_FIELDS = ('id', 'email', 'first_name', 'last_name', 'is_active', 'created_on')
+
+
+def keyset_batches(queryset, key, batch_size=EXPORT_BATCH_SIZE):
+    # queryset is a values() queryset holding key, which has to be unique within it
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(**{f'{key}__gt': last})
+        batch = list(page.order_by(key)[:batch_size])
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1][key]
+
+
+async def akeyset_batches(queryset, key, batch_size=EXPORT_BATCH_SIZE):
+    last = None
+    while True:
+        page = queryset if last is None else queryset.filter(**{f'{key}__gt': last})
+        batch = [row async for row in page.order_by(key)[:batch_size]]
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1][key]
+
+
+def friend_querysets(user_id):
+    # keyed on friend_id, which walks the unique (user, friend) index
+    friends = (Friendship.objects.filter(user_id=user_id)
+               .values('friend_id', 'friend__email', 'friend__first_name', 'friend__last_name', 'created_on'))
+    return [(friends, 'friend_id')]
+
+
+def friend_row(row):
+    return {
+        'id': row['friend_id'],
+        'email': row['friend__email'],
+        'first_name': row['friend__first_name'],
+        'last_name': row['friend__last_name'],
+        'friends_since': row['created_on'],
+    }
+
+
+def friend_request_querysets(user_id):
+    # sent then received, each along one of the (sender, receiver) and (receiver, sender) indexes
+    # instead of an OR over both columns
+    rows = FriendRequest.objects.values(*FRIEND_REQUEST_FIELDS)
+    return [(rows.filter(sender_id=user_id), 'receiver_id'), (rows.filter(receiver_id=user_id), 'sender_id')]
+
+
+def user_querysets(user_id=None):
+    return [(User.objects.values(*USER_FIELDS), 'id')]
+
+
+def friendship_querysets(user_id=None):
+    return [(Friendship.objects.values('id', *FRIENDSHIP_FIELDS), 'id')]
+
+
+def all_friend_request_querysets(user_id=None):
+    return [(FriendRequest.objects.values(*FRIEND_REQUEST_FIELDS), 'id')]
+
+
+# kind -> (fields, querysets for a user id, row transform)
+EXPORTS = {
+    'friends': (FRIEND_FIELDS, friend_querysets, friend_row),
+    'friend-requests': (FRIEND_REQUEST_FIELDS, friend_request_querysets, dict),
+    'users': (USER_FIELDS, user_querysets, dict),
+    'friendships': (FRIENDSHIP_FIELDS, friendship_querysets, dict),
+    'all-friend-requests': (FRIEND_REQUEST_FIELDS, all_friend_request_querysets, dict),
+}
+# kinds the export endpoint offers for a single user, the others dump the whole graph
+USER_EXPORTS = ('friends', 'friend-requests')
+
+
+def export_value(value):
+    # ISO 8601 with the full precision and offset in both formats, where str() and DjangoJSONEncoder
+    # would each write datetimes their own way
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class Echo:
+    # file-like object for csv.writer, hands every formatted line straight back
+
+    def write(self, value):
+        return value
+
+
+def encode_csv(fields):
+    writer = csv.writer(Echo())
+    header = writer.writerow(fields)
+
+    def encode(row):
+        return writer.writerow([export_value(row[field]) for field in fields])
+    return header, encode
+
+
+def encode_ndjson(fields):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+    def encode(row):
+        return encoder.encode({field: export_value(row[field]) for field in fields}) + '\n'
+    return None, encode
+
+
+ENCODERS = {
+    'ndjson': encode_ndjson,
+    'csv': encode_csv,
+}
+
+
+def export_chunks(kind, export_format, user_id=None, batch_size=EXPORT_BATCH_SIZE):
+    # one string per batch of rows, the header line first
+    fields, querysets, transform = EXPORTS[kind]
+    header, encode = ENCODERS[export_format](fields)
+    if header:
+        yield header
+    for queryset, key in querysets(user_id):
+        for batch in keyset_batches(queryset, key, batch_size):
+            yield ''.join(encode(transform(row)) for row in batch)
+
+
+async def aexport_chunks(kind, export_format, user_id=None, batch_size=EXPORT_BATCH_SIZE):
+    fields, querysets, transform = EXPORTS[kind]
+    header, encode = ENCODERS[export_format](fields)
+    if header:
+        yield header
+    for queryset, key in querysets(user_id):
+        async for batch in akeyset_batches(queryset, key, batch_size):
+            yield ''.join(encode(transform(row)) for row in batch)
@@ -0,0 +1,189 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from heapq import nlargest
+from itertools import chain
+from django.conf import settings
+from .models import Friendship
+
+
+class FriendGraph:
+    # Compressed sparse row adjacency of accepted friendships, held in memory per process.
+    # node_ids is the sorted array of user ids with at least one friend, the neighbours of
+    # node_ids[i] are the sorted friend ids in indices[indptr[i]:indptr[i + 1]]. Changes made
+    # after the build live in small add/remove overlays that are folded back in by compact().
+
+    def __init__(self, node_ids=None, indptr=None, indices=None, max_edge_id=0):
+        self.node_ids = node_ids if node_ids is not None else array('q')
+        self.indptr = indptr if indptr is not None else array('q', [0])
+        self.indices = indices if indices is not None else array('q')
+        self.max_edge_id = max_edge_id
+        self.added = {}
+        self.removed = {}
+        self.built_at = time.monotonic()
+        self.refreshed_at = self.built_at
+
+    @classmethod
+    def from_edges(cls, edges, max_edge_id=0):
+        # edges: iterable of (user_id, friend_id) sorted by user_id then friend_id
+        node_ids, indptr, indices = array('q'), array('q', [0]), array('q')
+        current = None
+        for user_id, friend_id in edges:
+            if user_id != current:
+                if current is not None:
+                    indptr.append(len(indices))
+                node_ids.append(user_id)
+                current = user_id
+            indices.append(friend_id)
+        if current is not None:
+            indptr.append(len(indices))
+        return cls(node_ids, indptr, indices, max_edge_id)
+
+    @classmethod
+    def build(cls):
+        max_edge_id = Friendship.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        edges = (Friendship.objects.filter(id__lte=max_edge_id)
+                 .order_by('user_id', 'friend_id')
+                 .values_list('user_id', 'friend_id')
+                 .iterator(chunk_size=20000))
+        return cls.from_edges(edges, max_edge_id)
+
+    @property
+    def overlay_size(self):
+        return sum(map(len, self.added.values())) + sum(map(len, self.removed.values()))
+
+    def base_neighbors(self, user_id):
+        position = bisect_left(self.node_ids, user_id)
+        if position == len(self.node_ids) or self.node_ids[position] != user_id:
+            return self.indices[0:0]
+        return self.indices[self.indptr[position]:self.indptr[position + 1]]
+
+    def neighbors(self, user_id):
+        base = self.base_neighbors(user_id)
+        added = self.added.get(user_id)
+        removed = self.removed.get(user_id)
+        if not added and not removed:
+            return base
+        friend_ids = set(base)
+        if removed:
+            friend_ids -= removed
+        if added:
+            friend_ids |= added
+        return array('q', sorted(friend_ids))
+
+    @staticmethod
+    def _contains(sorted_ids, value):
+        position = bisect_left(sorted_ids, value)
+        return position < len(sorted_ids) and sorted_ids[position] == value
+
+    def has_edge(self, user_id, friend_id):
+        return self._contains(self.neighbors(user_id), friend_id)
+
+    def _set_edge(self, user_id, friend_id, present):
+        add_to, discard_from = (self.added, self.removed) if present else (self.removed, self.added)
+        discard_from.get(user_id, set()).discard(friend_id)
+        in_base = self._contains(self.base_neighbors(user_id), friend_id)
+        if in_base != present:
+            add_to.setdefault(user_id, set()).add(friend_id)
+
+    def add_edge(self, user_id, friend_id):
+        self._set_edge(user_id, friend_id, True)
+        self._set_edge(friend_id, user_id, True)
+
+    def remove_edge(self, user_id, friend_id):
+        self._set_edge(user_id, friend_id, False)
+        self._set_edge(friend_id, user_id, False)
+
+    def compact(self):
+        touched = set(self.added) | set(self.removed)
+        if not touched:
+            return self
+
+        def edges():
+            merged = sorted(set(self.node_ids) | touched)
+            for user_id in merged:
+                for friend_id in self.neighbors(user_id):
+                    yield user_id, friend_id
+
+        graph = self.from_edges(edges(), self.max_edge_id)
+        graph.built_at = self.built_at
+        graph.refreshed_at = self.refreshed_at
+        return graph
+
+    def mutual_friends(self, user_id, other_id):
+        return sorted(set(self.neighbors(user_id)).intersection(self.neighbors(other_id)))
+
+    def suggestions(self, user_id, limit=10):
+        # friends of friends ranked by the number of mutual friends, ties broken by lowest user id
+        friend_ids = self.neighbors(user_id)
+        counts = Counter(chain.from_iterable(map(self.neighbors, friend_ids)))
+        counts.pop(user_id, None)
+        for friend_id in friend_ids:
+            counts.pop(friend_id, None)
+        return nlargest(limit, counts.items(), key=lambda item: (item[1], -item[0]))
+
+
+_graph = None
+_lock = threading.Lock()
+
+
+def graph_settings():
+    return {
+        'refresh_seconds': getattr(settings, 'FRIEND_GRAPH_REFRESH_SECONDS', 30),
+        'rebuild_seconds': getattr(settings, 'FRIEND_GRAPH_REBUILD_SECONDS', 900),
+        'max_overlay': getattr(settings, 'FRIEND_GRAPH_MAX_OVERLAY', 10000),
+    }
+
+
+def get_friend_graph():
+    # Builds the graph on first use. Afterwards new Friendship rows written by other processes are
+    # pulled in incrementally every refresh_seconds, and the graph is rebuilt from scratch every
+    # rebuild_seconds so removals made elsewhere are picked up too.
+    global _graph
+    options = graph_settings()
+    with _lock:
+        now = time.monotonic()
+        if _graph is None or now - _graph.built_at > options['rebuild_seconds']:
+            _graph = FriendGraph.build()
+        elif now - _graph.refreshed_at > options['refresh_seconds']:
+            new_edges = (Friendship.objects.filter(id__gt=_graph.max_edge_id)
+                         .order_by('id')
+                         .values_list('id', 'user_id', 'friend_id'))
+            for edge_id, user_id, friend_id in new_edges.iterator(chunk_size=20000):
+                _graph.add_edge(user_id, friend_id)
+                _graph.max_edge_id = edge_id
+            _graph.refreshed_at = now
+        if _graph.overlay_size > options['max_overlay']:
+            _graph = _graph.compact()
+        return _graph
+
+
+def friend_suggestions(user_id, limit=10):
+    graph = get_friend_graph()
+    with _lock:
+        return graph.suggestions(user_id, limit)
+
+
+def mutual_friends(user_id, other_id):
+    graph = get_friend_graph()
+    with _lock:
+        return graph.mutual_friends(user_id, other_id)
+
+
+def apply_friendship_change(user_id, friend_id, present):
+    # keeps an already built graph in step with writes made by this process
+    with _lock:
+        if _graph is None:
+            return
+        if present:
+            _graph.add_edge(user_id, friend_id)
+        else:
+            _graph.remove_edge(user_id, friend_id)
+
+
+def reset_friend_graph():
+    global _graph
+    with _lock:
+        _graph = None
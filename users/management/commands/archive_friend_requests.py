@@ -0,0 +1,61 @@
+import time
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from users.archive import archive_batch
+from users.archive import retention_rules
+
+
+class Command(BaseCommand):
+    help = ('Move cancelled and expired friend requests to the archive table according to '
+            'USERS_FRIEND_REQUEST_RETENTION, in batches of one short transaction each.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--rule', action='append', dest='rules',
+                            help='Only run this retention rule (repeatable).')
+        parser.add_argument('--days', type=int,
+                            help='Keep friend requests this many days instead of the configured retention.')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches, to go easy on replicas.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the friend requests that would be archived.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        rules = retention_rules()
+        for rule in options['rules'] or []:
+            if rule not in rules:
+                raise CommandError(f'Unknown or disabled retention rule {rule!r}, configured: {", ".join(rules)}')
+        if options['rules']:
+            rules = {rule: rules[rule] for rule in options['rules']}
+        if options['days'] is not None:
+            rules = dict.fromkeys(rules, options['days'])
+
+        verb = 'would archive' if dry_run else 'archived'
+        total = 0
+        started = time.perf_counter()
+        for rule, days in rules.items():
+            rule_started = time.perf_counter()
+            last_id = 0
+            archived = 0
+            batches = 0
+            while True:
+                last_id, count = archive_batch(rule, days, last_id, batch_size, dry_run=dry_run)
+                if last_id is None:
+                    break
+                archived += count
+                batches += 1
+                self.stdout.write(f'{rule}: {verb} {archived} friend requests, up to id {last_id}')
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+            elapsed = time.perf_counter() - rule_started
+            rate = archived / elapsed if elapsed else 0
+            self.stdout.write(f'{rule} (older than {days} days): {verb} {archived} friend requests '
+                              f'in {batches} batches, {elapsed:.1f}s, {rate:.0f} rows/s')
+            total += archived
+
+        elapsed = time.perf_counter() - started
+        rate = total / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(f'Done: {verb} {total} friend requests in {elapsed:.1f}s '
+                                             f'({rate:.0f} rows/s).'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from users.models import FriendRequest
+from users.models import Friendship
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Friendship edge table from accepted friend requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--clear', action='store_true',
+                            help='Delete all existing edges before backfilling.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['clear']:
+            Friendship.objects.all().delete()
+
+        accepted = FriendRequest.objects.filter(is_accepted=True, is_cancelled=False).order_by('id')
+        last_id = 0
+        total = 0
+        while True:
+            batch = list(accepted.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic():
+                Friendship.sync(batch)
+            last_id = batch[-1].id
+            total += len(batch)
+            self.stdout.write(f'Backfilled {total} friend requests')
+
+        stale = Friendship.objects.exclude(friend_request__is_accepted=True, friend_request__is_cancelled=False)
+        removed, _ = stale.delete()
+        self.stdout.write(self.style.SUCCESS(f'Done: {total} accepted friend requests, {removed} stale edges removed.'))
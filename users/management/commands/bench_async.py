@@ -0,0 +1,183 @@
+import asyncio
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient
+from django.test import Client
+from django.test.utils import override_settings
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.urls import include
+from django.urls import path
+from django.urls import reverse
+from users.urls import build_urlpatterns
+from .bench_endpoints import Command as BenchEndpointsCommand
+from .bench_endpoints import percentile
+
+READ_ROUTES = ('user-list', 'user-detail', 'friend-list', 'friend-create')
+
+
+def urlconf(async_views):
+    # a ROOT_URLCONF of its own per mode, so both run in one process whatever USERS_ASYNC_VIEWS says
+    module = ModuleType('bench_async_urls_async' if async_views else 'bench_async_urls_sync')
+    module.urlpatterns = [path('api/', include(build_urlpatterns(async_views)))]
+    return module
+
+
+class SimulatedLatency:
+    # execute_wrapper sleeping before every query, stands in for the network round trip to MySQL
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, execute, sql, params, many, context):
+        time.sleep(self.seconds)
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connection_created.connect(self.install, weak=False)
+        for opened in connections.all(initialized_only=True):
+            self.install(connection=opened)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.install)
+        for opened in connections.all(initialized_only=True):
+            if self in opened.execute_wrappers:
+                opened.execute_wrappers.remove(self)
+
+
+class Command(BaseCommand):
+    help = ('Compare one WSGI worker serving the read endpoints with the sync views against one ASGI '
+            'event loop serving them with the async views (USERS_ASYNC_VIEWS), at several levels of '
+            'concurrency, and report throughput and latency as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Requests per run.')
+        parser.add_argument('--concurrency', default='1,10,50',
+                            help='Comma separated numbers of requests in flight on the ASGI side.')
+        parser.add_argument('--threads', type=int, default=1,
+                            help='Threads of the WSGI worker, each one serves a single request at a time.')
+        parser.add_argument('--db-latency', type=float, default=0,
+                            help='Milliseconds added to every query to simulate a remote database.')
+        parser.add_argument('--cold-cache', action='store_true',
+                            help='Run with a dummy cache so every read goes to the database.')
+        parser.add_argument('--output', default='bench_async.json')
+
+    def handle(self, *args, **options):
+        actor = BenchEndpointsCommand.pick_actor()
+        if actor is None:
+            raise CommandError('No users with friends found, run generate_social_graph first.')
+        try:
+            levels = sorted({int(level) for level in options['concurrency'].split(',') if level.strip()})
+        except ValueError:
+            raise CommandError('--concurrency takes a comma separated list of integers.')
+
+        overrides = {}
+        if options['cold_cache']:
+            overrides['CACHES'] = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+        results = []
+        setup_test_environment()
+        try:
+            with override_settings(**overrides), SimulatedLatency(options['db_latency'] / 1000):
+                with override_settings(ROOT_URLCONF=urlconf(False)):
+                    urls = self.urls(actor)
+                    results.append(self.run_wsgi(actor, urls, options['requests'], options['threads']))
+                with override_settings(ROOT_URLCONF=urlconf(True)):
+                    for level in levels:
+                        results.append(asyncio.run(self.run_asgi(actor, urls, options['requests'], level)))
+        finally:
+            teardown_test_environment()
+
+        report = {
+            'requests': options['requests'],
+            'db_latency_ms': options['db_latency'],
+            'cold_cache': options['cold_cache'],
+            'routes': dict(zip(READ_ROUTES, urls)),
+            'runs': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        self.print_report(report)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}'))
+
+    @staticmethod
+    def urls(actor):
+        kwargs = {'pk': actor.id}
+        return [reverse(name, kwargs=kwargs) if name in ('user-detail', 'friend-list') else reverse(name)
+                for name in READ_ROUTES]
+
+    def run_wsgi(self, actor, urls, total, threads):
+        def serve(count):
+            client = Client()
+            client.force_login(actor)
+            latencies, statuses = [], set()
+            try:
+                for i in range(count):
+                    started = time.perf_counter()
+                    response = client.get(urls[i % len(urls)])
+                    latencies.append((time.perf_counter() - started) * 1000)
+                    statuses.add(response.status_code)
+            finally:
+                if threads > 1:
+                    connection.close()
+            return latencies, statuses
+
+        shares = [total // threads + (1 if i < total % threads else 0) for i in range(threads)]
+        started = time.perf_counter()
+        if threads == 1:
+            outcomes = [serve(total)]
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                outcomes = list(executor.map(serve, shares))
+        elapsed = time.perf_counter() - started
+        latencies = [latency for outcome, _ in outcomes for latency in outcome]
+        statuses = set().union(*(outcome for _, outcome in outcomes))
+        return self.summary('wsgi', threads, latencies, statuses, elapsed)
+
+    async def run_asgi(self, actor, urls, total, concurrency):
+        client = AsyncClient()
+        await asyncio.to_thread(client.force_login, actor)
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies, statuses = [], set()
+
+        async def serve(i):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.get(urls[i % len(urls)])
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses.add(response.status_code)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(serve(i) for i in range(total)))
+        return self.summary('asgi', concurrency, latencies, statuses, time.perf_counter() - started)
+
+    @staticmethod
+    def summary(mode, concurrency, latencies, statuses, elapsed):
+        return {
+            'mode': mode,
+            'concurrency': concurrency,
+            'status': sorted(statuses),
+            'requests_per_second': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+        }
+
+    def print_report(self, report):
+        self.stdout.write(f'{"mode":<8}{"in flight":>10}{"status":>10}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}')
+        for run in report['runs']:
+            self.stdout.write(f'{run["mode"]:<8}{run["concurrency"]:>10}{",".join(map(str, run["status"])):>10}'
+                              f'{run["requests_per_second"]:>10.1f}{run["p50_ms"]:>10.2f}{run["p95_ms"]:>10.2f}')
@@ -0,0 +1,81 @@
+import json
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.urls import NoReverseMatch
+from django.urls import reverse
+from users.authentication import issue_token
+from .bench_endpoints import Command as BenchEndpointsCommand
+from .bench_endpoints import percentile
+
+
+class Command(BaseCommand):
+    help = ('Compare session authentication with signed token authentication on one endpoint and '
+            'report requests/sec, latency and queries per request as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--route', default='user-detail',
+                            help='URL name to request, routes taking a pk get the benchmark user.')
+        parser.add_argument('--output', default='bench_auth.json')
+
+    def handle(self, *args, **options):
+        actor = BenchEndpointsCommand.pick_actor()
+        if actor is None:
+            raise CommandError('No users with friends found, run generate_social_graph first.')
+        try:
+            url = reverse(options['route'], kwargs={'pk': actor.id})
+        except NoReverseMatch:
+            url = reverse(options['route'])
+
+        session_client = Client()
+        session_client.force_login(actor)
+        token_client = Client(HTTP_AUTHORIZATION=f'Token {issue_token(actor)}')
+
+        setup_test_environment()
+        try:
+            results = {
+                'session': self.run(session_client, url, options['requests']),
+                'token': self.run(token_client, url, options['requests']),
+            }
+        finally:
+            teardown_test_environment()
+
+        report = {'url': url, 'requests': options['requests'], 'results': results}
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        self.stdout.write(f'{"auth":<10}{"status":>10}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"queries":>9}')
+        for name, result in results.items():
+            self.stdout.write(f'{name:<10}{",".join(map(str, result["status"])):>10}'
+                              f'{result["requests_per_second"]:>10.1f}{result["p50_ms"]:>10.2f}'
+                              f'{result["p95_ms"]:>10.2f}{result["queries"]:>9}')
+        self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}'))
+
+    @staticmethod
+    def run(client, url, total):
+        # one warm-up request, so the token version is cached as it is in steady state
+        client.get(url)
+        latencies, queries, statuses = [], [], set()
+        started = time.perf_counter()
+        for _ in range(total):
+            with CaptureQueriesContext(connection) as captured:
+                request_started = time.perf_counter()
+                response = client.get(url)
+                latencies.append((time.perf_counter() - request_started) * 1000)
+            queries.append(len(captured.captured_queries))
+            statuses.add(response.status_code)
+        elapsed = time.perf_counter() - started
+        return {
+            'status': sorted(statuses),
+            'requests_per_second': round(total / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+            'queries': max(queries),
+        }
@@ -0,0 +1,189 @@
+import json
+import math
+import statistics
+import time
+from itertools import count
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.urls import reverse
+from django.utils import timezone
+from users import urls as users_urls
+from users.models import User
+from users.models import FriendRequest
+from users.models import Friendship
+from .generate_social_graph import DEFAULT_PASSWORD
+
+BENCH_EMAIL_PREFIX = 'bench-endpoint-'
+UNTHROTTLED = {'rate': '1000000/s', 'burst': 1000000}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = ('Drive every route in users/urls.py through the test client against the current database '
+            'and report p50/p95 latency and query counts per endpoint as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=30)
+        parser.add_argument('--output', default='bench_endpoints.json')
+        parser.add_argument('--compare', help='Earlier output file to compare against.')
+        parser.add_argument('--password', default=DEFAULT_PASSWORD,
+                            help='Password of the benchmark user, as set by generate_social_graph.')
+        parser.add_argument('--cold-cache', action='store_true',
+                            help='Run with a dummy cache so every read goes to the database.')
+
+    def handle(self, *args, **options):
+        actor = self.pick_actor()
+        if actor is None:
+            raise CommandError('No users with friends found, run generate_social_graph first.')
+
+        throttles = {scope: UNTHROTTLED for scope in ('friend_request', 'login', 'register')}
+        overrides = {'THROTTLE_BUCKETS': throttles}
+        if options['cold_cache']:
+            overrides['CACHES'] = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+        started = timezone.now()
+        # lets the test client talk to the 'testserver' host whatever ALLOWED_HOSTS says, unless the
+        # test runner has done so already
+        try:
+            setup_test_environment()
+            own_environment = True
+        except RuntimeError:
+            own_environment = False
+        try:
+            with override_settings(**overrides):
+                results = self.run(actor, options)
+        finally:
+            if own_environment:
+                teardown_test_environment()
+            self.cleanup(started)
+
+        report = {
+            'generated_at': started.isoformat(),
+            'iterations': options['iterations'],
+            'cold_cache': options['cold_cache'],
+            'users': User.objects.count(),
+            'friend_requests': FriendRequest.objects.count(),
+            'endpoints': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        self.print_report(report, options.get('compare'))
+        self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}'))
+
+    @staticmethod
+    def pick_actor():
+        # the best connected user, so friend lists and suggestions have real work to do
+        top = (Friendship.objects.values('user_id').annotate(degree=Count('id'))
+               .order_by('-degree').values_list('user_id', flat=True).first())
+        return User.objects.filter(id=top).first() if top else None
+
+    def scenarios(self, actor, options):
+        friend_id = Friendship.objects.filter(user=actor).values_list('friend_id', flat=True).first()
+        friend_request_id = FriendRequest.objects.filter(receiver=actor).values_list('id', flat=True).first()
+        stranger_ids = iter(User.objects.exclude(id=actor.id).exclude(friend_of__user=actor)
+                            .exclude(friend_requests_received__sender=actor)
+                            .exclude(friend_requests_sent__receiver=actor)
+                            .values_list('id', flat=True)[:options['iterations'] * 3])
+        serial = count()
+        pk = {'pk': actor.id}
+        search = actor.first_name[:3].lower() or 'a'
+
+        def register():
+            email = f'{BENCH_EMAIL_PREFIX}{next(serial)}@example.com'
+            return {'email': email, 'first_name': 'Bench', 'last_name': 'Mark', 'password': 'bench-Pa55word'}
+
+        # name -> (method, url, data factory, authenticated)
+        return {
+            'register': ('post', reverse('register'), register, False),
+            'login': ('post', reverse('login'), lambda: {'email': actor.email, 'password': options['password']}, False),
+            'logout': ('post', reverse('logout'), None, True),
+            'root': ('get', reverse('root'), None, True),
+            'user-list': ('get', reverse('user-list'), None, True),
+            'user-list?search': ('get', reverse('user-list') + f'?search={search}', None, True),
+            'user-list?cursor': ('get', reverse('user-list') + '?paginate=cursor', None, True),
+            'user-detail': ('get', reverse('user-detail', kwargs=pk), None, True),
+            'friend-list': ('get', reverse('friend-list', kwargs=pk), None, True),
+            'friend-suggestions': ('get', reverse('friend-suggestions', kwargs=pk), None, True),
+            'mutual-friends': ('get', reverse('mutual-friends', kwargs={'pk': actor.id, 'other_pk': friend_id or actor.id}),
+                               None, True),
+            'user-export': ('get', reverse('user-export', kwargs={'pk': actor.id, 'kind': 'friend-requests'}), None, True),
+            'friend-create': ('get', reverse('friend-create'), None, True),
+            'friend-create?pending': ('get', reverse('friend-create') + '?state=pending', None, True),
+            'friend-create:post': ('post', reverse('friend-create'), lambda: {'receiver': next(stranger_ids, actor.id)},
+                                   True),
+            'friend-request-bulk': ('post', reverse('friend-request-bulk'),
+                                    lambda: {'action': 'create', 'receivers': [next(stranger_ids, actor.id)]}, True),
+            'friendrequest-detail': ('get', reverse('friendrequest-detail', kwargs={'pk': friend_request_id or 0}),
+                                     None, True),
+            'cache-stats': ('get', reverse('cache-stats'), None, True),
+            'metrics': ('get', reverse('metrics'), None, True),
+        }
+
+    def run(self, actor, options):
+        scenarios = self.scenarios(actor, options)
+        covered = {name.split('?')[0].split(':')[0] for name in scenarios}
+        for pattern in users_urls.urlpatterns:
+            if pattern.name and pattern.name not in covered:
+                self.stderr.write(f'No benchmark scenario for route {pattern.name}')
+
+        results = {}
+        for name, (method, url, data, authenticated) in scenarios.items():
+            latencies, queries, statuses = [], [], set()
+            for _ in range(options['iterations']):
+                client = Client()
+                if authenticated:
+                    client.force_login(actor)
+                payload = data() if data else None
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    if method == 'get':
+                        response = client.get(url)
+                    else:
+                        response = client.post(url, json.dumps(payload or {}), content_type='application/json')
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                    latencies.append((time.perf_counter() - started) * 1000)
+                queries.append(len(captured.captured_queries))
+                statuses.add(response.status_code)
+            results[name] = {
+                'method': method.upper(),
+                'url': url,
+                'status': sorted(statuses),
+                'p50_ms': round(percentile(latencies, 0.50), 3),
+                'p95_ms': round(percentile(latencies, 0.95), 3),
+                'mean_ms': round(statistics.mean(latencies), 3),
+                'queries': max(queries),
+            }
+        return results
+
+    @staticmethod
+    def cleanup(started):
+        User.objects.filter(email__startswith=BENCH_EMAIL_PREFIX).delete()
+        FriendRequest.objects.filter(created_on__gte=started).delete()
+
+    def print_report(self, report, compare_path):
+        previous = {}
+        if compare_path:
+            with open(compare_path) as compare_file:
+                previous = json.load(compare_file).get('endpoints', {})
+        self.stdout.write(f'{"endpoint":<24}{"status":>10}{"p50 ms":>10}{"p95 ms":>10}{"queries":>9}'
+                          + (f'{"p50 delta":>11}{"queries delta":>15}' if previous else ''))
+        for name, result in report['endpoints'].items():
+            line = (f'{name:<24}{",".join(map(str, result["status"])):>10}{result["p50_ms"]:>10.2f}'
+                    f'{result["p95_ms"]:>10.2f}{result["queries"]:>9}')
+            if name in previous:
+                before = previous[name]
+                change = (result['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0
+                line += f'{change:>+10.1f}%{result["queries"] - before["queries"]:>+15}'
+            self.stdout.write(line)
@@ -0,0 +1,104 @@
+import io
+import json
+import statistics
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from django.utils import timezone
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from users.pagination import ClampedPageNumberPagination
+from users.renderers import FastJSONParser
+from users.renderers import FastJSONRenderer
+from users.renderers import orjson
+from users.serializers import UserRowSerializer
+
+
+class Command(BaseCommand):
+    help = ('Compare the stock DRF JSON renderer and parser with the ones of the production profile '
+            '(users/renderers.py) on paginated user list pages, and report pages/sec and MB/sec as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-sizes', type=int, nargs='*', default=[10, 100, 1000])
+        parser.add_argument('--seconds', type=float, default=1.0,
+                            help='Time spent on each renderer, parser and page size.')
+        parser.add_argument('--output', default='bench_renderers.json')
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stderr.write('orjson is not installed, the fast renderer and parser fall back to DRF.')
+        candidates = {
+            'render': {'drf': JSONRenderer(), 'fast': FastJSONRenderer()},
+            'parse': {'drf': JSONParser(), 'fast': FastJSONParser()},
+        }
+        # the hyperlinks of the rows are built for the test client host, pages go past USERS_MAX_PAGE_SIZE
+        setup_test_environment()
+        try:
+            with override_settings(USERS_MAX_PAGE_SIZE=max(options['page_sizes'])):
+                pages = {page_size: self.page(page_size) for page_size in options['page_sizes']}
+        finally:
+            teardown_test_environment()
+        results = []
+        self.stdout.write(f'{"page":>6}{"step":>8}{"impl":>6}{"pages/s":>12}{"MB/s":>10}{"speedup":>9}')
+        for page_size in options['page_sizes']:
+            data = pages[page_size]
+            body = JSONRenderer().render(data)
+            if FastJSONRenderer().render(data) != body:
+                raise CommandError(f'The fast renderer output differs from JSONRenderer on a {page_size} item page.')
+            for step, implementations in candidates.items():
+                rates = {}
+                for name, implementation in implementations.items():
+                    if step == 'render':
+                        run = lambda: implementation.render(data)
+                    else:
+                        run = lambda: implementation.parse(io.BytesIO(body), 'application/json', {})
+                    rates[name] = self.pages_per_second(run, options['seconds'])
+                for name, rate in rates.items():
+                    result = {'page_size': page_size, 'step': step, 'implementation': name,
+                              'pages_per_second': rate, 'mb_per_second': rate * len(body) / 1e6,
+                              'speedup': rate / rates['drf']}
+                    results.append(result)
+                    self.stdout.write(f'{page_size:>6}{step:>8}{name:>6}{rate:>12.0f}'
+                                      f'{result["mb_per_second"]:>10.1f}{result["speedup"]:>8.2f}x')
+
+        report = {'orjson': getattr(orjson, '__version__', None), 'results': results}
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}'))
+
+    @staticmethod
+    def page(page_size):
+        # what UserListAPIView.get hands to the renderer, built from synthetic values() rows
+        request = Request(RequestFactory().get('/api/users/', {'page_size': page_size}))
+        now = timezone.now()
+        rows = [{'id': i, 'created_on': now - timedelta(minutes=i), 'email': f'user{i}@example.com',
+                 'first_name': f'First{i}', 'last_name': f'Last{i}', 'friend_count': i % 50,
+                 'pending_incoming_count': i % 7, 'pending_outgoing_count': i % 5}
+                for i in range(1, page_size * 3 + 1)]
+        paginator = ClampedPageNumberPagination()
+        page = paginator.paginate_queryset(rows, request)
+        serializer = UserRowSerializer(page, context={'request': request})
+        return paginator.get_paginated_response(serializer.data).data
+
+    @staticmethod
+    def pages_per_second(run, seconds):
+        # median of five rounds, each as many calls as fit in a fifth of the time
+        samples = []
+        for _ in range(5):
+            calls = 0
+            started = time.perf_counter()
+            deadline = started + seconds / 5
+            while True:
+                run()
+                calls += 1
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+            samples.append(calls / (now - started))
+        return statistics.median(samples)
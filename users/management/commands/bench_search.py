@@ -0,0 +1,74 @@
+import random
+import statistics
+import time
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from users.models import User
+from users.search import NgramSearchBackend
+from users.search import SimpleSearchBackend
+
+FIRST_NAMES = ['amar', 'amarendra', 'aman', 'abhirama', 'shahid', 'yousuf', 'sara', 'maria', 'omar', 'lena',
+               'ivan', 'noor', 'kiran', 'diego', 'yuki', 'fatima', 'arjun', 'zoe', 'liam', 'mei']
+LAST_NAMES = ['khan', 'sharma', 'smith', 'garcia', 'ivanova', 'tanaka', 'rossi', 'nguyen', 'haddad', 'kowalski',
+              'mueller', 'silva', 'okafor', 'larsen', 'dubois', 'patel', 'cohen', 'kim', 'novak', 'ali']
+EMAIL_PREFIX = 'bench-search-'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark user search backends on a table of synthetic users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000,
+                            help='Number of synthetic users the table should contain.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--queries', nargs='*', default=['am', 'amar', 'sharma', 'nowhere', 'kiran.patel'])
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--cleanup', action='store_true', help='Delete the synthetic users afterwards.')
+
+    def handle(self, *args, **options):
+        synthetic = User.objects.filter(email__startswith=EMAIL_PREFIX)
+        existing = synthetic.count()
+        if existing < options['users']:
+            self.create_users(existing, options['users'], options['batch_size'], random.Random(options['seed']))
+
+        exact_email = synthetic.order_by('id').values_list('email', flat=True).first()
+        queries = options['queries'] + ([exact_email] if exact_email else [])
+        backends = [SimpleSearchBackend(), NgramSearchBackend()]
+        self.stdout.write(f'{"query":<32}' + ''.join(f'{type(b).__name__:>24}' for b in backends))
+        for query in queries:
+            timings = [self.time_query(backend, query, options['repeat']) for backend in backends]
+            self.stdout.write(f'{query:<32}' + ''.join(f'{t:>21.2f} ms' for t in timings))
+
+        if options['cleanup']:
+            synthetic.delete()
+
+    def create_users(self, start, stop, batch_size, rng):
+        password = make_password(None)
+        backend = NgramSearchBackend()
+        started = time.perf_counter()
+        for offset in range(start, stop, batch_size):
+            users = []
+            for i in range(offset, min(offset + batch_size, stop)):
+                first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+                email = f'{EMAIL_PREFIX}{i}.{first_name}.{last_name}@example.com'
+                users.append(User(email=email, username=email, first_name=first_name.title(),
+                                  last_name=last_name.title(), password=password, is_active=True))
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+                # bulk_create does not return ids on every backend, so index from the table
+                emails = [user.email for user in users]
+                backend.index_users(User.objects.filter(email__in=emails).only('id', 'email', 'first_name', 'last_name'))
+            self.stdout.write(f'Created {min(offset + batch_size, stop)}/{stop} users')
+        self.stdout.write(f'Created {stop - start} users in {time.perf_counter() - started:.1f}s')
+
+    @staticmethod
+    def time_query(backend, query, repeat):
+        users = User.objects.order_by('-created_on', '-id')
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            list(backend.search(users, query)[:10])
+            samples.append((time.perf_counter() - started) * 1000)
+        return statistics.median(samples)
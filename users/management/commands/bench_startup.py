@@ -0,0 +1,39 @@
+import json
+import statistics
+from django.core.management.base import BaseCommand
+from socialapp.startup import STARTUP_BUDGET
+from socialapp.startup import measure
+
+
+class Command(BaseCommand):
+    help = ('Start fresh worker processes under each settings profile and report the time and peak RSS '
+            'from import to the first response of APIBaseView, and the number of modules imported, as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', nargs='*', default=['dev', 'prod', 'api'],
+                            help='Modules of the socialapp.settings package to compare.')
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--output', default='bench_startup.json')
+
+    def handle(self, *args, **options):
+        results = {}
+        for profile in options['profiles']:
+            runs = [measure(f'socialapp.settings.{profile}') for _ in range(options['runs'])]
+            results[profile] = {
+                'status': sorted({run['status'] for run in runs}),
+                'setup_seconds': statistics.median(run['setup_seconds'] for run in runs),
+                'seconds': statistics.median(run['seconds'] for run in runs),
+                'rss_mb': max(run['rss_mb'] for run in runs),
+                'modules': max(run['modules'] for run in runs),
+                'admin': any(run['admin'] for run in runs),
+            }
+
+        report = {'runs': options['runs'], 'budget': STARTUP_BUDGET, 'results': results}
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        self.stdout.write(f'{"profile":<10}{"status":>8}{"setup s":>10}{"first s":>10}{"rss MB":>9}{"modules":>9}{"admin":>7}')
+        for profile, result in results.items():
+            self.stdout.write(f'{profile:<10}{",".join(map(str, result["status"])):>8}{result["setup_seconds"]:>10.3f}'
+                              f'{result["seconds"]:>10.3f}{result["rss_mb"]:>9.1f}{result["modules"]:>9}'
+                              f'{"yes" if result["admin"] else "no":>7}')
+        self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}'))
@@ -0,0 +1,45 @@
+import time
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from users.export import EXPORT_BATCH_SIZE
+from users.export import EXPORTS
+from users.export import USER_EXPORTS
+from users.export import ENCODERS
+from users.export import export_chunks
+
+
+class Command(BaseCommand):
+    help = ('Dump the users, friendships or friend requests of the whole graph, or the friends and friend '
+            'requests of one user, as NDJSON or CSV. Streams the same way as the export endpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=sorted(EXPORTS), default='all-friend-requests')
+        parser.add_argument('--format', dest='export_format', choices=sorted(ENCODERS), default='ndjson')
+        parser.add_argument('--user', type=int, help=f'User id, required by {" and ".join(USER_EXPORTS)}.')
+        parser.add_argument('--output', default='-', help='File to write, - for standard output.')
+        parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        kind = options['kind']
+        if kind in USER_EXPORTS and options['user'] is None:
+            raise CommandError(f'--user is required to export {kind}.')
+
+        started = time.perf_counter()
+        chunks = export_chunks(kind, options['export_format'], options['user'], options['batch_size'])
+        if options['output'] == '-':
+            written = self.write(chunks, lambda chunk: self.stdout.write(chunk, ending=''))
+        else:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+                written = self.write(chunks, output.write)
+            self.stderr.write(self.style.SUCCESS(
+                f'Wrote {written} bytes to {options["output"]} in {time.perf_counter() - started:.1f}s.'
+            ))
+
+    @staticmethod
+    def write(chunks, write):
+        # counts UTF-8 bytes rather than characters, names are not all ASCII
+        written = 0
+        for chunk in chunks:
+            write(chunk)
+            written += len(chunk.encode('utf-8'))
+        return written
@@ -0,0 +1,112 @@
+import random
+import time
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from users.models import User
+from users.models import FriendRequest
+from users.search import SEARCH_FIELDS
+from users.search import get_search_backend
+from users.signals import friend_requests_bulk_changed
+
+FIRST_NAMES = ['amar', 'aman', 'abhirama', 'shahid', 'yousuf', 'sara', 'maria', 'omar', 'lena', 'ivan',
+               'noor', 'kiran', 'diego', 'yuki', 'fatima', 'arjun', 'zoe', 'liam', 'mei', 'tariq']
+LAST_NAMES = ['khan', 'sharma', 'smith', 'garcia', 'ivanova', 'tanaka', 'rossi', 'nguyen', 'haddad', 'kowalski',
+              'mueller', 'silva', 'okafor', 'larsen', 'dubois', 'patel', 'cohen', 'kim', 'novak', 'ali']
+DEFAULT_PASSWORD = 'synthetic-password'
+
+
+class Command(BaseCommand):
+    help = ('Generate synthetic users and a power-law friendship graph of FriendRequest rows, '
+            'written with batched inserts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--avg-friends', type=float, default=20,
+                            help='Average number of friend requests per user.')
+        parser.add_argument('--exponent', type=float, default=2.1,
+                            help='Power-law exponent of the degree distribution, lower means heavier hubs.')
+        parser.add_argument('--accepted-ratio', type=float, default=0.8,
+                            help='Share of friend requests that are accepted, the rest stay pending.')
+        parser.add_argument('--cancelled-ratio', type=float, default=0.05,
+                            help='Share of the pending friend requests that are cancelled.')
+        parser.add_argument('--password', default=DEFAULT_PASSWORD,
+                            help='Password of every generated user, hashed once.')
+        parser.add_argument('--prefix', default='synthetic')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        started = time.perf_counter()
+        user_ids = self.create_users(options, rng)
+        pairs = self.friendship_pairs(user_ids, options, rng)
+        self.create_friend_requests(pairs, options, rng)
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {len(user_ids)} users and {len(pairs)} friend requests '
+            f'in {time.perf_counter() - started:.1f}s.'
+        ))
+
+    def create_users(self, options, rng):
+        password = make_password(options['password'])
+        prefix = options['prefix']
+        run = f'{int(time.time())}{rng.randrange(1000):03d}'
+        backend = get_search_backend()
+        user_ids = []
+        for offset in range(0, options['users'], options['batch_size']):
+            users = []
+            for i in range(offset, min(offset + options['batch_size'], options['users'])):
+                first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+                email = f'{prefix}-{run}-{i}.{first_name}.{last_name}@example.com'
+                users.append(User(email=email, username=email, first_name=first_name.title(),
+                                  last_name=last_name.title(), password=password, is_active=True))
+            with transaction.atomic():
+                User.objects.bulk_create(users)
+                # bulk_create does not return ids on every backend, read them back for the graph
+                created = User.objects.filter(email__in=[user.email for user in users]).only('id', *SEARCH_FIELDS)
+                created = list(created.order_by('id'))
+                backend.index_users(created)
+            user_ids.extend(user.id for user in created)
+            self.stdout.write(f'Created {len(user_ids)}/{options["users"]} users')
+        return user_ids
+
+    @staticmethod
+    def friendship_pairs(user_ids, options, rng):
+        # Chung-Lu style graph: every user draws a Pareto weight and both ends of each edge are
+        # sampled proportionally to it, which gives a power-law degree distribution.
+        if len(user_ids) < 2:
+            return []
+        weights = [rng.paretovariate(options['exponent'] - 1) for _ in user_ids]
+        cumulative = []
+        total = 0
+        for weight in weights:
+            total += weight
+            cumulative.append(total)
+        wanted = min(int(len(user_ids) * options['avg_friends'] / 2),
+                     len(user_ids) * (len(user_ids) - 1) // 2)
+        pairs = set()
+        attempts = 0
+        while len(pairs) < wanted and attempts < wanted * 10:
+            attempts += 1
+            a, b = rng.choices(user_ids, cum_weights=cumulative, k=2)
+            if a != b:
+                pairs.add((min(a, b), max(a, b)))
+        return sorted(pairs)
+
+    def create_friend_requests(self, pairs, options, rng):
+        created_count = 0
+        for offset in range(0, len(pairs), options['batch_size']):
+            friend_requests = []
+            for low, high in pairs[offset:offset + options['batch_size']]:
+                sender_id, receiver_id = (low, high) if rng.random() < 0.5 else (high, low)
+                is_accepted = rng.random() < options['accepted_ratio']
+                is_cancelled = not is_accepted and rng.random() < options['cancelled_ratio']
+                friend_requests.append(FriendRequest(sender_id=sender_id, receiver_id=receiver_id,
+                                                     is_accepted=is_accepted, is_cancelled=is_cancelled))
+            with transaction.atomic():
+                last_id = FriendRequest.objects.order_by('-id').values_list('id', flat=True).first() or 0
+                FriendRequest.objects.bulk_create(friend_requests)
+                created = list(FriendRequest.objects.filter(id__gt=last_id))
+                friend_requests_bulk_changed.send(sender=FriendRequest, friend_requests=created)
+            created_count += len(created)
+            self.stdout.write(f'Created {created_count}/{len(pairs)} friend requests')
@@ -0,0 +1,170 @@
+import csv
+import json
+import os
+import time
+from contextlib import suppress
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from django.contrib.auth.hashers import identify_hasher
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.core.validators import validate_email
+from django.db import transaction
+from users.models import User
+from users.search import SEARCH_FIELDS
+from users.search import get_search_backend
+
+
+def init_worker(settings_module):
+    # worker processes started with spawn (macOS, Windows) import nothing from the parent
+    import django
+    from django.conf import settings
+    if not settings.configured:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+        django.setup()
+
+
+def hash_passwords(passwords):
+    return [make_password(password) for password in passwords]
+
+
+def read_rows(path, input_format):
+    with open(path, newline='', encoding='utf-8') as source:
+        if input_format == 'csv':
+            yield from csv.DictReader(source)
+        else:
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def batches(rows, size):
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+    help = ('Import users from a CSV or JSONL file with email, first_name, last_name and password columns. '
+            'Passwords are hashed in a process pool, users are written with batched bulk_create, and an '
+            'interrupted import picks up from its checkpoint file.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', dest='input_format', choices=['csv', 'jsonl'],
+                            help='Input format, by default taken from the file extension.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Password hashing processes, all cores by default.')
+        parser.add_argument('--prehashed', action='store_true',
+                            help='The password column holds Django password hashes (for example '
+                                 'pbkdf2_sha256$...), stored as they are.')
+        parser.add_argument('--checkpoint', help='Checkpoint file, <path>.checkpoint by default.')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['input_format'] or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+        checkpoint_path = options['checkpoint'] or f'{path}.checkpoint'
+        progress = {'rows': 0, 'created': 0, 'skipped': 0, 'invalid': 0}
+        if os.path.exists(checkpoint_path) and not options['restart']:
+            with open(checkpoint_path) as checkpoint:
+                progress = json.load(checkpoint)
+            self.stdout.write(f'Resuming after row {progress["rows"]} from {checkpoint_path}')
+
+        rows = islice(read_rows(path, input_format), progress['rows'], None)
+        started = time.perf_counter()
+        resumed_rows = progress['rows']
+        executor = None
+        if not options['prehashed'] and options['workers'] > 1:
+            executor = ProcessPoolExecutor(max_workers=options['workers'], initializer=init_worker,
+                                           initargs=(os.environ.get('DJANGO_SETTINGS_MODULE', ''),))
+        try:
+            # hashing of the next batch runs in the pool while the current one is written
+            pending = None
+            for batch in batches(rows, options['batch_size']):
+                submitted = self.prepare(batch, options, executor)
+                if pending is not None:
+                    self.write(pending, progress, checkpoint_path, started, resumed_rows)
+                pending = submitted
+            if pending is not None:
+                self.write(pending, progress, checkpoint_path, started, resumed_rows)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        elapsed = time.perf_counter() - started
+        imported = progress['rows'] - resumed_rows
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} rows in {elapsed:.1f}s ({imported / elapsed if elapsed else 0:.0f} rows/s): '
+            f'{progress["created"]} created, {progress["skipped"]} already existing, {progress["invalid"]} invalid.'
+        ))
+        # nothing was written for an empty input
+        with suppress(FileNotFoundError):
+            os.remove(checkpoint_path)
+
+    def prepare(self, batch, options, executor):
+        # validated users of the batch and their password hashes (futures while being computed)
+        users, passwords, invalid = [], [], 0
+        for row in batch:
+            email = (row.get('email') or '').strip().lower()
+            password = row.get('password') or ''
+            try:
+                validate_email(email)
+                if not password:
+                    raise ValidationError('password is required')
+                if options['prehashed']:
+                    identify_hasher(password)
+            except (ValidationError, ValueError) as exc:
+                invalid += 1
+                self.stderr.write(f'Skipping {email or row}: {exc}')
+                continue
+            users.append(User(email=email, username=email, first_name=(row.get('first_name') or '')[:30],
+                              last_name=(row.get('last_name') or '')[:30], is_active=True))
+            passwords.append(password)
+
+        if options['prehashed']:
+            hashes = passwords
+        elif executor is None:
+            hashes = hash_passwords(passwords)
+        else:
+            # one chunk per worker, so every core gets its share of the batch
+            workers = options['workers']
+            size = max(len(passwords) // workers + (len(passwords) % workers > 0), 1)
+            hashes = [executor.submit(hash_passwords, passwords[start:start + size])
+                      for start in range(0, len(passwords), size)]
+        return {'rows': len(batch), 'users': users, 'hashes': hashes, 'invalid': invalid}
+
+    def write(self, prepared, progress, checkpoint_path, started, resumed_rows):
+        hashes = prepared['hashes']
+        if hashes and not isinstance(hashes[0], str):
+            hashes = [password for future in hashes for password in future.result()]
+        users = prepared['users']
+        for user, password in zip(users, hashes):
+            user.password = password
+
+        emails = [user.email for user in users]
+        with transaction.atomic():
+            existing = set(User.objects.filter(email__in=emails).values_list('email', flat=True))
+            new_users = [user for user in users if user.email not in existing]
+            User.objects.bulk_create(new_users, ignore_conflicts=True)
+            # bulk_create does not return ids on every backend, read them back for the search index
+            created = list(User.objects.filter(email__in=[user.email for user in new_users]).only('id', *SEARCH_FIELDS))
+            get_search_backend().index_users(created)
+
+        progress['rows'] += prepared['rows']
+        progress['created'] += len(created)
+        progress['skipped'] += len(users) - len(created)
+        progress['invalid'] += prepared['invalid']
+        # written after the commit, a batch replayed after a crash in between is skipped as existing
+        temporary = f'{checkpoint_path}.tmp'
+        with open(temporary, 'w') as checkpoint:
+            json.dump(progress, checkpoint)
+        os.replace(temporary, checkpoint_path)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'{progress["rows"]} rows, {progress["created"]} created, '
+                          f'{(progress["rows"] - resumed_rows) / elapsed:.0f} rows/s')
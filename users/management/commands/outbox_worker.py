@@ -0,0 +1,45 @@
+import time
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import close_old_connections
+from users.outbox import drain
+from users.outbox import get_consumers
+
+
+class Command(BaseCommand):
+    help = ('Deliver the friend request events of the outbox to the consumers in USERS_OUTBOX_CONSUMERS, '
+            'in batches, until stopped (or until the outbox is drained with --once).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', action='append', dest='consumers',
+                            help='Only run this consumer, can be repeated. All of them by default.')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when no consumer had anything to do.')
+        parser.add_argument('--once', action='store_true', help='Exit as soon as there is nothing left to deliver.')
+
+    def handle(self, *args, **options):
+        consumers = get_consumers()
+        unknown = set(options['consumers'] or []) - set(consumers)
+        if unknown:
+            raise CommandError(f'Unknown consumers: {", ".join(sorted(unknown))}.')
+        if options['consumers']:
+            consumers = {name: consumers[name] for name in options['consumers']}
+
+        delivered = 0
+        while True:
+            handled = 0
+            for name, handler in consumers.items():
+                count = drain(name, handler, options['batch_size'])
+                if count:
+                    self.stdout.write(f'{name}: {count} events')
+                handled += count
+            delivered += handled
+            if handled:
+                continue
+            if options['once']:
+                break
+            # a long running worker must not hold on to a connection the server already dropped
+            close_old_connections()
+            time.sleep(options['poll_interval'])
+        self.stdout.write(self.style.SUCCESS(f'Delivered {delivered} events.'))
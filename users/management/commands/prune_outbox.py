@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from users.outbox import prune
+
+
+class Command(BaseCommand):
+    help = ('Delete outbox events that every consumer has handled and that are older than '
+            'USERS_OUTBOX_RETENTION_DAYS.')
+
+    def handle(self, *args, **options):
+        removed = prune()
+        self.stdout.write(self.style.SUCCESS(f'Removed {removed} outbox events.'))
@@ -0,0 +1,11 @@
+import time
+from django.core.management.base import BaseCommand
+from users.throttler import get_bucket_store
+
+
+class Command(BaseCommand):
+    help = 'Delete throttle buckets that have fully refilled, they carry no state any more.'
+
+    def handle(self, *args, **options):
+        removed = get_bucket_store().prune(time.time())
+        self.stdout.write(self.style.SUCCESS(f'Removed {removed} idle throttle buckets.'))
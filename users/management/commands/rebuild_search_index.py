@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from users.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the user search index for the configured USERS_SEARCH_BACKEND.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        total = backend.rebuild(
+            batch_size=options['batch_size'],
+            progress=lambda count: self.stdout.write(f'Indexed {count} users'),
+        )
+        self.stdout.write(self.style.SUCCESS(f'Done: {total} users indexed by {type(backend).__name__}.'))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from users.counters import recount
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = ('Recount the friend and pending friend request counters of every user and repair the ones '
+            'that drifted. Also fills them in for users created before the counters existed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        users = User.objects.order_by('id').values_list('id', flat=True)
+        last_id = 0
+        total = 0
+        repaired = 0
+        while True:
+            user_ids = list(users.filter(id__gt=last_id)[:batch_size])
+            if not user_ids:
+                break
+            drifted = recount(user_ids)
+            last_id = user_ids[-1]
+            total += len(user_ids)
+            repaired += len(drifted)
+            self.stdout.write(f'Checked {total} users, {repaired} repaired')
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {total} users checked, {repaired} had drifted counters.'))
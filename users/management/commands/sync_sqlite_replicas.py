@@ -0,0 +1,34 @@
+import sqlite3
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = ('Copy the default SQLite database over every SQLite replica in DATABASE_REPLICAS, once or '
+            'every --interval seconds, to stand in for replication when trying ReplicaRouter locally.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep copying with this many seconds in between, which is the simulated replication lag.')
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS].settings_dict
+        replicas = [connections[alias].settings_dict for alias in getattr(settings, 'DATABASE_REPLICAS', [])]
+        if connections[DEFAULT_DB_ALIAS].vendor != 'sqlite':
+            raise CommandError('The default database is not SQLite, replicas are kept in sync by the server.')
+        if not replicas:
+            raise CommandError('No replicas configured, set DB_SQLITE_REPLICAS.')
+
+        while True:
+            for replica in replicas:
+                # the backup API copies a consistent snapshot even while the primary is being written
+                with sqlite3.connect(primary['NAME']) as source, sqlite3.connect(replica['NAME']) as target:
+                    source.backup(target)
+            self.stdout.write(f'Copied {primary["NAME"]} to {len(replicas)} replicas')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,141 @@
+import threading
+from bisect import bisect_left
+from socialapp.db.pool import pool_stats
+from .cache import cache_stats
+
+# Fixed bucket histograms in the Prometheus layout. Memory is bounded by the number of URL names
+# times the number of buckets, whatever the traffic.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+SIZE_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152, 8388608)
+
+REQUEST_METRICS = (
+    ('http_request_duration_seconds', 'Wall time spent in the view and middleware below it.', DURATION_BUCKETS),
+    ('http_request_db_queries', 'Database queries run per request.', QUERY_BUCKETS),
+    ('http_request_db_duration_seconds', 'Time spent waiting on the database per request.', DURATION_BUCKETS),
+    ('http_response_size_bytes', 'Size of the response body, streaming responses excluded.', SIZE_BUCKETS),
+)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += bucket_count
+            yield f'{name}_bucket', dict(labels, le=str(bound)), cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.responses = {}
+        self.collectors = []
+
+    def observe_request(self, view, method, status, duration, db_queries, db_duration, response_size):
+        values = (duration, db_queries, db_duration, response_size)
+        with self.lock:
+            key = (view, method)
+            if key not in self.histograms:
+                self.histograms[key] = [Histogram(buckets) for _, _, buckets in REQUEST_METRICS]
+            for histogram, value in zip(self.histograms[key], values):
+                if value is not None:
+                    histogram.observe(value)
+            status_key = (view, method, status)
+            self.responses[status_key] = self.responses.get(status_key, 0) + 1
+
+    def register_collector(self, collector):
+        # collector() returns (name, type, help, [(labels, value), ...]) tuples, read on every scrape
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.responses.clear()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for position, (name, help_text, _) in enumerate(REQUEST_METRICS):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (view, method), histograms in sorted(self.histograms.items()):
+                    labels = {'view': view, 'method': method}
+                    lines += [format_sample(*sample) for sample in histograms[position].samples(name, labels)]
+            lines += ['# HELP http_responses_total Responses by view, method and status code.',
+                      '# TYPE http_responses_total counter']
+            for (view, method, status), total in sorted(self.responses.items()):
+                lines.append(format_sample('http_responses_total',
+                                           {'view': view, 'method': method, 'status': status}, total))
+        for collector in self.collectors:
+            for name, metric_type, help_text, samples in collector():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+                lines += [format_sample(name, labels, value) for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_sample(name, labels, value):
+    if labels:
+        rendered = ','.join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+        return f'{name}{{{rendered}}} {value}'
+    return f'{name} {value}'
+
+
+registry = MetricsRegistry()
+
+
+def cache_collector():
+    samples = []
+    for namespace, counts in sorted(cache_stats().items()):
+        samples.append(({'namespace': namespace, 'result': 'hit'}, counts['hits']))
+        samples.append(({'namespace': namespace, 'result': 'miss'}, counts['misses']))
+    return [('users_cache_requests_total', 'counter', 'Per-user cache lookups by namespace and result.', samples)]
+
+
+registry.register_collector(cache_collector)
+
+
+def pool_collector():
+    in_use, idle, max_size, opened, closed, waits, wait_seconds, timeouts = ([] for _ in range(8))
+    for alias, stats in sorted(pool_stats(), key=lambda item: item[0]):
+        labels = {'alias': alias}
+        in_use.append((labels, stats['in_use']))
+        idle.append((labels, stats['idle']))
+        max_size.append((labels, stats['max_size']))
+        opened.append((labels, stats['opened']))
+        closed += [(dict(labels, reason=reason), count) for reason, count in sorted(stats['closed'].items())]
+        waits.append((labels, stats['waits']))
+        wait_seconds.append((labels, round(stats['wait_seconds'], 6)))
+        timeouts.append((labels, stats['timeouts']))
+    return [
+        ('db_pool_connections_in_use', 'gauge', 'Pooled connections checked out by a thread.', in_use),
+        ('db_pool_connections_idle', 'gauge', 'Pooled connections open and waiting to be reused.', idle),
+        ('db_pool_max_size', 'gauge', 'Maximum number of open connections of the pool.', max_size),
+        ('db_pool_connections_opened_total', 'counter', 'Connections opened by the pool.', opened),
+        ('db_pool_connections_closed_total', 'counter', 'Connections closed by the pool, by reason.', closed),
+        ('db_pool_waits_total', 'counter', 'Checkouts that had to wait for a connection.', waits),
+        ('db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a connection.', wait_seconds),
+        ('db_pool_timeouts_total', 'counter', 'Checkouts that gave up waiting.', timeouts),
+    ]
+
+
+registry.register_collector(pool_collector)
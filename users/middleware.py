@@ -0,0 +1,176 @@
+import time
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction
+from asgiref.sync import markcoroutinefunction
+from asgiref.sync import sync_to_async
+from django.contrib.auth import SESSION_KEY
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from rest_framework.exceptions import AuthenticationFailed
+from .authentication import SignedTokenAuthentication
+from .cache import PRIMARY_PIN_KEY
+from .cache import get_cache
+from .cache import pin_to_primary
+from .metrics import registry
+from .routers import RoutingState
+from .routers import pin_seconds
+from .routers import replicas
+from .routers import routing_state
+
+# anything else is folded into 'other' so clients cannot grow the label set
+KNOWN_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+# QueryTimer of the request being served. A context variable rather than a per-request
+# execute_wrapper so it follows async views into the threads the async ORM runs queries on.
+current_timer = ContextVar('current_timer', default=None)
+
+
+class QueryTimer:
+    # counts the queries of one request and the time spent in them
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+
+def time_query(execute, sql, params, many, context):
+    timer = current_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.duration += time.perf_counter() - started
+        timer.count += 1
+
+
+@receiver(connection_created)
+def install_query_timer(sender, connection, **kwargs):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+class RequestMetricsMiddleware:
+    # Records wall time, query count, database time and response size per resolved URL name.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # connections opened before the middleware was loaded missed connection_created
+        for connection in connections.all(initialized_only=True):
+            install_query_timer(sender=None, connection=connection)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        timer = QueryTimer()
+        token = current_timer.set(timer)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_timer.reset(token)
+        self.observe(request, response, timer, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        timer = QueryTimer()
+        token = current_timer.set(timer)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_timer.reset(token)
+        self.observe(request, response, timer, time.perf_counter() - started)
+        return response
+
+    @staticmethod
+    def observe(request, response, timer, duration):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else '<unresolved>'
+        size = None if response.streaming else len(response.content)
+        method = request.method if request.method in KNOWN_METHODS else 'other'
+        registry.observe_request(view, method, response.status_code, duration,
+                                 timer.count, timer.duration, size)
+
+
+class ReplicaPinMiddleware:
+    # Read-your-writes for ReplicaRouter. A request that wrote to the users app pins its client to
+    # the primary for DATABASE_REPLICA_PIN_SECONDS: through a cookie, which also covers anonymous
+    # writes such as a signup, and through a cache entry per user for token clients without a
+    # cookie jar. The other users a write touched are pinned through the same cache entry when
+    # their cached responses are invalidated (users.cache.invalidate). Needs SessionMiddleware above it.
+    cookie_name = 'primary_until'
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not replicas():
+            return self.get_response(request)
+        user_id = self.request_user_id(request)
+        state = RoutingState(self.pinned_until(request, user_id))
+        token = routing_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            routing_state.reset(token)
+        if state.wrote:
+            self.pin(request, response, user_id)
+        return response
+
+    async def __acall__(self, request):
+        if not replicas():
+            return await self.get_response(request)
+        user_id = await sync_to_async(self.request_user_id)(request)
+        state = RoutingState(await sync_to_async(self.pinned_until)(request, user_id))
+        token = routing_state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            routing_state.reset(token)
+        if state.wrote:
+            await sync_to_async(self.pin)(request, response, user_id)
+        return response
+
+    @staticmethod
+    def request_user_id(request):
+        # who is calling, without reading the user table: the signed token or the session
+        authentication = SignedTokenAuthentication()
+        try:
+            token = authentication.get_token(request)
+            if token is not None:
+                return authentication.verify(token)[0]
+        except AuthenticationFailed:
+            return None
+        return request.session.get(SESSION_KEY)
+
+    def pinned_until(self, request, user_id):
+        try:
+            pinned_until = float(request.COOKIES.get(self.cookie_name, 0))
+        except ValueError:
+            pinned_until = 0.0
+        if user_id is not None:
+            pinned_until = max(pinned_until, get_cache().get(PRIMARY_PIN_KEY.format(user_id=user_id), 0))
+        return pinned_until
+
+    def pin(self, request, response, user_id):
+        if user_id is None:
+            # the request may have logged someone in (or signed them up and in)
+            user_id = request.session.get(SESSION_KEY)
+        pinned_until = pin_to_primary([] if user_id is None else [user_id])
+        response.set_cookie(self.cookie_name, f'{pinned_until:.3f}', max_age=pin_seconds(), httponly=True,
+                            samesite='Lax')
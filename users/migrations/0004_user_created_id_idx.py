@@ -0,0 +1,17 @@
+# Generated by Django 4.0 on 2026-10-18 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_friendship'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['created_on', 'id'], name='user_created_id_idx'),
+        ),
+    ]
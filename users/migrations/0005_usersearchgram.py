@@ -0,0 +1,26 @@
+# Generated by Django 4.0 on 2026-10-18 19:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_user_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSearchGram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=3)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_grams', to='users.user')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='usersearchgram',
+            constraint=models.UniqueConstraint(fields=('gram', 'user'), name='unique_user_search_gram'),
+        ),
+    ]
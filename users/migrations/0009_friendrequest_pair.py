@@ -0,0 +1,33 @@
+# Generated by Django 4.2.3 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Expand step: nullable pair columns, filled in by the application from now on, and the indexes
+    # of the friend request lists (secondary indexes are built online). 0010 backfills and constrains.
+
+    dependencies = [
+        ('users', '0008_user_friend_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='friendrequest',
+            name='user_low',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='friendrequest',
+            name='user_high',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['receiver', 'is_accepted', 'created_on'], name='fr_receiver_accepted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['sender', 'is_accepted', 'created_on'], name='fr_sender_accepted_idx'),
+        ),
+    ]
@@ -0,0 +1,110 @@
+# Generated by Django 4.2.3 on 2026-10-18 21:05
+
+from django.db import migrations, models
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.functions import Least
+from django.utils import timezone
+
+BATCH_SIZE = 5000
+
+
+def backfill_pairs(apps, schema_editor):
+    # one short UPDATE per id range, each committed on its own, so the table is never locked for long
+    FriendRequest = apps.get_model('users', 'FriendRequest')
+    friend_requests = FriendRequest.objects.using(schema_editor.connection.alias)
+    missing = friend_requests.filter(user_low__isnull=True).order_by('id').values_list('id', flat=True)
+    last_id = 0
+    while True:
+        ids = list(missing.filter(id__gt=last_id)[:BATCH_SIZE])
+        if not ids:
+            break
+        friend_requests.filter(id__gt=last_id, id__lte=ids[-1], user_low__isnull=True).update(
+            user_low=Least(F('sender'), F('receiver')),
+            user_high=Greatest(F('sender'), F('receiver')),
+        )
+        last_id = ids[-1]
+
+
+def merge_reverse_duplicates(apps, schema_editor):
+    # A->B and B->A were both allowed before the pair key and now share one pair. Per pair, keep the
+    # request the friendship edges point to, else an accepted one, else the newest; the others are
+    # deleted with their edges and the counters of both users are recounted.
+    FriendRequest = apps.get_model('users', 'FriendRequest')
+    Friendship = apps.get_model('users', 'Friendship')
+    alias = schema_editor.connection.alias
+    friend_requests = FriendRequest.objects.using(alias)
+    duplicated = (friend_requests.values_list('user_low', 'user_high').annotate(count=Count('id'))
+                  .filter(count__gt=1).order_by())
+    for user_low, user_high, _ in list(duplicated):
+        with transaction.atomic(using=alias):
+            rows = list(friend_requests.filter(user_low=user_low, user_high=user_high).select_for_update())
+            with_edges = set(Friendship.objects.using(alias).filter(friend_request__in=rows)
+                             .values_list('friend_request_id', flat=True))
+            rows.sort(key=lambda row: (row.id in with_edges, row.is_accepted and not row.is_cancelled,
+                                       row.modified_on, row.id), reverse=True)
+            friend_requests.filter(id__in=[row.id for row in rows[1:]]).delete()
+            recount_users(apps, alias, [user_low, user_high])
+
+
+def recount_users(apps, alias, user_ids):
+    # users.counters.recount against the historical models
+    User = apps.get_model('users', 'User')
+    FriendRequest = apps.get_model('users', 'FriendRequest')
+    Friendship = apps.get_model('users', 'Friendship')
+    pending = FriendRequest.objects.using(alias).filter(is_accepted=False, is_cancelled=False)
+    for user_id in user_ids:
+        User.objects.using(alias).filter(id=user_id).update(
+            friend_count=Friendship.objects.using(alias).filter(user_id=user_id).count(),
+            pending_outgoing_count=pending.filter(sender_id=user_id).count(),
+            pending_incoming_count=pending.filter(receiver_id=user_id).count(),
+            modified_on=timezone.now(),
+        )
+
+
+class Migration(migrations.Migration):
+    # Contract step: backfill the pair of the rows written before 0009, merge the A->B and B->A
+    # requests that now share a pair, then make it the one unique key of a friend request in place of the two (sender, receiver) constraints. Plain indexes on
+    # both directions are built before the constraints go, so the columns are never left unindexed.
+    atomic = False
+
+    dependencies = [
+        ('users', '0009_friendrequest_pair'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_pairs, migrations.RunPython.noop),
+        migrations.RunPython(merge_reverse_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='friendrequest',
+            name='user_low',
+            field=models.BigIntegerField(editable=False),
+        ),
+        migrations.AlterField(
+            model_name='friendrequest',
+            name='user_high',
+            field=models.BigIntegerField(editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='friendrequest',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_friend_request_pair'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['sender', 'receiver'], name='fr_sender_receiver_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['receiver', 'sender'], name='fr_receiver_sender_idx'),
+        ),
+        migrations.RemoveConstraint(
+            model_name='friendrequest',
+            name='unique_friend_request',
+        ),
+        migrations.RemoveConstraint(
+            model_name='friendrequest',
+            name='unique_friend_request_reverse',
+        ),
+    ]
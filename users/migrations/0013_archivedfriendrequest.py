@@ -0,0 +1,35 @@
+# Generated by Django 4.2.3 on 2026-10-18 20:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0012_outbox_recipient'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedFriendRequest',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('is_accepted', models.BooleanField(default=False)),
+                ('is_cancelled', models.BooleanField(default=False)),
+                ('created_on', models.DateTimeField(blank=True, null=True)),
+                ('modified_on', models.DateTimeField(blank=True, null=True)),
+                ('user_low', models.BigIntegerField()),
+                ('user_high', models.BigIntegerField()),
+                ('reason', models.CharField(max_length=50)),
+                ('archived_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('receiver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', 'user_high'], name='archived_fr_pair_idx')],
+            },
+        ),
+    ]
@@ -1,4 +1,7 @@
+import warnings
 from django.db import models
+from django.db import router
+from django.db import transaction
 from django.db.models import Q
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
@@ -36,25 +39,33 @@ class User(AbstractUser):
     created_on = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     modified_on = models.DateTimeField(auto_now=True, null=True, blank=True)
     login_count = models.IntegerField(editable=False, default=0)
+    # bumped to revoke every signed API token issued before, see users/authentication.py
+    token_version = models.IntegerField(editable=False, default=0)
+    # denormalized from FriendRequest, see users/counters.py
+    friend_count = models.IntegerField(editable=False, default=0)
+    pending_incoming_count = models.IntegerField(editable=False, default=0)
+    pending_outgoing_count = models.IntegerField(editable=False, default=0)
 
     EMAIL_FIELD = 'email'
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
 
+    class Meta(AbstractUser.Meta):
+        swappable = 'AUTH_USER_MODEL'
+        indexes = [
+            # serves the (created_on, id) keyset pagination of the user list
+            models.Index(fields=['created_on', 'id'], name='user_created_id_idx'),
+        ]
 
     def friends_by_requests_sent(self):
-        friend_requests = self.friend_requests_sent.filter(is_accepted=True, is_cancelled=False)
-        friend_users = []
-        for friend_request in friend_requests:
-            friend_users.append(friend_request.receiver)
-        return friend_users
+        warnings.warn('User.friends_by_requests_sent() is deprecated, use friends().', DeprecationWarning,
+                      stacklevel=2)
+        return list(User.objects.filter(friend_of__user=self, friend_of__friend_request__sender=self))
 
     def friends_by_requests_received(self):
-        friend_requests = self.friend_requests_received.filter(is_accepted=True, is_cancelled=False)
-        friend_users = []
-        for friend_request in friend_requests:
-            friend_users.append(friend_request.sender)
-        return friend_users
+        warnings.warn('User.friends_by_requests_received() is deprecated, use friends().', DeprecationWarning,
+                      stacklevel=2)
+        return list(User.objects.filter(friend_of__user=self, friend_of__friend_request__receiver=self))
 
     def active_friend_requests_exist(self):
         sent_exist = self.friend_requests_sent.filter(sender=self, is_accepted=False, is_cancelled=False).exists()
@@ -62,15 +73,30 @@ class User(AbstractUser):
         return sent_exist or received_exist
 
     def friends(self):
-        return self.friends_by_requests_sent() + self.friends_by_requests_received()
+        # served from the Friendship edge table, one indexed join instead of a query per friend
+        return User.objects.filter(friend_of__user=self).order_by('-friend_of__created_on', '-friend_of__id')
 
     def friends_queryset(self):
-        query = Q(sender=self) | Q(receiver=self)
-        return FriendRequest.objects.filter(query)
+        # accepted friend requests involving this user, one row per friendship
+        return FriendRequest.objects.filter(friendships__user=self).order_by('-friendships__created_on')
+
 
 
+class FriendRequestQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create skips save(), the pair key is filled in here instead
+        objs = list(objs)
+        for obj in objs:
+            obj.set_pair()
+        return super().bulk_create(objs, *args, **kwargs)
+
 
 class FriendRequest(models.Model):
+    # states the user counters are kept for, a cancelled request counts for neither
+    STATE_PENDING = 'pending'
+    STATE_FRIENDS = 'friends'
+
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name="friend_requests_sent")
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name="friend_requests_received")
     is_accepted = models.BooleanField(default=False, help_text=_('designates whether this friend request is accepted '
@@ -79,27 +105,227 @@ class FriendRequest(models.Model):
                                                                   'cancelled by sender before being accepted'))
     created_on = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     modified_on = models.DateTimeField(auto_now=True, null=True, blank=True)
+    # the two users ordered by id, whichever of them sent the request, so that one unique index
+    # covers both directions
+    user_low = models.BigIntegerField(editable=False)
+    user_high = models.BigIntegerField(editable=False)
 
+    objects = FriendRequestQuerySet.as_manager()
 
     def clean(self):
         inserting = False if self.pk else True
         if self.sender == self.receiver:
             raise ValidationError("Sender and receiver cannot be the same user.")
 
-        if inserting and FriendRequest.objects.filter(sender=self.sender, receiver=self.receiver).exists():
+        if inserting and FriendRequest.pair_taken(self.sender_id, self.receiver_id):
             raise ValidationError("A friend request between these users already exists.")
 
-        if inserting and FriendRequest.objects.filter(sender=self.receiver, receiver=self.sender).exists():
-            raise ValidationError("A friend request between these users already exists.")
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user_low', 'user_high'],
+                name='unique_friend_request_pair'
+            ),
+        ]
+        indexes = [
+            # serve the pending/accepted friend request lists, newest first, of either side
+            models.Index(fields=['receiver', 'is_accepted', 'created_on'], name='fr_receiver_accepted_idx'),
+            models.Index(fields=['sender', 'is_accepted', 'created_on'], name='fr_sender_accepted_idx'),
+            # the (sender, receiver) unique constraints left for the pair, their indexes stay for the
+            # per-user walks of users/export.py and the lookups of one direction
+            models.Index(fields=['sender', 'receiver'], name='fr_sender_receiver_idx'),
+            models.Index(fields=['receiver', 'sender'], name='fr_receiver_sender_idx'),
+        ]
+
+    @staticmethod
+    def pair_key(first_id, second_id):
+        return (first_id, second_id) if first_id < second_id else (second_id, first_id)
+
+    @classmethod
+    def between(cls, first_id, second_id):
+        user_low, user_high = cls.pair_key(first_id, second_id)
+        return cls.objects.filter(user_low=user_low, user_high=user_high)
+
+    @classmethod
+    def pair_taken(cls, first_id, second_id):
+        # a request between the two users blocks a new one, and so does a cancelled request that was
+        # moved to the archive; an expired pending request does not (see users/archive.py)
+        return (cls.between(first_id, second_id).exists()
+                or ArchivedFriendRequest.between(first_id, second_id).filter(is_cancelled=True).exists())
+
+    def set_pair(self):
+        self.user_low, self.user_high = self.pair_key(self.sender_id, self.receiver_id)
+
+    @property
+    def is_friendship(self):
+        return bool(self.is_accepted) and not self.is_cancelled
+
+    @classmethod
+    def counter_state_of(cls, is_accepted, is_cancelled):
+        if is_cancelled:
+            return None
+        return cls.STATE_FRIENDS if is_accepted else cls.STATE_PENDING
+
+    @property
+    def counter_state(self):
+        return self.counter_state_of(self.is_accepted, self.is_cancelled)
+
+    def save(self, *args, **kwargs):
+        # the user counters are updated by the post_save handler from the state the row had before,
+        # read under a row lock so that concurrent saves of the same request count once each
+        using = kwargs.get('using') or router.db_for_write(FriendRequest, instance=self)
+        self.set_pair()
+        with transaction.atomic(using=using):
+            self.previous_counter_state = None
+            if self.pk is not None and not self._state.adding:
+                previous = (FriendRequest.objects.using(using).select_for_update().filter(pk=self.pk)
+                            .values_list('is_accepted', 'is_cancelled').first())
+                if previous is not None:
+                    self.previous_counter_state = self.counter_state_of(*previous)
+            super().save(*args, **kwargs)
+
+
+class Friendship(models.Model):
+    # Denormalized adjacency table, one row per direction of an accepted friend request.
+    # Kept in sync by the FriendRequest signal handlers in users/signals.py.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="friendships")
+    friend = models.ForeignKey(User, on_delete=models.CASCADE, related_name="friend_of")
+    friend_request = models.ForeignKey(FriendRequest, on_delete=models.CASCADE, related_name="friendships")
+    created_on = models.DateTimeField(default=timezone.now)
 
     class Meta:
         constraints = [
             models.UniqueConstraint(
-                fields=['sender', 'receiver'],
-                name='unique_friend_request'
+                fields=['user', 'friend'],
+                name='unique_friendship'
             ),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'created_on'], name='friendship_user_created_idx'),
+        ]
+
+    @classmethod
+    def edges_for(cls, friend_request):
+        created_on = friend_request.modified_on or timezone.now()
+        return [
+            cls(user_id=friend_request.sender_id, friend_id=friend_request.receiver_id,
+                friend_request_id=friend_request.id, created_on=created_on),
+            cls(user_id=friend_request.receiver_id, friend_id=friend_request.sender_id,
+                friend_request_id=friend_request.id, created_on=created_on),
+        ]
+
+    @classmethod
+    def sync(cls, friend_requests):
+        """Make the edge table agree with the given friend requests, creating or removing both directions."""
+        edges = []
+        stale_ids = []
+        for friend_request in friend_requests:
+            if friend_request.is_friendship:
+                edges.extend(cls.edges_for(friend_request))
+            else:
+                stale_ids.append(friend_request.id)
+        if stale_ids:
+            cls.objects.filter(friend_request_id__in=stale_ids).delete()
+        if edges:
+            cls.objects.bulk_create(edges, ignore_conflicts=True)
+
+
+class ArchivedFriendRequest(models.Model):
+    # Friend request moved out of FriendRequest by a retention rule of the archive_friend_requests
+    # command, under its original id. See users/archive.py.
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    is_accepted = models.BooleanField(default=False)
+    is_cancelled = models.BooleanField(default=False)
+    created_on = models.DateTimeField(null=True, blank=True)
+    modified_on = models.DateTimeField(null=True, blank=True)
+    user_low = models.BigIntegerField()
+    user_high = models.BigIntegerField()
+    # name of the retention rule that archived it
+    reason = models.CharField(max_length=50)
+    archived_on = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # serves the duplicate pair check of new friend requests
+            models.Index(fields=['user_low', 'user_high'], name='archived_fr_pair_idx'),
+        ]
+
+    @classmethod
+    def between(cls, first_id, second_id):
+        user_low, user_high = FriendRequest.pair_key(first_id, second_id)
+        return cls.objects.filter(user_low=user_low, user_high=user_high)
+
+    @classmethod
+    def from_friend_request(cls, friend_request, reason, archived_on):
+        return cls(id=friend_request.id, sender_id=friend_request.sender_id, receiver_id=friend_request.receiver_id,
+                   is_accepted=bool(friend_request.is_accepted), is_cancelled=bool(friend_request.is_cancelled),
+                   created_on=friend_request.created_on, modified_on=friend_request.modified_on,
+                   user_low=friend_request.user_low, user_high=friend_request.user_high,
+                   reason=reason, archived_on=archived_on)
+
+
+class UserSearchGram(models.Model):
+    # Inverted n-gram index over email, first_name and last_name, maintained by users.search.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="search_grams")
+    gram = models.CharField(max_length=3)
+
+    class Meta:
+        constraints = [
             models.UniqueConstraint(
-                fields=['receiver', 'sender'],
-                name='unique_friend_request_reverse'
-            )
+                fields=['gram', 'user'],
+                name='unique_user_search_gram'
+            ),
         ]
+
+
+class ThrottleBucket(models.Model):
+    # GCRA state for one throttle key: the theoretical arrival time (epoch seconds) of the next request.
+    key = models.CharField(max_length=255, unique=True)
+    tat = models.FloatField()
+
+
+class OutboxEvent(models.Model):
+    # Append-only log of friend request changes, written in the transaction of the change and
+    # drained by the outbox_worker command, see users/outbox.py.
+    topic = models.CharField(max_length=50)
+    event_type = models.CharField(max_length=50)
+    aggregate_id = models.BigIntegerField()
+    # user the event is pushed to by the friend request event stream (users/events.py)
+    recipient_id = models.BigIntegerField(null=True, blank=True)
+    payload = models.JSONField()
+    created_on = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # serves the replay of a user's events after Last-Event-ID
+            models.Index(fields=['recipient_id', 'id'], name='outbox_recipient_id_idx'),
+        ]
+
+
+class OutboxConsumer(models.Model):
+    # Position of one outbox consumer: the id of the last event it handled, the ids below it it has
+    # not seen yet (id -> timestamp it first missed them), the worker holding the current batch, and
+    # the retry state of that batch.
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    gaps = models.JSONField(default=dict, blank=True)
+    claimed_by = models.CharField(max_length=32, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    retry_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    modified_on = models.DateTimeField(auto_now=True)
+
+
+class OutboxDeadLetter(models.Model):
+    # Event a consumer gave up on after USERS_OUTBOX_MAX_ATTEMPTS, a copy that outlives the pruning
+    # of the outbox.
+    consumer = models.CharField(max_length=100)
+    event_id = models.BigIntegerField()
+    topic = models.CharField(max_length=50)
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField()
+    error = models.TextField()
+    created_on = models.DateTimeField(default=timezone.now)
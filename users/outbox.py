@@ -0,0 +1,234 @@
+import logging
+import traceback
+from datetime import timedelta
+from uuid import uuid4
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import FriendRequest
+from .models import OutboxConsumer
+from .models import OutboxDeadLetter
+from .models import OutboxEvent
+
+# Transactional outbox. Every friend request change appends an OutboxEvent in the transaction of
+# the change (see the FriendRequest signal handlers in users/signals.py), so an event exists if and
+# only if the change was committed. The outbox_worker command hands the events, in id order and in
+# batches, to every consumer in USERS_OUTBOX_CONSUMERS and keeps each consumer's position in
+# OutboxConsumer. Delivery is at least once: a batch that fails is retried with backoff, after
+# USERS_OUTBOX_MAX_ATTEMPTS its events are handled one by one and the ones still failing are moved
+# to OutboxDeadLetter. Ids are allocated at insert but committed in any order, so an id below the
+# position can still show up: the ids a consumer moved past without seeing are kept as its gaps and
+# delivered when they commit, until USERS_OUTBOX_GAP_SECONDS tell they were rolled back. Handlers
+# run outside the consumer row lock, a claim of USERS_OUTBOX_CLAIM_SECONDS keeps the other workers
+# of the consumer off the batch meanwhile.
+TOPIC_FRIEND_REQUEST = 'friend_request'
+
+EVENT_CREATED = 'created'
+EVENT_ACCEPTED = 'accepted'
+EVENT_REJECTED = 'rejected'
+EVENT_CANCELLED = 'cancelled'
+EVENT_REOPENED = 'reopened'
+EVENT_DELETED = 'deleted'
+EVENT_ARCHIVED = 'archived'
+
+# ids a consumer keeps waiting for at most, the highest ones; ids allocated with a step above one
+# would otherwise grow the gaps without bound
+MAX_GAPS = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def settle_seconds():
+    # how long after it was written an event can still commit, as far as the event streams care
+    return getattr(settings, 'USERS_OUTBOX_SETTLE_SECONDS', 5)
+
+
+def gap_seconds():
+    return getattr(settings, 'USERS_OUTBOX_GAP_SECONDS', 3600)
+
+
+def claim_seconds():
+    return getattr(settings, 'USERS_OUTBOX_CLAIM_SECONDS', 300)
+
+
+def max_attempts():
+    return getattr(settings, 'USERS_OUTBOX_MAX_ATTEMPTS', 5)
+
+
+def retention():
+    return timedelta(days=getattr(settings, 'USERS_OUTBOX_RETENTION_DAYS', 7))
+
+
+def change_event_type(previous, current):
+    # event for a friend request that went from one counter state to another, None if it did not move
+    if previous == current:
+        return None
+    if current is None:
+        return EVENT_CANCELLED
+    if current == FriendRequest.STATE_FRIENDS:
+        return EVENT_ACCEPTED
+    return EVENT_REJECTED if previous == FriendRequest.STATE_FRIENDS else EVENT_REOPENED
+
+
+def state_event_type(friend_request):
+    # event for a friend request written in bulk, whose previous state is not known
+    return {
+        FriendRequest.STATE_PENDING: EVENT_CREATED,
+        FriendRequest.STATE_FRIENDS: EVENT_ACCEPTED,
+        None: EVENT_CANCELLED,
+    }[friend_request.counter_state]
+
+
+def friend_request_event(friend_request, event_type):
+    return OutboxEvent(
+        topic=TOPIC_FRIEND_REQUEST,
+        event_type=event_type,
+        aggregate_id=friend_request.id,
+        recipient_id=friend_request.receiver_id,
+        payload={
+            'id': friend_request.id,
+            'sender_id': friend_request.sender_id,
+            'receiver_id': friend_request.receiver_id,
+            'is_accepted': bool(friend_request.is_accepted),
+            'is_cancelled': bool(friend_request.is_cancelled),
+        },
+    )
+
+
+def publish(events):
+    # has to run in the transaction of the change the events describe
+    if events:
+        OutboxEvent.objects.bulk_create(events)
+
+
+def get_consumers():
+    consumers = getattr(settings, 'USERS_OUTBOX_CONSUMERS', {})
+    return {name: import_string(path) for name, path in consumers.items()}
+
+
+def log_events(events):
+    # example consumer, replace or extend it with notifications, analytics, cache warming...
+    for event in events:
+        logger.info('%s %s %s %s', event.id, event.topic, event.event_type, event.payload)
+
+
+def drain(name, handler, batch_size=100):
+    """Hand the next batch of events to one consumer, returns the number of events handled."""
+    claimed = claim(name, batch_size)
+    if claimed is None:
+        return 0
+    consumer, events = claimed
+    # outside the consumer row lock, a slow handler does not hold it
+    error = deliver(handler, events)
+    dead_letters = []
+    if error is not None and consumer.attempts + 1 >= max_attempts():
+        dead_letters = dead_letter_failures(name, handler, events)
+    return release(consumer, events, error, dead_letters)
+
+
+def claim(name, batch_size):
+    # (consumer, events) of the next batch, claimed for this worker, None if there is nothing to do
+    with transaction.atomic():
+        # the row lock keeps a second worker of the same consumer from claiming the batch too
+        consumer, _ = OutboxConsumer.objects.select_for_update().get_or_create(name=name)
+        now = timezone.now()
+        if consumer.retry_at and consumer.retry_at > now:
+            return None
+        if consumer.claimed_until and consumer.claimed_until > now:
+            return None
+        pending = Q(id__gt=consumer.position) | Q(id__in=[int(event_id) for event_id in consumer.gaps])
+        events = list(OutboxEvent.objects.filter(pending).order_by('id')[:batch_size])
+        if not events:
+            return None
+        consumer.claimed_by = uuid4().hex
+        consumer.claimed_until = now + timedelta(seconds=claim_seconds())
+        consumer.save()
+        return consumer, events
+
+
+def release(consumer, events, error, dead_letters):
+    with transaction.atomic():
+        current = OutboxConsumer.objects.select_for_update().get(id=consumer.id)
+        if current.claimed_by != consumer.claimed_by:
+            # the claim ran out and another worker took the batch over, it records the outcome
+            return 0
+        now = timezone.now()
+        current.claimed_by = ''
+        current.claimed_until = None
+        if error is not None:
+            current.attempts += 1
+            current.last_error = error
+            if current.attempts < max_attempts():
+                current.retry_at = now + timedelta(seconds=min(2 ** current.attempts, 300))
+                current.save()
+                return 0
+            OutboxDeadLetter.objects.bulk_create(dead_letters)
+        advance(current, [event.id for event in events], now)
+        current.attempts = 0
+        current.retry_at = None
+        current.last_error = ''
+        current.save()
+        return len(events)
+
+
+def advance(consumer, event_ids, now):
+    # moves the position past the delivered ids and keeps the ids skipped on the way as gaps, a
+    # consumer that starts from scratch has none below its first event
+    delivered = set(event_ids)
+    gaps = {int(event_id): seen for event_id, seen in consumer.gaps.items() if int(event_id) not in delivered}
+    top = max(delivered)
+    if top > consumer.position:
+        low = consumer.position + 1 if consumer.position else min(delivered)
+        skipped = set(range(low, top)) - delivered
+        gaps.update(dict.fromkeys(skipped, now.timestamp()))
+        consumer.position = top
+    expired = now.timestamp() - gap_seconds()
+    kept = sorted(event_id for event_id, seen in gaps.items() if seen > expired)[-MAX_GAPS:]
+    consumer.gaps = {str(event_id): gaps[event_id] for event_id in kept}
+
+
+def deliver(handler, events):
+    # the traceback of a failed delivery, None on success; the transaction undoes what the handler
+    # wrote to the database before failing. It commits apart from the consumer position, a worker
+    # dying in between has the batch delivered again.
+    try:
+        with transaction.atomic():
+            handler(events)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def dead_letter_failures(name, handler, events):
+    # the events of the batch that still fail on their own, saved when the batch is released
+    dead_letters = []
+    for event in events:
+        error = deliver(handler, [event])
+        if error is not None:
+            logger.error('Outbox consumer %s gave up on event %s:\n%s', name, event.id, error)
+            dead_letters.append(OutboxDeadLetter(consumer=name, event_id=event.id, topic=event.topic,
+                                                 event_type=event.event_type, payload=event.payload, error=error))
+    return dead_letters
+
+
+def prune(batch_size=1000):
+    """Delete the events every consumer is past and that are older than the retention, returns how many."""
+    names = list(getattr(settings, 'USERS_OUTBOX_CONSUMERS', {}))
+    positions = OutboxConsumer.objects.filter(name__in=names)
+    if positions.count() < len(names):
+        # a consumer that never ran yet still has every event ahead of it
+        return 0
+    position = positions.aggregate(position=Min('position'))['position'] or 0
+    # an id some consumer still waits for may commit late, after its created_on fell out of retention
+    waited_for = {int(event_id) for gaps in positions.values_list('gaps', flat=True) for event_id in gaps}
+    expired = (OutboxEvent.objects.filter(id__lte=position, created_on__lt=timezone.now() - retention())
+               .exclude(id__in=waited_for))
+    removed = 0
+    while True:
+        ids = list(expired.order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return removed
+        removed += OutboxEvent.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,183 @@
+import json
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from django.conf import settings
+from django.core.paginator import InvalidPage
+from django.core.paginator import Page
+from django.db.models import F
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param
+from rest_framework.utils.urls import replace_query_param
+
+
+def max_page_size():
+    return getattr(settings, 'USERS_MAX_PAGE_SIZE', 100)
+
+
+def clamp_page_size(value, default=None):
+    if default is None:
+        default = settings.REST_FRAMEWORK.get('PAGE_SIZE', 10)
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        page_size = default
+    if page_size < 1:
+        page_size = default
+    return min(page_size, max_page_size())
+
+
+def wants_cursor_pagination(request):
+    params = request.query_params
+    return params.get('paginate', '').strip().lower() == 'cursor' or KeysetPagination.cursor_query_param in params
+
+
+class ClampedPageNumberPagination(PageNumberPagination):
+    page_size_query_param = 'page_size'
+
+    @property
+    def max_page_size(self):
+        return max_page_size()
+
+    def get_page_size(self, request):
+        return clamp_page_size(request.query_params.get(self.page_size_query_param), self.page_size)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        # same pages and links as paginate_queryset, with the count and the page read through the async ORM
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        paginator = self.django_paginator_class(queryset, page_size)
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            number = paginator.validate_number(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        bottom = (number - 1) * page_size
+        rows = [row async for row in queryset[bottom:bottom + page_size]]
+        self.page = Page(rows, number, paginator)
+        if paginator.num_pages > 1 and self.template is not None:
+            self.display_page_controls = True
+        self.request = request
+        return rows
+
+
+class KeysetPagination(BasePagination):
+    # Keyset pagination on (created_on, id), newest first. Every page is a single indexed range
+    # query of page_size + 1 rows, there is no COUNT(*) and no OFFSET, so page 10,000 costs the
+    # same as page 1. Rows with a NULL created_on (legacy data) sort after all dated rows.
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        return self.set_page([row async for row in self.page_queryset(queryset, request)])
+
+    def page_queryset(self, queryset, request):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = clamp_page_size(request.query_params.get(self.page_size_query_param))
+        position = self.position = self.decode_cursor(request)
+        self.reverse = bool(position and position['r'])
+
+        if position is not None:
+            queryset = queryset.filter(self.position_filter(position['c'], position['i'], self.reverse))
+        queryset = queryset.order_by(*self.ordering(self.reverse))
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, rows):
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.reverse:
+            rows.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = self.position is not None
+        self.page = rows
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_link(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_link(self.page[0], reverse=True)
+
+    @staticmethod
+    def ordering(reverse):
+        if reverse:
+            return [F('created_on').asc(nulls_first=True), 'id']
+        return [F('created_on').desc(nulls_last=True), '-id']
+
+    @staticmethod
+    def position_filter(created_on, pk, reverse):
+        if reverse:
+            if created_on is None:
+                return Q(created_on__isnull=True, id__gt=pk) | Q(created_on__isnull=False)
+            return Q(created_on__gt=created_on) | Q(created_on=created_on, id__gt=pk)
+        if created_on is None:
+            return Q(created_on__isnull=True, id__lt=pk)
+        return Q(created_on__lt=created_on) | Q(created_on=created_on, id__lt=pk) | Q(created_on__isnull=True)
+
+    def encode_link(self, row, reverse):
+        created_on = row['created_on'] if isinstance(row, dict) else row.created_on
+        pk = row['id'] if isinstance(row, dict) else row.pk
+        position = {
+            'c': created_on.isoformat() if created_on else None,
+            'i': pk,
+            'r': 1 if reverse else 0,
+        }
+        encoded = urlsafe_b64encode(json.dumps(position, separators=(',', ':')).encode('ascii')).decode('ascii')
+        url = remove_query_param(self.base_url, 'paginate')
+        return replace_query_param(url, self.cursor_query_param, encoded.rstrip('='))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            position = json.loads(urlsafe_b64decode(padded.encode('ascii')))
+            created_on = position['c']
+            position['c'] = parse_datetime(created_on) if created_on else None
+            position['i'] = int(position['i'])
+            position['r'] = bool(position.get('r'))
+            if created_on and position['c'] is None:
+                raise ValueError(created_on)
+            # a tampered id past the range of the column would fail in the database instead
+            if not 0 <= position['i'] < 2 ** 63:
+                raise ValueError(position['i'])
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise ValidationError({self.cursor_query_param: [self.invalid_cursor_message]})
+        return position
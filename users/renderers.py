@@ -0,0 +1,50 @@
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON renderer and parser of the production settings profile (socialapp/settings/prod.py). With
+# orjson installed, responses are encoded in one pass straight to bytes: the OrderedDicts and lists
+# built by the row serializers and get_paginated_response are walked as they are, without the
+# intermediate str of json.dumps, and request bodies are decoded from bytes the same way. Output is
+# the same as DRF's JSONRenderer with the default settings; without orjson both fall back to DRF.
+
+if orjson is not None:
+    # datetimes and every type orjson does not know go through the DRF encoder, so that they are
+    # formatted the way JSONRenderer formats them; non-str keys become str as with json.dumps
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    _encoder = JSONEncoder()
+
+
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # indented output and the non default UNICODE_JSON/COMPACT_JSON settings are left to DRF
+        if (orjson is None or self.ensure_ascii or not self.compact
+                or self.get_indent(accepted_media_type, renderer_context or {})):
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        ret = orjson.dumps(data, default=_encoder.default, option=ORJSON_OPTIONS)
+        # same escaping as JSONRenderer, the two separators are valid JSON but not valid JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class FastJSONParser(JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        # orjson reads UTF-8 only and rejects NaN and Infinity, as STRICT_JSON does
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or not self.strict or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
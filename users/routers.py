@@ -0,0 +1,82 @@
+import random
+import time
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+
+# Routing state of the request (or management command) being run: whether it has written to the
+# users app, and until when its reads have to stay on the primary. Set by ReplicaPinMiddleware.
+routing_state = ContextVar('routing_state', default=None)
+
+
+class RoutingState:
+
+    def __init__(self, pinned_until=0.0):
+        self.pinned_until = pinned_until
+        self.wrote = False
+
+    @property
+    def pinned(self):
+        return self.wrote or self.pinned_until > time.time()
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def pin_seconds():
+    return getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10)
+
+
+def reads_pinned():
+    state = routing_state.get()
+    return state is not None and state.pinned
+
+
+def record_write():
+    state = routing_state.get()
+    if state is None:
+        # outside of a request (shell, management commands), pinned for the rest of the context
+        state = RoutingState()
+        routing_state.set(state)
+    state.wrote = True
+
+
+class ReplicaRouter:
+    # Reads of the users app go to a random replica from DATABASE_REPLICAS, writes go to the
+    # primary. Reads stay on the primary inside a transaction on it, after a write in the same
+    # request, and for DATABASE_REPLICA_PIN_SECONDS after a write by the same client or user
+    # (read-your-writes, see ReplicaPinMiddleware). Other apps always use the default database.
+    app_labels = {'users'}
+    # bookkeeping tables that are read to be written: always on the primary, and writing them
+    # does not pin the client
+    primary_models = {'users.throttlebucket', 'users.outboxevent', 'users.outboxconsumer', 'users.outboxdeadletter'}
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label not in self.app_labels:
+            return None
+        pool = replicas()
+        if (not pool or model._meta.label_lower in self.primary_models or reads_pinned()
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+        return random.choice(pool)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label not in self.app_labels:
+            return None
+        if model._meta.label_lower not in self.primary_models:
+            record_write()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema through replication
+        if db in replicas():
+            return False
+        return None
@@ -0,0 +1,129 @@
+from functools import lru_cache
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from .models import User
+from .models import UserSearchGram
+
+SEARCH_FIELDS = ('email', 'first_name', 'last_name')
+
+
+class SimpleSearchBackend:
+    # README semantics: an exact email match wins, otherwise substring match on email and names.
+
+    def search(self, queryset, query):
+        query = query.strip().lower()
+        if not query:
+            return queryset
+        exact_ids = list(queryset.filter(email__iexact=query).values_list('id', flat=True)[:1])
+        if exact_ids:
+            return queryset.filter(id__in=exact_ids)
+        return self.substring_search(queryset, query)
+
+    async def asearch(self, queryset, query):
+        # search() for the async views, only the exact email probe touches the database here
+        query = query.strip().lower()
+        if not query:
+            return queryset
+        exact_ids = [pk async for pk in queryset.filter(email__iexact=query).values_list('id', flat=True)[:1]]
+        if exact_ids:
+            return queryset.filter(id__in=exact_ids)
+        return self.substring_search(queryset, query)
+
+    def substring_search(self, queryset, query):
+        return queryset.filter(self.substring_filter(query))
+
+    @staticmethod
+    def substring_filter(query):
+        db_search_query = Q()
+        for field in SEARCH_FIELDS:
+            db_search_query |= Q(**{f'{field}__icontains': query})
+        return db_search_query
+
+    def index_users(self, users):
+        pass
+
+    def rebuild(self, batch_size=1000, progress=None):
+        return 0
+
+
+class NgramSearchBackend(SimpleSearchBackend):
+    # Substring lookups are answered from the UserSearchGram inverted index: every bigram and
+    # trigram of the searchable fields is stored per user, a query selects the users holding all
+    # of its grams, and only those candidates are re-checked with icontains to drop false positives
+    # (grams present but not adjacent). Single character queries fall back to the plain filter.
+    gram_sizes = (2, 3)
+
+    @classmethod
+    def grams_for_text(cls, text, sizes=None):
+        text = (text or '').lower()
+        grams = set()
+        for size in sizes or cls.gram_sizes:
+            for start in range(len(text) - size + 1):
+                grams.add(text[start:start + size])
+        return grams
+
+    @classmethod
+    def grams_for_user(cls, user):
+        grams = set()
+        for field in SEARCH_FIELDS:
+            grams |= cls.grams_for_text(getattr(user, field))
+        return grams
+
+    @classmethod
+    def grams_for_query(cls, query):
+        size = max(cls.gram_sizes)
+        if len(query) >= size:
+            return cls.grams_for_text(query, sizes=(size,))
+        return {query} if len(query) in cls.gram_sizes else set()
+
+    def substring_search(self, queryset, query):
+        grams = self.grams_for_query(query)
+        if not grams:
+            return super().substring_search(queryset, query)
+        candidates = (UserSearchGram.objects.filter(gram__in=grams)
+                      .values('user_id')
+                      .annotate(matched=Count('id'))
+                      .filter(matched=len(grams))
+                      .values('user_id'))
+        return queryset.filter(id__in=candidates).filter(self.substring_filter(query))
+
+    def index_users(self, users):
+        users = list(users)
+        if not users:
+            return
+        rows = [UserSearchGram(user_id=user.id, gram=gram) for user in users for gram in self.grams_for_user(user)]
+        with transaction.atomic():
+            UserSearchGram.objects.filter(user_id__in=[user.id for user in users]).delete()
+            UserSearchGram.objects.bulk_create(rows, batch_size=5000, ignore_conflicts=True)
+
+    def rebuild(self, batch_size=1000, progress=None):
+        users = User.objects.only('id', *SEARCH_FIELDS).order_by('id')
+        last_id = 0
+        total = 0
+        while True:
+            batch = list(users.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            self.index_users(batch)
+            last_id = batch[-1].id
+            total += len(batch)
+            if progress:
+                progress(total)
+        return total
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    path = getattr(settings, 'USERS_SEARCH_BACKEND', 'users.search.NgramSearchBackend')
+    return import_string(path)()
+
+
+@receiver(setting_changed)
+def reset_search_backend(setting, **kwargs):
+    if setting == 'USERS_SEARCH_BACKEND':
+        get_search_backend.cache_clear()
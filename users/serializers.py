@@ -1,6 +1,12 @@
+from abc import ABC
+from abc import abstractmethod
+from collections import OrderedDict
+from django.conf import settings
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 from .models import User
 from .models import FriendRequest
+from .authentication import revoke_tokens
 from django.contrib.auth import authenticate
 from django.contrib.auth import login
 
@@ -8,7 +14,8 @@ from django.contrib.auth import login
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ['url', 'email', 'first_name', 'last_name', 'password']
+        fields = ['url', 'email', 'first_name', 'last_name', 'password',
+                  'friend_count', 'pending_incoming_count', 'pending_outgoing_count']
         extra_kwargs = {'password': {'write_only': True}}
 
     def create(self, validated_data):
@@ -21,13 +28,16 @@ class UserSerializer(serializers.ModelSerializer):
         return user
 
     def update(self, instance, validated_data):
-        if 'password' in validated_data:
+        password_changed = 'password' in validated_data
+        if password_changed:
             password = validated_data.pop('password')
             instance.set_password(password)
 
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
         instance.save()
+        if password_changed:
+            revoke_tokens(instance)
         return instance
 
     def partial_update(self, instance, validated_data):
@@ -58,7 +68,7 @@ class FriendRequestSerializer(serializers.ModelSerializer):
     sender = serializers.SerializerMethodField(method_name='get_sender')
 
     def get_sender(self, obj):
-        return obj.sender.id
+        return obj.sender_id
 
     class Meta:
         model = FriendRequest
@@ -76,15 +86,10 @@ class FriendRequestSerializer(serializers.ModelSerializer):
         if not put_or_patch and sender == receiver:
             raise serializers.ValidationError("Sender and receiver cannot be the same user.")
 
-        # Enforce bidirectional uniqueness for friend requests
-        if not put_or_patch:
-            sender_friend_request_exists = FriendRequest.objects.filter(sender=sender, receiver=receiver).exists()
-            receiver_friend_request_exists = FriendRequest.objects.filter(sender=receiver, receiver=sender).exists()
-            if sender_friend_request_exists or receiver_friend_request_exists:
-                raise serializers.ValidationError("A friend request between these users already exists.")
-        # Ensure a user cannot send a friend request to themselves
-        if FriendRequest.objects.filter(sender=sender, receiver=sender).exists():
-            raise serializers.ValidationError("A user cannot send a friend request to themselves.")
+        # Enforce bidirectional uniqueness for friend requests, lookups on the canonical pair in the
+        # friend request table and its archive (a request to oneself is already rejected above)
+        if not put_or_patch and FriendRequest.pair_taken(sender.id, receiver.id):
+            raise serializers.ValidationError("A friend request between these users already exists.")
 
         # Ensure is_accepted and is_cancelled fields are not set to True simultaneously
         is_accepted = data.get('is_accepted')
@@ -93,3 +98,90 @@ class FriendRequestSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("A friend request cannot be both accepted and cancelled.")
 
         return data
+
+
+class FriendRequestBulkSerializer(serializers.Serializer):
+    ACTIONS = ('create', 'accept', 'reject')
+
+    action = serializers.ChoiceField(choices=ACTIONS)
+
+    def get_fields(self):
+        # the item limit is read per request so FRIEND_REQUEST_BULK_MAX can be changed in settings
+        fields = super().get_fields()
+        max_items = getattr(settings, 'FRIEND_REQUEST_BULK_MAX', 50)
+        for name in ('receivers', 'requests'):
+            fields[name] = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False,
+                                                 allow_empty=False, max_length=max_items)
+        return fields
+
+    def validate(self, data):
+        ids_field = 'receivers' if data['action'] == 'create' else 'requests'
+        if not data.get(ids_field):
+            raise serializers.ValidationError({ids_field: f"This field is required for the {data['action']} action."})
+        # keep the first occurrence of every id, in the order given
+        data['ids'] = list(dict.fromkeys(data[ids_field]))
+        return data
+
+
+class RowListSerializer(ABC):
+    # Read-only list serialization for values() rows. Produces the same JSON as the model serializer
+    # it mirrors, but touches no model instances and builds hyperlinks from a URL template resolved
+    # once per request instead of calling reverse() for every row.
+    values_fields = ()
+    placeholder_pk = 987654321987654321
+
+    def __init__(self, rows, context):
+        self.rows = rows
+        self.context = context
+
+    def url_template(self, view_name):
+        url = reverse(view_name, kwargs={'pk': self.placeholder_pk}, request=self.context.get('request'))
+        prefix, suffix = url.split(str(self.placeholder_pk))
+        return lambda pk: f'{prefix}{pk}{suffix}'
+
+    @abstractmethod
+    def to_representation(self, row, urls):
+        pass
+
+    def get_urls(self):
+        return {}
+
+    @property
+    def data(self):
+        urls = self.get_urls()
+        return [self.to_representation(row, urls) for row in self.rows]
+
+
+class UserRowSerializer(RowListSerializer):
+    values_fields = ('id', 'created_on', 'email', 'first_name', 'last_name',
+                     'friend_count', 'pending_incoming_count', 'pending_outgoing_count')
+
+    def get_urls(self):
+        return {'user': self.url_template('user-detail')}
+
+    def to_representation(self, row, urls):
+        return OrderedDict((
+            ('url', urls['user'](row['id'])),
+            ('email', row['email']),
+            ('first_name', row['first_name']),
+            ('last_name', row['last_name']),
+            ('friend_count', row['friend_count']),
+            ('pending_incoming_count', row['pending_incoming_count']),
+            ('pending_outgoing_count', row['pending_outgoing_count']),
+        ))
+
+
+class FriendRequestRowSerializer(RowListSerializer):
+    values_fields = ('id', 'created_on', 'sender_id', 'receiver_id', 'is_cancelled', 'is_accepted')
+
+    def get_urls(self):
+        return {'friend_request': self.url_template('friendrequest-detail')}
+
+    def to_representation(self, row, urls):
+        return OrderedDict((
+            ('url', urls['friend_request'](row['id'])),
+            ('sender', row['sender_id']),
+            ('receiver', row['receiver_id']),
+            ('is_cancelled', bool(row['is_cancelled'])),
+            ('is_accepted', bool(row['is_accepted'])),
+        ))
@@ -0,0 +1,154 @@
+from contextvars import ContextVar
+from functools import partial
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import Signal
+from django.dispatch import receiver
+from .models import User
+from .models import FriendRequest
+from .models import Friendship
+from .authentication import revoke_tokens
+from .cache import invalidate
+from .counters import apply_state_change
+from .counters import recount
+from .graph import apply_friendship_change
+from .outbox import EVENT_ARCHIVED
+from .outbox import EVENT_CREATED
+from .outbox import EVENT_DELETED
+from .outbox import change_event_type
+from .outbox import friend_request_event
+from .outbox import publish
+from .outbox import state_event_type
+from .events import wake_hubs
+from .search import SEARCH_FIELDS
+from .search import get_search_backend
+
+# fields of a user that show up in other users' cached friend lists
+PUBLIC_FIELDS = ('email', 'first_name', 'last_name')
+
+# Sent with friend_requests=[...] after bulk_create/bulk_update writes, which bypass post_save,
+# and optionally event=<outbox event type> when the state alone does not tell what happened.
+friend_requests_bulk_changed = Signal()
+# Sent with friend_requests=[...] after the archive moved them out of FriendRequest. The delete runs
+# with archiving set, which turns off the per row post_delete handlers the batch handler stands in for.
+friend_requests_archived = Signal()
+archiving = ContextVar('archiving', default=False)
+
+
+@receiver(post_save, sender=FriendRequest)
+def sync_friendship_edges(sender, instance, **kwargs):
+    Friendship.sync([instance])
+    transaction.on_commit(partial(apply_friendship_change, instance.sender_id, instance.receiver_id,
+                                  instance.is_friendship))
+
+
+@receiver(post_delete, sender=FriendRequest)
+def drop_friendship_from_graph(sender, instance, **kwargs):
+    # the Friendship rows themselves go away through the cascade
+    transaction.on_commit(partial(apply_friendship_change, instance.sender_id, instance.receiver_id, False))
+
+
+@receiver(post_save, sender=FriendRequest)
+def count_friend_request_change(sender, instance, created=False, raw=False, **kwargs):
+    # raw saves (loaddata) bypass FriendRequest.save, reconcile_counters repairs them
+    if raw:
+        return
+    previous = None if created else instance.previous_counter_state
+    apply_state_change(instance.sender_id, instance.receiver_id, previous, instance.counter_state)
+
+
+@receiver(post_delete, sender=FriendRequest)
+def uncount_deleted_friend_request(sender, instance, **kwargs):
+    if archiving.get():
+        return
+    apply_state_change(instance.sender_id, instance.receiver_id, instance.counter_state, None)
+
+
+def publish_events(events):
+    publish(events)
+    # the event streams of this process get them right after the commit, not at their next poll
+    transaction.on_commit(wake_hubs)
+
+
+@receiver(post_save, sender=FriendRequest)
+def publish_friend_request_change(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    event_type = EVENT_CREATED if created else change_event_type(instance.previous_counter_state,
+                                                                  instance.counter_state)
+    if event_type:
+        publish_events([friend_request_event(instance, event_type)])
+
+
+@receiver(post_delete, sender=FriendRequest)
+def publish_friend_request_deletion(sender, instance, **kwargs):
+    if archiving.get():
+        return
+    publish_events([friend_request_event(instance, EVENT_DELETED)])
+
+
+@receiver(post_save, sender=User)
+def index_user_for_search(sender, instance, update_fields=None, **kwargs):
+    # saves such as the last_login update on login do not touch searchable fields
+    if update_fields is not None and not set(update_fields) & set(SEARCH_FIELDS):
+        return
+    get_search_backend().index_users([instance])
+
+
+@receiver(post_save, sender=FriendRequest)
+@receiver(post_delete, sender=FriendRequest)
+def invalidate_friend_request_parties(sender, instance, **kwargs):
+    if archiving.get():
+        return
+    transaction.on_commit(partial(invalidate, instance.sender_id, instance.receiver_id))
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_and_friends(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields) & set(PUBLIC_FIELDS):
+        return
+    friend_ids = list(Friendship.objects.filter(user=instance).values_list('friend_id', flat=True))
+    transaction.on_commit(partial(invalidate, instance.id, *friend_ids))
+
+
+@receiver(post_save, sender=User)
+def revoke_tokens_of_inactive_user(sender, instance, created=False, update_fields=None, **kwargs):
+    # tokens carry the is_active flag, deactivating a user has to revoke the ones already issued
+    if created or instance.is_active:
+        return
+    if update_fields is not None and 'is_active' not in update_fields:
+        return
+    revoke_tokens(instance)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    # friends are invalidated by the cascaded FriendRequest deletes
+    transaction.on_commit(partial(invalidate, instance.id))
+
+
+@receiver(friend_requests_bulk_changed)
+def sync_bulk_friend_requests(sender, friend_requests, event=None, **kwargs):
+    Friendship.sync(friend_requests)
+    publish_events([friend_request_event(friend_request, event or state_event_type(friend_request))
+                    for friend_request in friend_requests])
+    party_ids = []
+    for friend_request in friend_requests:
+        transaction.on_commit(partial(apply_friendship_change, friend_request.sender_id,
+                                      friend_request.receiver_id, friend_request.is_friendship))
+        party_ids += [friend_request.sender_id, friend_request.receiver_id]
+    recount(party_ids)
+    transaction.on_commit(partial(invalidate, *party_ids))
+
+
+@receiver(friend_requests_archived)
+def sync_archived_friend_requests(sender, friend_requests, **kwargs):
+    # an expired pending request leaves the pending counters of both sides; a cancelled one can still
+    # have had friendship edges, removed by the cascade (drop_friendship_from_graph keeps running)
+    publish_events([friend_request_event(friend_request, EVENT_ARCHIVED) for friend_request in friend_requests])
+    party_ids = []
+    for friend_request in friend_requests:
+        party_ids += [friend_request.sender_id, friend_request.receiver_id]
+    recount(party_ids)
+    transaction.on_commit(partial(invalidate, *party_ids))
@@ -1,3 +1,1802 @@
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO
+from io import StringIO
+from contextlib import ExitStack
+from contextvars import copy_context
+from types import SimpleNamespace
+from base64 import urlsafe_b64encode
+from asgiref.sync import async_to_sync
+from asgiref.sync import sync_to_async
+from unittest import mock
+from unittest import skipUnless
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import connections
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.utils import ConnectionHandler
+from django.db.utils import DatabaseError
+from django.db.migrations.executor import MigrationExecutor
+from django.test import Client
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.test.client import RequestFactory
+from django.urls import include
+from django.urls import path
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from socialapp.db.pool import ConnectionPool
+from socialapp.db.pool import PoolTimeout
+from socialapp.db.pool import get_pool
+from socialapp.db.pool import pool_stats
+from socialapp.startup import STARTUP_BUDGET
+from socialapp.startup import measure
+from .models import User
+from .models import FriendRequest
+from .models import ArchivedFriendRequest
+from .models import Friendship
+from .models import ThrottleBucket
+from .models import OutboxConsumer
+from .models import OutboxEvent
+from .models import OutboxDeadLetter
+from .models import UserSearchGram
+from .outbox import claim
+from .outbox import drain
+from .outbox import friend_request_event
+from .outbox import release
+from .export import export_chunks
+from .async_views import AsyncReadAPIView
+from .authentication import TOKEN_SALT
+from .events import get_hub
+from .cache import cache_stats
+from .metrics import registry
+from .cache import get_version
+from .cache import invalidate
+from .cache import reset_cache_stats
+from .counters import COUNTER_FIELDS
+from .counters import actual_counts
+from .counters import recount
+from .search import NgramSearchBackend
+from .search import SimpleSearchBackend
+from .throttler import FriendRequestThrottle
+from .urls import build_urlpatterns
+from .middleware import ReplicaPinMiddleware
+from .search import get_search_backend
+from .management.commands.generate_social_graph import DEFAULT_PASSWORD
+from .management.commands.import_users import Command as ImportUsersCommand
+from .routers import ReplicaRouter
+from .routers import RoutingState
+from .routers import routing_state
+from .serializers import UserSerializer
+from .serializers import UserRowSerializer
+from .serializers import FriendRequestSerializer
+from .serializers import FriendRequestRowSerializer
+from .renderers import FastJSONParser
+from .renderers import FastJSONRenderer
 
-# Create your tests here.
+
+class FriendshipSyncTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='edges@example.com', username='edges', is_active=True)
+        cls.others = [User.objects.create(email=f'edge{i}@example.com', username=f'edge{i}', is_active=True)
+                      for i in range(4)]
+
+    def edges(self):
+        return set(Friendship.objects.values_list('user_id', 'friend_id', 'friend_request_id'))
+
+    def expected_edges(self):
+        accepted = FriendRequest.objects.filter(is_accepted=True, is_cancelled=False)
+        return ({(request.sender_id, request.receiver_id, request.id) for request in accepted}
+                | {(request.receiver_id, request.sender_id, request.id) for request in accepted})
+
+    def test_single_saves_and_deletes_keep_both_directions(self):
+        first, second = self.others[:2]
+        accepted = FriendRequest.objects.create(sender=self.user, receiver=first)
+        FriendRequest.objects.create(sender=second, receiver=self.user)
+        self.assertEqual(self.edges(), set())
+        accepted.is_accepted = True
+        accepted.save()
+        self.assertEqual(self.edges(), {(self.user.id, first.id, accepted.id), (first.id, self.user.id, accepted.id)})
+        self.assertEqual(list(self.user.friends()), [first])
+        self.assertEqual(list(first.friends()), [self.user])
+        accepted.is_cancelled = True
+        accepted.save()
+        self.assertEqual(self.edges(), set())
+        accepted.is_cancelled = False
+        accepted.save()
+        self.assertEqual(self.edges(), self.expected_edges())
+        accepted.delete()
+        self.assertEqual(self.edges(), set())
+        self.assertEqual(list(self.user.friends()), [])
+
+    def test_bulk_answers_keep_edges_in_sync(self):
+        ids = [FriendRequest.objects.create(sender=other, receiver=self.user).id for other in self.others]
+        self.client.force_login(self.user)
+        response = self.client.post('/api/users/requests/bulk/', {'action': 'accept', 'requests': ids},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.edges()), 2 * len(ids))
+        self.assertEqual(self.edges(), self.expected_edges())
+        self.client.post('/api/users/requests/bulk/', {'action': 'reject', 'requests': ids[:2]},
+                         content_type='application/json')
+        self.assertEqual(self.edges(), self.expected_edges())
+        self.assertEqual(set(self.user.friends()), set(self.others[2:]))
+
+    def test_backfill_rebuilds_edges(self):
+        for other in self.others[:3]:
+            FriendRequest.objects.create(sender=self.user, receiver=other, is_accepted=True)
+        expected = self.expected_edges()
+        Friendship.objects.all().delete()
+        # a stale edge left behind by a request that is no longer accepted
+        stale = FriendRequest.objects.create(sender=self.others[3], receiver=self.user)
+        Friendship.objects.bulk_create(Friendship.edges_for(stale))
+        call_command('backfill_friendships', stdout=StringIO())
+        self.assertEqual(self.edges(), expected)
+
+    def test_friends_queryset_returns_the_accepted_requests_of_the_user(self):
+        sent = FriendRequest.objects.create(sender=self.user, receiver=self.others[0], is_accepted=True)
+        received = FriendRequest.objects.create(sender=self.others[1], receiver=self.user, is_accepted=True)
+        FriendRequest.objects.create(sender=self.others[2], receiver=self.user)
+        FriendRequest.objects.create(sender=self.user, receiver=self.others[3], is_accepted=True, is_cancelled=True)
+        FriendRequest.objects.create(sender=self.others[2], receiver=self.others[3], is_accepted=True)
+        self.assertEqual(set(self.user.friends_queryset()), {sent, received})
+
+    def test_deprecated_friend_helpers_read_the_edges(self):
+        FriendRequest.objects.create(sender=self.user, receiver=self.others[0], is_accepted=True)
+        FriendRequest.objects.create(sender=self.others[1], receiver=self.user, is_accepted=True)
+        FriendRequest.objects.create(sender=self.user, receiver=self.others[2])
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(self.user.friends_by_requests_sent(), [self.others[0]])
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(self.user.friends_by_requests_received(), [self.others[1]])
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='pager@example.com', username='pager', is_active=True)
+        cls.others = [User.objects.create(email=f'page{i}@example.com', username=f'page{i}', is_active=True)
+                      for i in range(7)]
+        # three users share a timestamp, their order comes from the id tiebreak
+        tied = timezone.now() - timedelta(days=1)
+        User.objects.filter(id__in=[user.id for user in cls.others[2:5]]).update(created_on=tied)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def expected_ids(self):
+        return list(User.objects.exclude(id=self.user.id).order_by('-created_on', '-id').values_list('id', flat=True))
+
+    def ids(self, response):
+        return [int(item['url'].rstrip('/').rsplit('/', 1)[1]) for item in response.json()['results']]
+
+    def test_cursors_walk_forward_and_back_across_ties(self):
+        pages = []
+        url = '/api/users/?paginate=cursor&page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(self.ids(response))
+            url = response.json()['next']
+        self.assertEqual([pk for page in pages for pk in page], self.expected_ids())
+        self.assertIsNone(response.json()['next'])
+
+        backwards = []
+        url = response.json()['previous']
+        while url:
+            response = self.client.get(url)
+            backwards.append(self.ids(response))
+            url = response.json()['previous']
+        self.assertEqual(backwards, pages[-2::-1])
+
+    def test_invalid_cursors_are_rejected(self):
+        def encode(value):
+            return urlsafe_b64encode(value.encode()).decode().rstrip('=')
+        cursors = ['not-a-cursor', encode('[]'), encode('{"c": "yesterday", "i": 1}'),
+                   encode('{"c": null, "i": "x"}'), encode('{"c": null, "i": 100000000000000000000000}'), 'é']
+        for cursor in cursors:
+            response = self.client.get('/api/users/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+
+    @override_settings(USERS_MAX_PAGE_SIZE=3)
+    def test_page_size_is_clamped(self):
+        for page_size, expected in (('1000', 3), ('2', 2), ('0', 3), ('abc', 3)):
+            for mode in ('cursor', 'page'):
+                response = self.client.get('/api/users/', {'paginate': mode, 'page_size': page_size})
+                # the default PAGE_SIZE of 10 is clamped too
+                self.assertEqual(len(response.json()['results']), expected, (page_size, mode))
+
+
+class SearchBackendTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        names = [('Anna', 'Smith'), ('Hannah', 'Smithers'), ('Joanna', 'Black'), ('Bob', 'Annan'), ('Zed', 'Q')]
+        cls.users = [User.objects.create(email=f'{first.lower()}@example.com', username=first.lower(),
+                                         first_name=first, last_name=last, is_active=True)
+                     for first, last in names]
+        # the exact email of one user is a substring of another's
+        cls.users.append(User.objects.create(email='x.anna@example.com', username='xanna', is_active=True))
+
+    def search(self, backend, query):
+        return list(backend.search(User.objects.order_by('id'), query).values_list('id', flat=True))
+
+    def assertSameResults(self, query):
+        expected = self.search(SimpleSearchBackend(), query)
+        self.assertEqual(self.search(NgramSearchBackend(), query), expected, query)
+        return expected
+
+    def test_results_match_the_simple_backend(self):
+        for query in ('ann', 'ANNA', 'smith', 'hers', 'nna@ex', 'example.com', ' ann ', 'zzz', 'an', 'q', 'a', ''):
+            self.assertSameResults(query)
+        self.assertEqual(self.assertSameResults('an'),
+                         [user.id for user in self.users if 'an' in f'{user.email}{user.first_name}{user.last_name}'.lower()])
+
+    def test_exact_email_match_wins(self):
+        self.assertEqual(self.assertSameResults('Anna@Example.com'), [self.users[0].id])
+        self.assertEqual(self.assertSameResults('nna@example.com'),
+                         [self.users[0].id, self.users[2].id, self.users[5].id])
+
+    def test_index_follows_changes_and_deletes(self):
+        user = self.users[4]
+        self.assertEqual(self.search(NgramSearchBackend(), 'zed'), [user.id])
+        user.first_name = 'Quentin'
+        user.email = 'quentin@example.org'
+        user.save()
+        self.assertEqual(self.search(NgramSearchBackend(), 'zed'), [])
+        self.assertEqual(self.search(NgramSearchBackend(), 'uenti'), [user.id])
+        self.assertEqual(self.search(NgramSearchBackend(), '.org'), [user.id])
+        self.assertSameResults('uenti')
+        # saves that leave the searchable fields alone keep the index
+        user.save(update_fields=['last_login'])
+        self.assertEqual(self.search(NgramSearchBackend(), 'uenti'), [user.id])
+        user.delete()
+        self.assertFalse(UserSearchGram.objects.filter(user_id=user.id).exists())
+        self.assertEqual(self.search(NgramSearchBackend(), 'uenti'), [])
+
+
+class MutualFriendsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.first, cls.second, cls.common, cls.outsider = [
+            User.objects.create(email=f'mutual{i}@example.com', username=f'mutual{i}', is_active=True)
+            for i in range(4)]
+        cls.staff = User.objects.create(email='mutual-staff@example.com', username='mutual-staff',
+                                        is_staff=True, is_active=True)
+        for sender, receiver in ((cls.first, cls.common), (cls.second, cls.common), (cls.first, cls.outsider)):
+            FriendRequest.objects.create(sender=sender, receiver=receiver, is_accepted=True)
+
+    def setUp(self):
+        cache.clear()
+
+    def ids(self, response):
+        return [int(item['url'].rstrip('/').rsplit('/', 1)[1]) for item in response.json()['results']]
+
+    def test_only_the_two_users_and_staff_see_mutual_friends(self):
+        url = f'/api/users/{self.first.id}/mutual/{self.second.id}/'
+        for user in (self.first, self.second, self.staff):
+            self.client.force_login(user)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, user.email)
+            self.assertEqual(self.ids(response), [self.common.id])
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+    def test_a_user_has_no_mutual_friends_with_themselves(self):
+        for user in (self.first, self.staff):
+            self.client.force_login(user)
+            response = self.client.get(f'/api/users/{self.first.id}/mutual/{self.first.id}/')
+            self.assertEqual(response.status_code, 400, user.email)
+            self.assertNotIn('results', response.json())
+        # the friend list stays private to anyone else
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(f'/api/users/{self.first.id}/mutual/{self.first.id}/').status_code, 403)
+
+
+class CacheInvalidationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='cached@example.com', username='cached', is_active=True)
+        cls.others = [User.objects.create(email=f'cached{i}@example.com', username=f'cached{i}', is_active=True)
+                      for i in range(3)]
+
+    def setUp(self):
+        cache.clear()
+        reset_cache_stats()
+        self.client.force_login(self.user)
+
+    def versions(self, *users):
+        return [get_version(user.id) for user in users]
+
+    def assertInvalidated(self, users, write):
+        before = self.versions(*users)
+        with self.captureOnCommitCallbacks(execute=True):
+            result = write()
+        for user, old, new in zip(users, before, self.versions(*users)):
+            self.assertNotEqual(old, new, user.email)
+        return result
+
+    def test_friend_request_save_and_delete_invalidate_both_parties(self):
+        first, second = self.others[:2]
+        friend_request = self.assertInvalidated(
+            [self.user, first], lambda: FriendRequest.objects.create(sender=self.user, receiver=first))
+        friend_request.is_accepted = True
+        self.assertInvalidated([self.user, first], friend_request.save)
+        self.assertInvalidated([self.user, first], friend_request.delete)
+        # nobody else is touched
+        version = get_version(second.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            FriendRequest.objects.create(sender=self.user, receiver=first)
+        self.assertEqual(get_version(second.id), version)
+
+    def test_bulk_writes_invalidate_every_party(self):
+        first, second, third = self.others
+        response = self.assertInvalidated([self.user, first], lambda: self.client.post(
+            '/api/users/requests/bulk/', {'action': 'create', 'receivers': [first.id]},
+            content_type='application/json'))
+        self.assertEqual(response.json()['results'][0]['status'], 'created')
+        accepted = FriendRequest.objects.create(sender=second, receiver=self.user)
+        rejected = FriendRequest.objects.create(sender=third, receiver=self.user)
+        # rejecting a pending request changes nothing, the rejected one is accepted first
+        for action, friend_request in (('accept', accepted), ('accept', rejected), ('reject', rejected)):
+            response = self.assertInvalidated([self.user, friend_request.sender], lambda: self.client.post(
+                '/api/users/requests/bulk/', {'action': action, 'requests': [friend_request.id]},
+                content_type='application/json'))
+            self.assertEqual(response.status_code, 200)
+
+    def test_cache_hit_returns_the_payload_of_the_miss(self):
+        FriendRequest.objects.create(sender=self.user, receiver=self.others[0])
+        miss = self.client.get('/api/users/requests/')
+        hit = self.client.get('/api/users/requests/')
+        self.assertEqual(cache_stats()['friend-requests'], {'hits': 1, 'misses': 1})
+        self.assertEqual(hit.json(), miss.json())
+        self.assertEqual(len(miss.json()['results']), 1)
+        # a write in between is seen by the next read
+        with self.captureOnCommitCallbacks(execute=True):
+            FriendRequest.objects.create(sender=self.others[1], receiver=self.user)
+        self.assertEqual(len(self.client.get('/api/users/requests/').json()['results']), 2)
+        self.assertEqual(cache_stats()['friend-requests'], {'hits': 1, 'misses': 2})
+
+
+class TokenBucketThrottleTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='throttled@example.com', username='throttled', is_active=True)
+        cls.others = [User.objects.create(email=f'throttled{i}@example.com', username=f'throttled{i}', is_active=True)
+                      for i in range(5)]
+
+    def setUp(self):
+        cache.clear()
+        self.now = 1000.0
+
+    def throttle(self):
+        throttle = FriendRequestThrottle()
+        throttle.timer = lambda: self.now
+        return throttle
+
+    def allow(self, cost=1):
+        request = SimpleNamespace(method='POST', user=self.user)
+        view = SimpleNamespace(get_throttle_cost=lambda request: cost)
+        throttle = self.throttle()
+        return throttle.allow_request(request, view), throttle.wait()
+
+    def test_burst_then_refill(self):
+        # 3/minute with a burst of 3, one request every 20 seconds once the burst is spent
+        self.assertEqual([self.allow() for _ in range(3)], [(True, None)] * 3)
+        self.assertEqual(self.allow(), (False, 20))
+        self.now += 5
+        self.assertEqual(self.allow(), (False, 15))
+        self.now += 15
+        self.assertEqual(self.allow(), (True, None))
+        self.assertEqual(self.allow(), (False, 20))
+        # an idle bucket refills up to the burst, not beyond
+        self.now += 600
+        self.assertEqual([self.allow()[0] for _ in range(4)], [True, True, True, False])
+
+    def test_cost_counts_every_request(self):
+        self.assertEqual(self.allow(cost=2), (True, None))
+        self.assertEqual(self.allow(cost=2), (False, 20))
+        self.assertEqual(self.allow(cost=1), (True, None))
+        self.assertEqual(self.allow(cost=0), (True, None))
+
+    def test_cost_above_the_burst_is_a_bad_request(self):
+        with self.assertRaises(ValidationError):
+            self.allow(cost=4)
+        # and takes nothing from the bucket
+        self.assertEqual(self.allow(cost=3), (True, None))
+
+    def test_bulk_create_status_codes(self):
+        self.client.force_login(self.user)
+        url = '/api/users/requests/bulk/'
+        response = self.client.post(url, {'action': 'create', 'receivers': [user.id for user in self.others[:4]]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('At most 3 friend requests', response.json()[0])
+        self.assertFalse(FriendRequest.objects.filter(sender=self.user).exists())
+        # duplicate receivers count once
+        response = self.client.post(url, {'action': 'create', 'receivers': [self.others[0].id] * 4 + [self.others[1].id]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(url, {'action': 'create', 'receivers': [self.others[2].id, self.others[3].id]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(20 <= int(response['Retry-After']) <= 21)
+
+
+class AsyncURLConf:
+    # ROOT_URLCONF of a deployment with USERS_ASYNC_VIEWS on
+    urlpatterns = [
+        path('api/', include(build_urlpatterns(async_views=True))),
+    ]
+
+
+class AsyncViewParityTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='parity@example.com', username='parity', first_name='Par', is_active=True)
+        cls.others = [User.objects.create(email=f'parity{i}@example.com', username=f'parity{i}',
+                                          first_name=f'Other{i}', is_active=True)
+                      for i in range(5)]
+        FriendRequest.objects.create(sender=cls.user, receiver=cls.others[0], is_accepted=True)
+        FriendRequest.objects.create(sender=cls.others[1], receiver=cls.user)
+        FriendRequest.objects.create(sender=cls.user, receiver=cls.others[2])
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+
+    def fetch_both(self, url):
+        cache.clear()
+        sync = self.client.get(url)
+        cache.clear()
+        with override_settings(ROOT_URLCONF=AsyncURLConf, USERS_ASYNC_VIEWS=True):
+            asynchronous = async_to_sync(self.async_client.get)(url)
+            # resolved lazily, against the async URLconf only in here
+            self.assertTrue(issubclass(asynchronous.resolver_match.func.view_class, AsyncReadAPIView), url)
+        self.assertEqual(asynchronous.status_code, sync.status_code, url)
+        self.assertEqual(asynchronous.json(), sync.json(), url)
+        self.assertEqual(asynchronous.get('ETag'), sync.get('ETag'), url)
+        return sync
+
+    def test_responses_match_the_sync_views(self):
+        urls = ['/api/users/', '/api/users/?page=2&page_size=2', '/api/users/?search=other',
+                '/api/users/?search=parity3@example.com', f'/api/users/{self.others[0].id}/',
+                f'/api/users/{self.user.id}/friends/', '/api/users/requests/', '/api/users/requests/?page_size=1']
+        for url in urls:
+            self.assertEqual(self.fetch_both(url).status_code, 200, url)
+        self.assertEqual(self.fetch_both('/api/users/987654/').status_code, 404)
+        self.assertEqual(self.fetch_both('/api/users/?page=99').status_code, 404)
+        self.assertEqual(self.fetch_both('/api/users/?cursor=bad').status_code, 400)
+
+    def test_cursor_pages_match_the_sync_views(self):
+        for url in ('/api/users/?paginate=cursor&page_size=2', '/api/users/requests/?paginate=cursor&page_size=1'):
+            pages = 0
+            while url:
+                url = self.fetch_both(url).json()['next']
+                pages += 1
+            self.assertGreater(pages, 1)
+
+    def test_anonymous_requests_match_the_sync_views(self):
+        self.client.logout()
+        self.async_client.logout()
+        self.assertEqual(self.fetch_both('/api/users/').status_code, 401)
+
+
+class SignedTokenAuthenticationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='token@example.com', username='token@example.com', is_active=True)
+        cls.user.set_password('first-password')
+        cls.user.save()
+
+    def setUp(self):
+        cache.clear()
+
+    def login(self, password='first-password'):
+        response = self.client.post('/api/login/', {'email': self.user.email, 'password': password})
+        self.assertEqual(response.status_code, 200)
+        # the test client keeps the session of the login, the token has to work on its own
+        self.client.logout()
+        return response.json()['token']
+
+    def get(self, token):
+        return self.client.get('/api/users/requests/', HTTP_AUTHORIZATION=f'Token {token}')
+
+    def test_login_token_authenticates(self):
+        token = self.login()
+        self.assertEqual(self.get(token).status_code, 200)
+        self.assertEqual(self.client.get('/api/users/requests/').status_code, 401)
+
+    def test_logout_revokes_tokens(self):
+        token = self.login()
+        other_token = self.login()
+        self.assertEqual(self.get(other_token).status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/logout/', HTTP_AUTHORIZATION=f'Token {token}')
+        self.assertEqual(response.status_code, 204)
+        for revoked in (token, other_token):
+            response = self.get(revoked)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.json()['detail'], 'Token has been revoked.')
+        self.assertEqual(self.get(self.login()).status_code, 200)
+
+    def test_password_change_revokes_tokens(self):
+        token = self.login()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f'/api/users/{self.user.id}/', {'password': 'second-password'},
+                                         content_type='application/json', HTTP_AUTHORIZATION=f'Token {token}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(token).status_code, 401)
+        self.assertEqual(self.get(self.login('second-password')).status_code, 200)
+
+    def test_bad_tokens_are_rejected(self):
+        token = self.login()
+        user_id, _, version = signing.loads(token, salt=TOKEN_SALT)
+        tokens = {
+            'Invalid token.': [token[:-1] + ('A' if token[-1] != 'A' else 'B'), 'not-a-token',
+                               signing.dumps([user_id, 1, version], salt='another salt'),
+                               signing.dumps({'user': user_id}, salt=TOKEN_SALT)],
+            'Token has been revoked.': [signing.dumps([user_id, 1, version + 1], salt=TOKEN_SALT),
+                                        signing.dumps([987654, 1, version], salt=TOKEN_SALT)],
+            'User inactive or deleted.': [signing.dumps([user_id, 0, version], salt=TOKEN_SALT)],
+        }
+        for detail, bad_tokens in tokens.items():
+            for bad_token in bad_tokens:
+                response = self.get(bad_token)
+                self.assertEqual(response.status_code, 401, bad_token)
+                self.assertEqual(response.json()['detail'], detail, bad_token)
+        self.assertEqual(self.client.get('/api/users/requests/', HTTP_AUTHORIZATION=f'Token {token} extra').status_code,
+                         401)
+        with override_settings(USERS_TOKEN_MAX_AGE=-1):
+            response = self.get(token)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['detail'], 'Token has expired.')
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    def pool(self, **options):
+        return ConnectionPool('default', dict({'max_size': 2, 'timeout': 0.05, 'check_after': 60}, **options))
+
+    def checkout(self, pool, ping=lambda raw: None):
+        return pool.checkout(FakeConnection, ping)
+
+    def test_size_limit_and_timeout(self):
+        pool = self.pool()
+        first, second = self.checkout(pool), self.checkout(pool)
+        with self.assertRaises(PoolTimeout):
+            self.checkout(pool)
+        pool.checkin(first)
+        self.assertIs(self.checkout(pool), first)
+        # a waiter gets the connection handed back by another thread
+        pool.options['timeout'] = 5
+        threading.Timer(0.05, pool.checkin, [second]).start()
+        self.assertIs(self.checkout(pool), second)
+        stats = pool.stats()
+        self.assertEqual((stats['opened'], stats['in_use'], stats['timeouts'], stats['waits']), (2, 2, 1, 2))
+
+    def test_failed_connect_frees_its_slot(self):
+        pool = self.pool(max_size=1)
+        with self.assertRaises(ConnectionError):
+            pool.checkout(lambda: (_ for _ in ()).throw(ConnectionError()), lambda raw: None)
+        self.assertEqual(pool.size, 0)
+        self.checkout(pool)
+
+    def test_idle_and_old_connections_are_recycled(self):
+        pool = self.pool(max_idle=300, max_lifetime=3600)
+        idle = self.checkout(pool)
+        pool.checkin(idle)
+        pool.idle[0].last_used -= 301
+        fresh = self.checkout(pool)
+        self.assertIsNot(fresh, idle)
+        self.assertTrue(idle.closed)
+        # past its lifetime a connection is closed when it comes back, however busy it is
+        pool.in_use[id(fresh)].created -= 3601
+        pool.checkin(fresh)
+        self.assertTrue(fresh.closed)
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertEqual(pool.stats()['closed'], {'idle': 1, 'lifetime': 1})
+
+    def test_broken_connection_is_discarded_on_checkout(self):
+        def ping(raw):
+            if raw is broken:
+                raise OSError('server has gone away')
+        pool = self.pool(check_after=1)
+        broken = self.checkout(pool)
+        pool.checkin(broken)
+        # recently used connections are not pinged
+        self.assertIs(self.checkout(pool, ping), broken)
+        pool.checkin(broken)
+        pool.idle[0].last_used -= 2
+        healthy = self.checkout(pool, ping)
+        self.assertIsNot(healthy, broken)
+        self.assertTrue(broken.closed)
+        self.assertEqual(pool.stats()['closed'], {'broken': 1})
+        pool.checkin(healthy)
+        pool.idle[0].last_used -= 2
+        self.assertIs(self.checkout(pool, ping), healthy)
+
+    def test_new_pool_after_fork(self):
+        settings_dict = {'ENGINE': 'socialapp.db.backends.sqlite3', 'NAME': 'fork-test', 'HOST': '', 'PORT': '',
+                         'USER': '', 'POOL': {'max_size': 1}}
+        pool = get_pool('fork-test', settings_dict)
+        inherited = pool.checkout(FakeConnection, lambda raw: None)
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # child: checking a parent connection in closes it, the alias gets a pool of its own
+            try:
+                pool.checkin(inherited)
+                child_pool = get_pool('fork-test', settings_dict)
+                result = {'closed': inherited.closed, 'new_pool': child_pool is not pool,
+                          'reused': child_pool.checkout(FakeConnection, lambda raw: None) is inherited,
+                          'stats': [alias for alias, _ in pool_stats()].count('fork-test')}
+                os.write(write, json.dumps(result).encode())
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as output:
+            result = json.loads(output.read())
+        os.waitpid(pid, 0)
+        self.assertEqual(result, {'closed': True, 'new_pool': True, 'reused': False, 'stats': 1})
+        self.assertIs(get_pool('fork-test', settings_dict), pool)
+        self.assertFalse(inherited.closed)
+        pool.checkin(inherited)
+
+
+class PooledDatabaseWrapperTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # a handler of its own, the test databases are in memory and not pooled
+        self.handler = ConnectionHandler({'default': {'ENGINE': 'socialapp.db.backends.sqlite3',
+                                                      'NAME': os.path.join(directory.name, 'pooled.sqlite3'),
+                                                      'POOL': {'max_size': 2, 'check_after': 0}}})
+        self.wrapper = self.handler['default']
+        self.addCleanup(self.wrapper.pool.close_idle)
+
+    def connect(self):
+        self.wrapper.ensure_connection()
+        return self.wrapper.connection
+
+    def test_closed_connections_go_back_to_the_pool(self):
+        raw = self.connect()
+        self.wrapper.close()
+        self.assertEqual(self.wrapper.pool.stats()['idle'], 1)
+        # pinged with SELECT 1 on the way out, check_after is 0
+        self.assertIs(self.connect(), raw)
+        self.wrapper.close()
+
+    def test_connection_with_an_error_is_discarded(self):
+        raw = self.connect()
+        with self.assertRaises(DatabaseError):
+            with self.wrapper.cursor() as cursor:
+                cursor.execute('SELECT * FROM no_such_table')
+        self.wrapper.close()
+        self.assertIsNot(self.connect(), raw)
+        self.wrapper.close()
+        self.assertEqual(self.wrapper.pool.stats()['closed'], {'error': 1})
+
+    def test_connection_closed_in_a_transaction_is_discarded(self):
+        raw = self.connect()
+        with mock.patch.object(transaction, 'connections', self.handler), transaction.atomic():
+            self.wrapper.close()
+        self.assertIsNot(self.connect(), raw)
+        self.wrapper.close()
+        self.assertEqual(self.wrapper.pool.stats()['closed'], {'transaction': 1})
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ImportUsersTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_csv(self, rows, name='users.csv'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', newline='') as output:
+            writer = csv.DictWriter(output, ['email', 'first_name', 'last_name', 'password'])
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def rows(self, count, start=0):
+        return [{'email': f'imported{i}@example.com', 'first_name': f'Imported{i}', 'last_name': 'Row',
+                 'password': f'secret{i}'} for i in range(start, start + count)]
+
+    def run_import(self, path, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_users', path, '--workers', '1', '--batch-size', '2', *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import_creates_users_and_removes_the_checkpoint(self):
+        path = self.write_csv(self.rows(5))
+        stdout, _ = self.run_import(path)
+        self.assertIn('5 created, 0 already existing, 0 invalid', stdout)
+        user = User.objects.get(email='imported3@example.com')
+        self.assertTrue(user.check_password('secret3'))
+        self.assertEqual((user.first_name, user.username, user.is_active), ('Imported3', user.email, True))
+        self.assertEqual(list(get_search_backend().search(User.objects.all(), 'imported3')), [user])
+        self.assertFalse(os.path.exists(f'{path}.checkpoint'))
+
+    def test_invalid_and_duplicate_rows_are_skipped(self):
+        User.objects.create(email='imported0@example.com', username='imported0@example.com')
+        rows = self.rows(3) + [{'email': 'not-an-email', 'password': 'x'}, {'email': 'nopassword@example.com'},
+                               {'email': 'Imported1@Example.com ', 'password': 'again'}]
+        stdout, stderr = self.run_import(self.write_csv(rows))
+        self.assertIn('2 created, 2 already existing, 2 invalid', stdout)
+        self.assertIn('Skipping not-an-email', stderr)
+        self.assertIn('Skipping nopassword@example.com', stderr)
+        self.assertEqual(User.objects.filter(email__startswith='imported').count(), 3)
+        self.assertTrue(User.objects.get(email='imported1@example.com').check_password('secret1'))
+
+    def test_interrupted_import_resumes_from_its_checkpoint(self):
+        path = self.write_csv(self.rows(6))
+        prepare = ImportUsersCommand.prepare
+
+        def interrupt_at_the_third_batch(command, batch, options, executor):
+            if batch[0]['email'] == 'imported4@example.com':
+                raise RuntimeError('interrupted')
+            return prepare(command, batch, options, executor)
+
+        with mock.patch.object(ImportUsersCommand, 'prepare', autospec=True, side_effect=interrupt_at_the_third_batch):
+            with self.assertRaises(RuntimeError):
+                self.run_import(path)
+        # the second batch was prepared but not written when it stopped
+        with open(f'{path}.checkpoint') as checkpoint:
+            self.assertEqual(json.load(checkpoint), {'rows': 2, 'created': 2, 'skipped': 0, 'invalid': 0})
+        self.assertEqual(User.objects.filter(email__startswith='imported').count(), 2)
+
+        stdout, _ = self.run_import(path)
+        self.assertIn('Resuming after row 2', stdout)
+        self.assertIn('Imported 4 rows', stdout)
+        self.assertIn('6 created, 0 already existing', stdout)
+        self.assertEqual(User.objects.filter(email__startswith='imported').count(), 6)
+        self.assertFalse(os.path.exists(f'{path}.checkpoint'))
+
+    def test_restart_ignores_the_checkpoint(self):
+        path = self.write_csv(self.rows(3))
+        with open(f'{path}.checkpoint', 'w') as checkpoint:
+            json.dump({'rows': 3, 'created': 3, 'skipped': 0, 'invalid': 0}, checkpoint)
+        stdout, _ = self.run_import(path, '--restart')
+        self.assertNotIn('Resuming', stdout)
+        self.assertIn('3 created', stdout)
+        self.assertFalse(os.path.exists(f'{path}.checkpoint'))
+
+    def test_empty_input(self):
+        jsonl = os.path.join(self.directory, 'users.jsonl')
+        open(jsonl, 'w').close()
+        for path in (self.write_csv([]), jsonl):
+            stdout, _ = self.run_import(path)
+            self.assertIn('Imported 0 rows', stdout)
+            self.assertFalse(os.path.exists(f'{path}.checkpoint'))
+        self.assertFalse(User.objects.exists())
+
+
+class FriendRequestPairTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.first, cls.second, cls.third = [
+            User.objects.create(email=f'pair{i}@example.com', username=f'pair{i}', is_active=True) for i in range(3)]
+
+    def setUp(self):
+        cache.clear()
+
+    def test_one_request_per_pair_in_either_direction(self):
+        friend_request = FriendRequest.objects.create(sender=self.first, receiver=self.second)
+        self.assertEqual((friend_request.user_low, friend_request.user_high),
+                         tuple(sorted([self.first.id, self.second.id])))
+        for sender, receiver in ((self.first, self.second), (self.second, self.first)):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                FriendRequest.objects.create(sender=sender, receiver=receiver)
+        FriendRequest.objects.create(sender=self.third, receiver=self.first)
+        self.assertEqual(FriendRequest.between(self.second.id, self.first.id).get(), friend_request)
+
+    def test_reverse_request_is_refused(self):
+        self.client.force_login(self.first)
+        self.assertEqual(self.client.post('/api/users/requests/', {'receiver': self.second.id}).status_code, 201)
+        self.client.force_login(self.second)
+        response = self.client.post('/api/users/requests/', {'receiver': self.first.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('A friend request between these users already exists.', str(response.json()))
+        response = self.client.post('/api/users/requests/bulk/', {'action': 'create', 'receivers': [self.first.id]},
+                                    content_type='application/json')
+        self.assertEqual(response.json()['results'][0]['status'], 'error')
+        self.assertEqual(FriendRequest.objects.count(), 1)
+
+    def test_request_cannot_be_sent_again_after_cancelling(self):
+        friend_request = FriendRequest.objects.create(sender=self.first, receiver=self.second)
+        friend_request.is_cancelled = True
+        friend_request.save()
+        for sender, receiver in ((self.first, self.second), (self.second, self.first)):
+            self.client.force_login(sender)
+            response = self.client.post('/api/users/requests/', {'receiver': receiver.id})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(FriendRequest.objects.all()), [friend_request])
+
+
+@override_settings(THROTTLE_BUCKETS={'friend_request': {'rate': '100/minute', 'burst': 100}})
+class FriendRequestBulkTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='bulk@example.com', username='bulk', is_active=True)
+        cls.others = [User.objects.create(email=f'bulk{i}@example.com', username=f'bulk{i}', is_active=True)
+                      for i in range(5)]
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def post(self, data):
+        return self.client.post('/api/users/requests/bulk/', data, content_type='application/json')
+
+    def statuses(self, response, key):
+        self.assertEqual(response.status_code, 200)
+        return {result[key]: result.get('error', result['status']) for result in response.json()['results']}
+
+    def test_create_reports_every_receiver(self):
+        first, second, third = self.others[:3]
+        FriendRequest.objects.create(sender=third, receiver=self.user)
+        response = self.post({'action': 'create',
+                              'receivers': [first.id, second.id, first.id, self.user.id, 987654, third.id]})
+        self.assertEqual([result['receiver'] for result in response.json()['results']],
+                         [first.id, second.id, self.user.id, 987654, third.id])
+        self.assertEqual(self.statuses(response, 'receiver'), {
+            first.id: 'created',
+            second.id: 'created',
+            self.user.id: 'Sender and receiver cannot be the same user.',
+            987654: 'User does not exist.',
+            third.id: 'A friend request between these users already exists.',
+        })
+        created = response.json()['results'][0]['friend_request']
+        self.assertEqual(created['url'], f'http://testserver/api/users/requests/'
+                                         f'{FriendRequest.objects.get(sender=self.user, receiver=first).id}')
+        self.assertEqual(FriendRequest.objects.filter(sender=self.user).count(), 2)
+        # sent again, the pairs are taken now
+        response = self.post({'action': 'create', 'receivers': [first.id]})
+        self.assertEqual(self.statuses(response, 'receiver'),
+                         {first.id: 'A friend request between these users already exists.'})
+
+    def test_create_survives_a_request_sent_concurrently(self):
+        first, second = self.others[:2]
+        bulk_create = FriendRequest.objects.bulk_create
+
+        def racing_bulk_create(*args, **kwargs):
+            # the other side sends a request after the checks, before the insert
+            FriendRequest.objects.create(sender=second, receiver=self.user)
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(FriendRequest.objects, 'bulk_create', racing_bulk_create):
+            response = self.post({'action': 'create', 'receivers': [first.id, second.id]})
+        self.assertEqual(self.statuses(response, 'receiver'), {
+            first.id: 'created', second.id: 'A friend request between these users already exists.'})
+        self.assertEqual(FriendRequest.objects.filter(receiver=second).count(), 0)
+
+    def test_accept_and_reject_report_the_resulting_state(self):
+        pending, accepted, cancelled, foreign = (
+            FriendRequest.objects.create(sender=self.others[0], receiver=self.user),
+            FriendRequest.objects.create(sender=self.others[1], receiver=self.user, is_accepted=True),
+            FriendRequest.objects.create(sender=self.others[2], receiver=self.user, is_cancelled=True),
+            FriendRequest.objects.create(sender=self.others[3], receiver=self.others[4]),
+        )
+        ids = [pending.id, accepted.id, cancelled.id, foreign.id, 987654]
+        errors = {cancelled.id: 'This friend request was cancelled by the sender.', foreign.id: 'Not found.',
+                  987654: 'Not found.'}
+        self.assertEqual(self.statuses(self.post({'action': 'reject', 'requests': ids}), 'id'),
+                         {**errors, pending.id: 'unchanged', accepted.id: 'rejected'})
+        self.assertEqual(self.statuses(self.post({'action': 'accept', 'requests': ids}), 'id'),
+                         {**errors, pending.id: 'accepted', accepted.id: 'accepted'})
+        response = self.post({'action': 'accept', 'requests': [pending.id]})
+        self.assertEqual(self.statuses(response, 'id'), {pending.id: 'unchanged'})
+        self.assertTrue(response.json()['results'][0]['friend_request']['is_accepted'])
+        self.assertEqual(set(self.user.friends()), {self.others[0], self.others[1]})
+        self.assertFalse(FriendRequest.objects.get(id=foreign.id).is_accepted)
+
+    @override_settings(FRIEND_REQUEST_BULK_MAX=2)
+    def test_invalid_calls_are_rejected(self):
+        for data in ({'action': 'create', 'requests': [self.others[0].id]}, {'action': 'delete', 'requests': [1]},
+                     {'action': 'accept', 'requests': []}, {'action': 'create', 'receivers': [1, 2, 3]}):
+            self.assertEqual(self.post(data).status_code, 400, data)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SocialGraphCommandTests(TestCase):
+
+    def generate(self):
+        stdout = StringIO()
+        call_command('generate_social_graph', '--users', '40', '--avg-friends', '6', '--batch-size', '15',
+                     '--prefix', 'generated', '--seed', '3', stdout=stdout)
+        return stdout.getvalue()
+
+    def test_generated_graph_is_consistent(self):
+        output = self.generate()
+        users = User.objects.filter(email__startswith='generated-')
+        friend_requests = FriendRequest.objects.all()
+        self.assertEqual(users.count(), 40)
+        self.assertIn(f'Generated 40 users and {friend_requests.count()} friend requests', output)
+        self.assertGreater(friend_requests.count(), 40)
+        self.assertTrue(users.first().check_password(DEFAULT_PASSWORD))
+
+        pairs = [tuple(sorted(pair)) for pair in friend_requests.values_list('sender_id', 'receiver_id')]
+        self.assertEqual(len(pairs), len(set(pairs)))
+        self.assertFalse(any(low == high for low, high in pairs))
+        accepted = friend_requests.filter(is_accepted=True, is_cancelled=False)
+        self.assertTrue(accepted.exists())
+        self.assertEqual(Friendship.objects.count(), 2 * accepted.count())
+        user_ids = list(users.values_list('id', flat=True))
+        stored = {row['id']: {field: row[field] for field in COUNTER_FIELDS}
+                  for row in users.values('id', *COUNTER_FIELDS)}
+        self.assertEqual(stored, actual_counts(user_ids))
+        user = users.first()
+        self.assertIn(user, get_search_backend().search(User.objects.all(), user.email))
+
+    def test_endpoint_benchmark_runs_against_the_generated_graph(self):
+        self.generate()
+        users_before = User.objects.count()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        output = os.path.join(directory.name, 'bench.json')
+        stdout = StringIO()
+        call_command('bench_endpoints', '--iterations', '2', '--output', output, stdout=stdout, stderr=StringIO())
+        with open(output) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report['iterations'], 2)
+        endpoints = report['endpoints']
+        for name in ('user-list', 'user-detail', 'friend-list', 'friend-suggestions', 'friend-create'):
+            self.assertEqual(endpoints[name]['status'], [200], name)
+        self.assertEqual(endpoints['register']['status'], [201])
+        self.assertEqual(endpoints['metrics']['status'], [403])
+        self.assertTrue(all(status < 500 for result in endpoints.values() for status in result['status']))
+        self.assertGreater(endpoints['friend-list']['queries'], 0)
+        # what the run wrote is removed again
+        self.assertEqual(User.objects.count(), users_before)
+        call_command('bench_endpoints', '--iterations', '1', '--output', output, '--compare', output,
+                     stdout=stdout, stderr=StringIO())
+        self.assertIn('p50 delta', stdout.getvalue())
+
+
+class RequestMetricsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='measured@example.com', username='measured', first_name='Mea',
+                                       is_active=True)
+        cls.admin = User.objects.create(email='scraper@example.com', username='scraper', is_staff=True,
+                                        is_active=True)
+
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+        self.addCleanup(registry.reset)
+
+    def test_requests_are_recorded_per_view_and_method(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('user-detail', kwargs={'pk': self.user.id})).status_code, 200)
+        self.client.get(reverse('user-detail', kwargs={'pk': 987654}))
+        self.client.get('/nowhere/')
+
+        duration, db_queries, db_duration, size = registry.histograms[('user-detail', 'GET')]
+        self.assertEqual(duration.count, 2)
+        self.assertGreater(duration.sum, 0)
+        self.assertEqual(db_queries.count, 2)
+        self.assertGreater(db_queries.sum, 0)
+        self.assertGreater(db_duration.sum, 0)
+        self.assertEqual(size.count, 2)
+        self.assertEqual(registry.responses[('user-detail', 'GET', 200)], 1)
+        self.assertEqual(registry.responses[('user-detail', 'GET', 404)], 1)
+        self.assertEqual(registry.responses[('<unresolved>', 'GET', 404)], 1)
+
+    def test_first_request_query_count_matches_the_queries_run(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('user-list'))
+        _, db_queries, _, _ = registry.histograms[('user-list', 'GET')]
+        self.assertEqual(db_queries.sum, len(queries))
+
+    def test_async_requests_are_recorded(self):
+        self.async_client.force_login(self.user)
+        with override_settings(ROOT_URLCONF=AsyncURLConf, USERS_ASYNC_VIEWS=True):
+            response = async_to_sync(self.async_client.get)(reverse('user-list'))
+        self.assertEqual(response.status_code, 200)
+        duration, db_queries, _, _ = registry.histograms[('user-list', 'GET')]
+        self.assertEqual(duration.count, 1)
+        self.assertGreater(db_queries.sum, 0)
+
+    def test_render_uses_the_prometheus_text_format(self):
+        registry.observe_request('user-list', 'GET', 200, 0.02, 3, 0.004, 600)
+        registry.observe_request('user-list', 'GET', 200, 20, 100, 0.5, None)
+        registry.observe_request('say "hi"', 'other', 500, 0.001, 0, 0, 10)
+        lines = registry.render().splitlines()
+
+        self.assertEqual(lines[:2], ['# HELP http_request_duration_seconds Wall time spent in the view and '
+                                     'middleware below it.', '# TYPE http_request_duration_seconds histogram'])
+        labels = 'view="user-list",method="GET"'
+        for line in (f'http_request_duration_seconds_bucket{{{labels},le="0.01"}} 0',
+                     f'http_request_duration_seconds_bucket{{{labels},le="0.025"}} 1',
+                     f'http_request_duration_seconds_bucket{{{labels},le="10.0"}} 1',
+                     f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2',
+                     f'http_request_duration_seconds_sum{{{labels}}} 20.02',
+                     f'http_request_duration_seconds_count{{{labels}}} 2',
+                     f'http_request_db_queries_bucket{{{labels},le="3"}} 1',
+                     f'http_request_db_queries_sum{{{labels}}} 103',
+                     # streaming responses have no size
+                     f'http_response_size_bytes_count{{{labels}}} 1',
+                     f'http_responses_total{{{labels},status="200"}} 2',
+                     'http_responses_total{view="say \\"hi\\"",method="other",status="500"} 1',
+                     '# TYPE users_cache_requests_total counter'):
+            self.assertIn(line, lines)
+
+    def test_metrics_endpoint_is_for_admins_only(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(self.admin)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        body = response.content.decode()
+        self.assertIn('http_responses_total{view="metrics",method="GET",status="403"} 1', body)
+        self.assertIn('http_responses_total{view="metrics",method="GET",status="401"} 1', body)
+
+
+class ExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='exporter@example.com', username='exporter', first_name='Zoë',
+                                       last_name='Ødegård', is_active=True)
+        cls.others = [User.objects.create(email=f'exported{i}@example.com', username=f'exported{i}',
+                                          first_name=f'Élodie{i}', is_active=True)
+                      for i in range(4)]
+        FriendRequest.objects.create(sender=cls.user, receiver=cls.others[0], is_accepted=True)
+        FriendRequest.objects.create(sender=cls.others[1], receiver=cls.user, is_accepted=True)
+        FriendRequest.objects.create(sender=cls.user, receiver=cls.others[2])
+        FriendRequest.objects.create(sender=cls.others[3], receiver=cls.user, is_cancelled=True)
+        FriendRequest.objects.create(sender=cls.others[2], receiver=cls.others[3])
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+
+    def url(self, kind, user=None):
+        return reverse('user-export', kwargs={'pk': (user or self.user).id, 'kind': kind})
+
+    def fetch(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def afetch(self, url):
+        async def fetch():
+            response = await self.async_client.get(url)
+            return response, b''.join([chunk async for chunk in response.streaming_content]).decode()
+        return async_to_sync(fetch)()
+
+    def test_friends_as_ndjson(self):
+        response, body = self.fetch(self.url('friends'))
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="user-{self.user.id}-friends.ndjson"')
+        rows = [json.loads(line) for line in body.splitlines()]
+        edges = Friendship.objects.filter(user=self.user).order_by('friend_id')
+        self.assertEqual(rows, [{'id': edge.friend_id, 'email': edge.friend.email, 'first_name': edge.friend.first_name,
+                                 'last_name': edge.friend.last_name, 'friends_since': edge.created_on.isoformat()}
+                                for edge in edges])
+        self.assertEqual(len(rows), 2)
+
+    def test_friend_requests_as_csv(self):
+        response, body = self.fetch(self.url('friend-requests') + '?output=CSV')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(body.splitlines()))
+        sent = FriendRequest.objects.filter(sender=self.user).order_by('receiver_id')
+        received = FriendRequest.objects.filter(receiver=self.user).order_by('sender_id')
+        self.assertEqual([int(row['id']) for row in rows], [request.id for request in [*sent, *received]])
+        self.assertEqual(rows[0]['created_on'], sent[0].created_on.isoformat())
+        self.assertEqual(rows[0]['is_accepted'], 'True')
+
+    def test_asgi_export_matches_the_sync_one(self):
+        for url in (self.url('friends'), self.url('friends') + '?output=csv', self.url('friend-requests')):
+            sync_response, sync_body = self.fetch(url)
+            async_response, async_body = self.afetch(url)
+            self.assertEqual(async_response.status_code, 200, url)
+            self.assertEqual(async_response['Content-Type'], sync_response['Content-Type'], url)
+            self.assertEqual(async_body, sync_body, url)
+            self.assertTrue(sync_body, url)
+
+    def test_batches_cover_every_row(self):
+        for kind, export_format in (('friend-requests', 'ndjson'), ('friends', 'csv')):
+            whole = ''.join(export_chunks(kind, export_format, self.user.id))
+            chunks = list(export_chunks(kind, export_format, self.user.id, batch_size=1))
+            self.assertEqual(''.join(chunks), whole, kind)
+            self.assertGreater(len(chunks), 2, kind)
+
+    def test_invalid_exports(self):
+        self.assertEqual(self.client.get(self.url('friends', self.others[0])).status_code, 403)
+        self.assertEqual(self.client.get(self.url('users')).status_code, 404)
+        self.assertEqual(self.client.get(self.url('friends') + '?output=xml').status_code, 400)
+
+    def test_export_graph_to_standard_output(self):
+        stdout = StringIO()
+        call_command('export_graph', '--batch-size', '2', stdout=stdout)
+        rows = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([row['id'] for row in rows], list(FriendRequest.objects.order_by('id')
+                                                           .values_list('id', flat=True)))
+        stdout = StringIO()
+        call_command('export_graph', '--kind', 'friends', '--user', str(self.user.id), '--format', 'csv',
+                     stdout=stdout)
+        self.assertEqual(stdout.getvalue(), ''.join(export_chunks('friends', 'csv', self.user.id)))
+
+    def test_export_graph_to_a_file_reports_bytes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        output = os.path.join(directory.name, 'users.csv')
+        stderr = StringIO()
+        call_command('export_graph', '--kind', 'users', '--format', 'csv', '--output', output,
+                     stdout=StringIO(), stderr=stderr)
+        with open(output, encoding='utf-8', newline='') as export_file:
+            rows = list(csv.DictReader(export_file))
+        self.assertEqual(len(rows), User.objects.count())
+        self.assertIn(f'Wrote {os.path.getsize(output)} bytes to {output}', stderr.getvalue())
+        with self.assertRaisesMessage(CommandError, '--user is required to export friends.'):
+            call_command('export_graph', '--kind', 'friends', stdout=StringIO())
+
+
+class PairBackfillMigrationTests(TransactionTestCase):
+    migrate_from = [('users', '0009_friendrequest_pair')]
+    migrate_to = [('users', '0010_friendrequest_pair_backfill')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        self.addCleanup(self.migrate_to_latest)
+        executor.migrate(self.migrate_from)
+        self.apps = executor.loader.project_state(self.migrate_from).apps
+
+    @staticmethod
+    def migrate_to_latest():
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_reverse_requests_are_merged_before_the_pair_is_constrained(self):
+        User = self.apps.get_model('users', 'User')
+        FriendRequest = self.apps.get_model('users', 'FriendRequest')
+        Friendship = self.apps.get_model('users', 'Friendship')
+        ann, bob, cat, dan, eve = [User.objects.create(email=f'{name}@example.com', username=name, is_active=True,
+                                                       friend_count=7, pending_incoming_count=7,
+                                                       pending_outgoing_count=7)
+                                   for name in ('ann', 'bob', 'cat', 'dan', 'eve')]
+        # written before the pair key: no pair, and both directions of the same two users
+        FriendRequest.objects.create(sender=ann, receiver=bob)
+        accepted = FriendRequest.objects.create(sender=bob, receiver=ann, is_accepted=True)
+        Friendship.objects.create(user=ann, friend=bob, friend_request=accepted)
+        Friendship.objects.create(user=bob, friend=ann, friend_request=accepted)
+        FriendRequest.objects.create(sender=cat, receiver=dan)
+        newest = FriendRequest.objects.create(sender=dan, receiver=cat)
+        single = FriendRequest.objects.create(sender=eve, receiver=ann)
+
+        MigrationExecutor(connection).migrate(self.migrate_to)
+
+        apps = MigrationExecutor(connection).loader.project_state(self.migrate_to).apps
+        FriendRequest = apps.get_model('users', 'FriendRequest')
+        Friendship = apps.get_model('users', 'Friendship')
+        User = apps.get_model('users', 'User')
+        self.assertEqual(sorted(FriendRequest.objects.values_list('id', flat=True)),
+                         [accepted.id, newest.id, single.id])
+        self.assertEqual(set(FriendRequest.objects.values_list('id', 'user_low', 'user_high')),
+                         {(accepted.id, ann.id, bob.id), (newest.id, cat.id, dan.id), (single.id, ann.id, eve.id)})
+        self.assertEqual(set(Friendship.objects.values_list('friend_request_id', flat=True)), {accepted.id})
+        counters = {user.id: (user.friend_count, user.pending_incoming_count, user.pending_outgoing_count)
+                    for user in User.objects.all()}
+        self.assertEqual(counters[ann.id], (1, 1, 0))
+        self.assertEqual(counters[bob.id], (1, 0, 0))
+        self.assertEqual(counters[cat.id], (0, 1, 0))
+        self.assertEqual(counters[dan.id], (0, 0, 1))
+        # eve had no duplicate, the reconcile_counters command is what repairs unrelated drift
+        self.assertEqual(counters[eve.id], (7, 7, 7))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            FriendRequest.objects.create(sender_id=bob.id, receiver_id=ann.id, user_low=ann.id, user_high=bob.id)
+
+
+class ListSerializationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='owner@example.com', username='owner', is_active=True)
+        cls.others = [
+            User.objects.create(email=f'user{i}@example.com', username=f'user{i}', first_name=f'First{i}',
+                                last_name=f'Last{i}', is_active=True)
+            for i in range(30)
+        ]
+        for i, other in enumerate(cls.others):
+            friend_request = FriendRequest.objects.create(sender=cls.user, receiver=other)
+            if i % 2:
+                friend_request.is_accepted = True
+                friend_request.save()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def drf_request(self):
+        return Request(RequestFactory().get('/api/users/'))
+
+    def test_row_serializers_match_model_serializers(self):
+        context = {'request': self.drf_request()}
+        users = User.objects.order_by('id')
+        self.assertEqual(
+            UserRowSerializer(users.values(*UserRowSerializer.values_fields), context=context).data,
+            UserSerializer(users, context=context, many=True).data,
+        )
+        friend_requests = FriendRequest.objects.order_by('id')
+        self.assertEqual(
+            FriendRequestRowSerializer(friend_requests.values(*FriendRequestRowSerializer.values_fields),
+                                       context=context).data,
+            FriendRequestSerializer(friend_requests, context=context, many=True).data,
+        )
+
+    def query_counts(self, url, page_sizes=(1, 10, 30)):
+        counts = []
+        for page_size in page_sizes:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, {'page_size': page_size})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.json()['results'])
+            counts.append(len(queries.captured_queries))
+        return counts
+
+    def assertConstantQueries(self, url):
+        counts = self.query_counts(url)
+        self.assertEqual(len(set(counts)), 1, counts)
+
+    def test_user_list_query_count_is_constant(self):
+        self.assertConstantQueries('/api/users/')
+
+    def test_friend_request_list_query_count_is_constant(self):
+        self.assertConstantQueries('/api/users/requests/')
+
+    def test_friend_list_query_count_is_constant(self):
+        self.assertConstantQueries(f'/api/users/{self.user.id}/friends/')
+
+
+class FastJSONRendererTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='renderer@example.com', username='renderer', is_active=True)
+        for i in range(15):
+            User.objects.create(email=f'render{i}@example.com', username=f'render{i}', first_name=f'Zoë {i}',
+                                last_name='O\u2028Neil', is_active=True)
+
+    def test_output_matches_the_stock_renderer(self):
+        self.client.force_login(self.user)
+        for url in ('/api/users/?page_size=10', '/api/users/?paginate=cursor', f'/api/users/{self.user.id}/'):
+            response = self.client.get(url, HTTP_ACCEPT='application/json')
+            self.assertEqual(FastJSONRenderer().render(response.data), response.content)
+            self.assertEqual(FastJSONParser().parse(BytesIO(response.content), 'application/json', {}),
+                             response.json())
+
+
+@override_settings(DATABASE_REPLICAS=['replica_1', 'replica_2'])
+class ReplicaRouterTests(SimpleTestCase):
+
+    def route(self, *steps, pinned_until=0.0):
+        # runs steps in a fresh context, as ReplicaPinMiddleware does for every request
+        def run():
+            routing_state.set(RoutingState(pinned_until))
+            return [step(ReplicaRouter()) for step in steps]
+        return copy_context().run(run)
+
+    def test_reads_go_to_replicas_and_writes_to_primary(self):
+        read, write = self.route(lambda router: router.db_for_read(User), lambda router: router.db_for_write(User))
+        self.assertIn(read, ['replica_1', 'replica_2'])
+        self.assertEqual(write, 'default')
+
+    def test_reads_after_a_write_stay_on_primary(self):
+        steps = (lambda router: router.db_for_write(FriendRequest), lambda router: router.db_for_read(User))
+        self.assertEqual(self.route(*steps)[1], 'default')
+
+    def test_pinned_client_reads_from_primary(self):
+        read = self.route(lambda router: router.db_for_read(User), pinned_until=float('inf'))[0]
+        self.assertEqual(read, 'default')
+
+    def test_throttle_buckets_stay_on_primary_without_pinning(self):
+        steps = (lambda router: router.db_for_read(ThrottleBucket), lambda router: router.db_for_write(ThrottleBucket),
+                 lambda router: router.db_for_read(User))
+        bucket_read, _, user_read = self.route(*steps)
+        self.assertEqual(bucket_read, 'default')
+        self.assertIn(user_read, ['replica_1', 'replica_2'])
+
+    def test_other_apps_are_not_routed(self):
+        self.assertEqual(self.route(lambda router: router.db_for_read(Session)), [None])
+
+    def test_replicas_are_not_migrated(self):
+        self.assertIs(ReplicaRouter().allow_migrate('replica_1', 'users'), False)
+        self.assertIsNone(ReplicaRouter().allow_migrate('default', 'users'))
+
+    def test_invalidated_users_read_from_primary(self):
+        cache.clear()
+        invalidate(1, 2)
+        middleware = ReplicaPinMiddleware(lambda request: None)
+        request = RequestFactory().get('/api/users/requests/')
+        for user_id in (1, 2):
+            pinned_until = middleware.pinned_until(request, user_id)
+            read = self.route(lambda router: router.db_for_read(FriendRequest), pinned_until=pinned_until)[0]
+            self.assertEqual(read, 'default')
+        self.assertEqual(middleware.pinned_until(request, 3), 0)
+
+
+@skipUnless(settings.DATABASE_REPLICAS, 'needs replicas, for example DB_ENGINE=sqlite DB_SQLITE_REPLICAS=1')
+class ReplicaReadYourWritesTests(TransactionTestCase):
+    # every replica mirrors the default database in tests, the queries show where reads went; not a
+    # TestCase, reads inside its transaction would all stay on the primary
+    databases = {'default', *settings.DATABASE_REPLICAS}
+
+    def setUp(self):
+        self.sender, self.receiver, self.bystander = [
+            User.objects.create(email=f'pinned{i}@example.com', username=f'pinned{i}', is_active=True)
+            for i in range(3)]
+        # creating them pinned them
+        cache.clear()
+
+    def poll(self, user):
+        client = Client()
+        client.force_login(user)
+        with ExitStack() as stack:
+            replica_queries = [stack.enter_context(CaptureQueriesContext(connections[alias]))
+                               for alias in settings.DATABASE_REPLICAS]
+            response = client.get('/api/users/requests/')
+        self.assertEqual(response.status_code, 200)
+        return response.json(), sum(len(queries) for queries in replica_queries)
+
+    def test_both_parties_of_a_write_read_it_from_primary(self):
+        self.client.force_login(self.sender)
+        response = self.client.post('/api/users/requests/', {'receiver': self.receiver.id})
+        self.assertEqual(response.status_code, 201)
+        # the receiver wrote nothing, the cache entry their poll fills still has to come from the primary
+        data, replica_queries = self.poll(self.receiver)
+        self.assertEqual(replica_queries, 0)
+        self.assertEqual(data['count'], 1)
+        # users the write did not touch keep reading from the replicas
+        data, replica_queries = self.poll(self.bystander)
+        self.assertGreater(replica_queries, 0)
+        self.assertEqual(data['count'], 0)
+
+
+class FriendCounterTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(email=f'counter{i}@example.com', username=f'counter{i}', is_active=True)
+                     for i in range(3)]
+
+    def assertCountersMatch(self):
+        stored = {row.pop('id'): row for row in User.objects.values('id', *COUNTER_FIELDS)}
+        self.assertEqual(stored, actual_counts(list(stored)))
+
+    def test_counters_follow_friend_request_changes(self):
+        first, second, third = self.users
+        friend_request = FriendRequest.objects.create(sender=first, receiver=second)
+        self.assertCountersMatch()
+        friend_request.is_accepted = True
+        friend_request.save()
+        # saving a stale copy in the same state counts nothing twice
+        FriendRequest.objects.get(id=friend_request.id).save()
+        self.assertCountersMatch()
+        FriendRequest.objects.create(sender=third, receiver=first)
+        friend_request.is_cancelled = True
+        friend_request.save()
+        self.assertCountersMatch()
+        third.delete()
+        self.assertCountersMatch()
+        self.assertEqual(User.objects.values_list('pending_incoming_count', 'friend_count').get(id=first.id), (0, 0))
+
+    def test_recount_repairs_drift(self):
+        first, second, _ = self.users
+        FriendRequest.objects.create(sender=first, receiver=second)
+        User.objects.filter(id=first.id).update(pending_outgoing_count=5)
+        self.assertEqual([user.id for user in recount([first.id, second.id])], [first.id])
+        self.assertCountersMatch()
+
+
+class LargeTableAdminTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(email='admin@example.com', username='admin', is_active=True,
+                                        is_staff=True, is_superuser=True)
+        cls.users = [User.objects.create(email=f'member{i}@example.com', username=f'member{i}', is_active=True)
+                     for i in range(20)]
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def changelist_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/users/friendrequest/')
+        self.assertEqual(response.status_code, 200)
+        return len(queries.captured_queries)
+
+    def test_friend_request_changelist_query_count_is_constant(self):
+        FriendRequest.objects.create(sender=self.users[0], receiver=self.users[1])
+        few = self.changelist_queries()
+        for other in self.users[2:]:
+            FriendRequest.objects.create(sender=self.users[0], receiver=other)
+        self.assertEqual(self.changelist_queries(), few)
+
+    def test_cancel_action_keeps_counters(self):
+        ids = [FriendRequest.objects.create(sender=self.users[0], receiver=other).id for other in self.users[1:]]
+        response = self.client.post('/admin/users/friendrequest/',
+                                    {'action': 'cancel_friend_requests', '_selected_action': ids})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(FriendRequest.objects.filter(is_cancelled=True).count(), len(ids))
+        self.assertEqual(User.objects.values_list('pending_outgoing_count', flat=True).get(id=self.users[0].id), 0)
+
+
+class ConditionalGetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='poller@example.com', username='poller', is_active=True)
+        cls.friend = User.objects.create(email='friend@example.com', username='friend', is_active=True)
+        friend_request = FriendRequest.objects.create(sender=cls.user, receiver=cls.friend)
+        friend_request.is_accepted = True
+        friend_request.save()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_friend_list_answers_304_until_a_friend_changes(self):
+        url = f'/api/users/{self.user.id}/friends/'
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        self.friend.first_name = 'Renamed'
+        self.friend.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['first_name'], 'Renamed')
+
+    def test_user_detail_answers_if_modified_since(self):
+        url = f'/api/users/{self.friend.id}/'
+        last_modified = self.client.get(url)['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+    def test_friend_request_detail(self):
+        friend_request = FriendRequest.objects.get(sender=self.user)
+        url = f'/api/users/requests/{friend_request.id}'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.client.get(f'/api/users/requests/{friend_request.id + 1000}')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'detail': 'Not found.'})
+
+
+delivered_events = []
+
+
+def collect_events(events):
+    delivered_events.extend((event.event_type, event.aggregate_id) for event in events)
+
+
+def failing_handler(events):
+    raise RuntimeError('handler down')
+
+
+def failing_on_odd_aggregates(events):
+    if any(event.aggregate_id % 2 for event in events):
+        raise RuntimeError('odd aggregate')
+    collect_events(events)
+
+
+@override_settings(USERS_OUTBOX_MAX_ATTEMPTS=3)
+class OutboxTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create(email='outbox-sender@example.com', username='outbox-sender', is_active=True)
+        cls.receiver = User.objects.create(email='outbox-receiver@example.com', username='outbox-receiver',
+                                           is_active=True)
+
+    def setUp(self):
+        delivered_events.clear()
+
+    def test_friend_request_changes_are_delivered_in_order(self):
+        friend_request = FriendRequest.objects.create(sender=self.sender, receiver=self.receiver)
+        friend_request.is_accepted = True
+        friend_request.save()
+        friend_request.save()
+        friend_request_id = friend_request.id
+        friend_request.delete()
+
+        self.assertEqual(drain('collector', collect_events, batch_size=2), 2)
+        self.assertEqual(drain('collector', collect_events, batch_size=2), 1)
+        self.assertEqual(drain('collector', collect_events, batch_size=2), 0)
+        self.assertEqual(delivered_events, [('created', friend_request_id), ('accepted', friend_request_id),
+                                            ('deleted', friend_request_id)])
+
+    def test_failed_batch_is_retried_without_moving_the_position(self):
+        FriendRequest.objects.create(sender=self.sender, receiver=self.receiver)
+        self.assertEqual(drain('flaky', failing_handler), 0)
+        consumer = OutboxConsumer.objects.get(name='flaky')
+        self.assertEqual((consumer.position, consumer.attempts), (0, 1))
+        self.assertIsNotNone(consumer.retry_at)
+
+        OutboxConsumer.objects.filter(name='flaky').update(retry_at=None)
+        self.assertEqual(drain('flaky', collect_events), 1)
+        consumer.refresh_from_db()
+        self.assertEqual((consumer.position, consumer.attempts), (OutboxEvent.objects.get().id, 0))
+
+    def event(self, aggregate_id, **kwargs):
+        return OutboxEvent.objects.create(topic='friend_request', event_type='created', aggregate_id=aggregate_id,
+                                          payload={}, **kwargs)
+
+    def test_event_committed_after_a_higher_id_is_still_delivered(self):
+        self.event(1)
+        late_id = self.event(2).id
+        last = self.event(3)
+        # not committed yet when the consumer reads
+        OutboxEvent.objects.filter(id=late_id).delete()
+        self.assertEqual(drain('collector', collect_events), 2)
+        consumer = OutboxConsumer.objects.get(name='collector')
+        self.assertEqual((consumer.position, list(consumer.gaps)), (last.id, [str(late_id)]))
+
+        # committed late, and with a created_on from when it was written
+        self.event(2, id=late_id, created_on=timezone.now() - timedelta(minutes=10))
+        self.assertEqual(drain('collector', collect_events), 1)
+        self.assertEqual(drain('collector', collect_events), 0)
+        self.assertEqual(delivered_events, [('created', 1), ('created', 3), ('created', 2)])
+        consumer.refresh_from_db()
+        self.assertEqual((consumer.position, consumer.gaps), (last.id, {}))
+
+    @override_settings(USERS_OUTBOX_GAP_SECONDS=0)
+    def test_gaps_are_given_up_on_after_the_gap_delay(self):
+        self.event(1)
+        self.event(2).delete()
+        self.event(3)
+        self.assertEqual(drain('collector', collect_events), 2)
+        self.assertEqual(OutboxConsumer.objects.get(name='collector').gaps, {})
+
+    def test_handler_runs_under_a_claim(self):
+        self.event(1)
+        seen = []
+
+        def handler(events):
+            consumer = OutboxConsumer.objects.get(name='claimed')
+            seen.append(bool(consumer.claimed_by and consumer.claimed_until))
+            # a second worker of the consumer finds the batch claimed instead of waiting on a lock
+            seen.append(drain('claimed', collect_events))
+
+        self.assertEqual(drain('claimed', handler), 1)
+        self.assertEqual(seen, [True, 0])
+        consumer = OutboxConsumer.objects.get(name='claimed')
+        self.assertEqual((consumer.claimed_by, consumer.claimed_until), ('', None))
+
+    def test_expired_claim_is_taken_over(self):
+        event = self.event(1)
+        consumer, events = claim('slow', 10)
+        OutboxConsumer.objects.filter(name='slow').update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(drain('slow', collect_events), 1)
+        # the slow worker finishing late does not record anything
+        self.assertEqual(release(consumer, events, None, []), 0)
+        self.assertEqual(OutboxConsumer.objects.get(name='slow').position, event.id)
+        self.assertEqual(delivered_events, [('created', 1)])
+
+    def test_events_still_failing_after_the_last_attempt_are_dead_lettered(self):
+        events = [self.event(aggregate_id) for aggregate_id in (1, 2, 3)]
+        for _ in range(2):
+            OutboxConsumer.objects.filter(name='picky').update(retry_at=None)
+            self.assertEqual(drain('picky', failing_on_odd_aggregates), 0)
+        OutboxConsumer.objects.filter(name='picky').update(retry_at=None)
+        with self.assertLogs('users.outbox', 'ERROR'):
+            self.assertEqual(drain('picky', failing_on_odd_aggregates), 3)
+        self.assertEqual(sorted(OutboxDeadLetter.objects.filter(consumer='picky').values_list('event_id', flat=True)),
+                         [events[0].id, events[2].id])
+        self.assertEqual(delivered_events, [('created', 2)])
+        consumer = OutboxConsumer.objects.get(name='picky')
+        self.assertEqual((consumer.position, consumer.attempts, consumer.retry_at), (events[2].id, 0, None))
+
+
+@override_settings(USERS_FRIEND_REQUEST_RETENTION={'cancelled': 30, 'expired': 180})
+class FriendRequestArchiveTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='archiver@example.com', username='archiver', is_active=True)
+        cls.others = [User.objects.create(email=f'archived{i}@example.com', username=f'archived{i}', is_active=True)
+                      for i in range(4)]
+
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        first, second, third, fourth = self.others
+        self.cancelled = FriendRequest.objects.create(sender=self.user, receiver=first, is_cancelled=True)
+        self.expired = FriendRequest.objects.create(sender=self.user, receiver=second)
+        self.accepted = FriendRequest.objects.create(sender=self.user, receiver=third, is_accepted=True)
+        self.recent = FriendRequest.objects.create(sender=fourth, receiver=self.user, is_cancelled=True)
+        FriendRequest.objects.filter(id__in=[self.cancelled.id, self.accepted.id]).update(
+            modified_on=now - timedelta(days=60), created_on=now - timedelta(days=400))
+        FriendRequest.objects.filter(id=self.expired.id).update(created_on=now - timedelta(days=200))
+
+    def archive(self, *args):
+        out = StringIO()
+        call_command('archive_friend_requests', *args, batch_size=1, stdout=out)
+        return out.getvalue()
+
+    def test_dry_run_only_counts(self):
+        self.assertIn('would archive 2 friend requests', self.archive('--dry-run'))
+        self.assertEqual(FriendRequest.objects.count(), 4)
+        self.assertFalse(ArchivedFriendRequest.objects.exists())
+
+    def test_cancelled_and_expired_requests_are_moved(self):
+        self.archive()
+        self.assertEqual(sorted(FriendRequest.objects.values_list('id', flat=True)), [self.accepted.id, self.recent.id])
+        self.assertEqual(dict(ArchivedFriendRequest.objects.values_list('id', 'reason')),
+                         {self.cancelled.id: 'cancelled', self.expired.id: 'expired'})
+        stored = {row.pop('id'): row for row in User.objects.values('id', *COUNTER_FIELDS)}
+        self.assertEqual(stored, actual_counts(list(stored)))
+        self.assertEqual(OutboxEvent.objects.filter(event_type='archived').count(), 2)
+
+    def test_edges_of_an_archived_request_are_deleted(self):
+        # cancelled through a queryset update, which left the friendship edges of the accepted state
+        FriendRequest.objects.filter(id=self.accepted.id).update(is_cancelled=True)
+        self.assertEqual(Friendship.objects.filter(friend_request=self.accepted).count(), 2)
+        OutboxEvent.objects.all().delete()
+        self.archive()
+        self.assertEqual(ArchivedFriendRequest.objects.get(id=self.accepted.id).reason, 'cancelled')
+        self.assertFalse(Friendship.objects.filter(friend_request_id=self.accepted.id).exists())
+        stored = {row.pop('id'): row for row in User.objects.values('id', *COUNTER_FIELDS)}
+        self.assertEqual(stored, actual_counts(list(stored)))
+        self.assertEqual(stored[self.user.id]['friend_count'], 0)
+        self.assertEqual(list(OutboxEvent.objects.values_list('event_type', flat=True).distinct()), ['archived'])
+
+    def test_archived_cancelled_pair_stays_taken(self):
+        self.archive()
+        self.client.force_login(self.user)
+        response = self.client.post('/api/users/requests/', {'receiver': self.others[0].id})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/users/requests/bulk/', {'action': 'create', 'receivers': [self.others[0].id]},
+                                    content_type='application/json')
+        self.assertEqual(response.json()['results'][0]['status'], 'error')
+        # an expired request can be sent again
+        response = self.client.post('/api/users/requests/', {'receiver': self.others[1].id})
+        self.assertEqual(response.status_code, 201)
+
+
+@override_settings(USERS_EVENTS_POLL_SECONDS=0.05, USERS_EVENTS_MAX_SECONDS=1, USERS_EVENTS_HEARTBEAT_SECONDS=1)
+class FriendRequestEventStreamTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='listener@example.com', username='listener', is_active=True)
+        cls.senders = [User.objects.create(email=f'sender{i}@example.com', username=f'sender{i}', is_active=True)
+                       for i in range(3)]
+
+    async def test_stream_replays_missed_events_and_pushes_new_ones(self):
+        missed = await FriendRequest.objects.acreate(sender=self.senders[0], receiver=self.user)
+        await FriendRequest.objects.acreate(sender=self.user, receiver=self.senders[1])
+        await sync_to_async(self.async_client.force_login)(self.user)
+        response = await self.async_client.get('/api/users/requests/events/', headers={'Last-Event-ID': '0'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        events = []
+        async for chunk in response.streaming_content:
+            events += [line for line in chunk.decode().splitlines() if line.startswith('data:')]
+            if len(events) == 1:
+                pushed = await FriendRequest.objects.acreate(sender=self.senders[2], receiver=self.user)
+        self.assertEqual(len(events), 2)
+        self.assertIn(f'/requests/{missed.id}"', events[0])
+        self.assertIn(f'/requests/{pushed.id}"', events[1])
+
+        # the poller stops with the last stream of the process
+        await self.assert_hub_stopped()
+
+    async def assert_hub_stopped(self):
+        for _ in range(20):
+            if get_hub().task is None:
+                break
+            await asyncio.sleep(0.05)
+        self.assertIsNone(get_hub().task)
+
+    async def read_events(self, response, on_event=None):
+        # (id, data) of the friend request events of a stream, until it ends
+        events = []
+        async for chunk in response.streaming_content:
+            lines = chunk.decode().splitlines()
+            if 'event: friend_request' in lines:
+                events.append((lines[0].removeprefix('id: '), lines[2]))
+                if on_event:
+                    await on_event(len(events))
+        return events
+
+    async def publish(self, event_id, friend_request_id):
+        event = friend_request_event(FriendRequest(id=friend_request_id, sender=self.senders[0], receiver=self.user),
+                                     'created')
+        event.id = event_id
+        await event.asave()
+
+    async def test_lower_id_committed_after_a_higher_one_is_streamed_and_resumed(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        base = await OutboxEvent.objects.order_by('-id').values_list('id', flat=True).afirst() or 0
+        low, high = base + 5, base + 10
+        await self.publish(high, 9002)
+        response = await self.async_client.get('/api/users/requests/events/')
+
+        async def commit_low(count):
+            if count == 1:
+                await self.publish(low, 9001)
+
+        events = await self.read_events(response, commit_low)
+        self.assertEqual(len(events), 2)
+        self.assertIn('/requests/9002"', events[0][1])
+        self.assertIn('/requests/9001"', events[1][1])
+        # the cursor sent with the higher id stays below the lower one, which was not settled yet
+        floor, _, ids = events[0][0].partition(':')
+        self.assertLess(int(floor), low)
+        self.assertEqual(ids, str(high))
+        await self.assert_hub_stopped()
+
+        # a client that lost the connection right after the higher id gets the lower one, and only it
+        response = await self.async_client.get('/api/users/requests/events/', headers={'Last-Event-ID': events[0][0]})
+        events = await self.read_events(response)
+        self.assertEqual(len(events), 1)
+        self.assertIn('/requests/9001"', events[0][1])
+        self.assertEqual(events[0][0], f'{floor}:{low},{high}')
+
+    async def test_stream_rejects_a_malformed_cursor(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        response = await self.async_client.get('/api/users/requests/events/', headers={'Last-Event-ID': '12:x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class StartupBudgetTests(SimpleTestCase):
+
+    def test_api_profile_starts_within_budget(self):
+        # best of three fresh workers, a busy machine only makes single runs slower
+        runs = [measure('socialapp.settings.api', env={'DB_ENGINE': 'sqlite'}) for _ in range(3)]
+        self.assertEqual({run['status'] for run in runs}, {200})
+        self.assertFalse(any(run['admin'] for run in runs))
+        self.assertLessEqual(min(run['seconds'] for run in runs), STARTUP_BUDGET['seconds'])
+        self.assertLessEqual(min(run['rss_mb'] for run in runs), STARTUP_BUDGET['rss_mb'])
+        self.assertLessEqual(max(run['modules'] for run in runs), STARTUP_BUDGET['modules'])
@@ -1,15 +1,192 @@
-from rest_framework.throttling import SimpleRateThrottle
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+from django.db.models import FloatField
+from django.db.models import Value
+from django.db.models.functions import Greatest
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import ValidationError
+from rest_framework.throttling import BaseThrottle
+from .models import ThrottleBucket
 
-class FriendRequestThrottle(SimpleRateThrottle):
-    scope = 'friend_request'
+# Generic cell rate algorithm (GCRA), the token bucket expressed as a single number per key: the
+# theoretical arrival time (tat). A limit of `rate` with `burst` lets a caller spend up to `burst`
+# requests at once, refilled at one per emission interval (period / rate). A request of cost c is
+# allowed when max(tat, now) + c * interval - now <= burst * interval, and then moves tat forward.
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    num, period = rate.split('/')
+    return int(num), PERIODS[period[0]]
+
+
+class DatabaseBucketStore:
+    # One row per key, updated by a single conditional UPDATE so concurrent workers never
+    # read-modify-write the same bucket. Works with nothing but the default database.
+
+    def consume(self, key, increment, limit, now):
+        if increment > limit:
+            return False, None
+        for _ in range(2):
+            allowed = ThrottleBucket.objects.filter(key=key, tat__lte=now + limit - increment).update(
+                tat=Greatest(F('tat'), Value(now, output_field=FloatField())) + increment
+            )
+            if allowed:
+                return True, 0
+            tat = ThrottleBucket.objects.filter(key=key).values_list('tat', flat=True).first()
+            if tat is not None:
+                return False, max(tat + increment - limit - now, 0)
+            try:
+                with transaction.atomic():
+                    ThrottleBucket.objects.create(key=key, tat=now + increment)
+                return True, 0
+            except IntegrityError:
+                # another worker created the bucket first, go through the conditional update again
+                continue
+        return False, 0
+
+    def refund(self, key, increment):
+        ThrottleBucket.objects.filter(key=key).update(tat=F('tat') - increment)
+
+    def prune(self, now):
+        return ThrottleBucket.objects.filter(tat__lt=now).delete()[0]
+
+
+class LocalMemoryBucketStore:
+    # Per-process buckets, only meant for tests and single process development servers.
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def consume(self, key, increment, limit, now):
+        if increment > limit:
+            return False, None
+        with self.lock:
+            tat = self.buckets.get(key, now)
+            if tat > now + limit - increment:
+                return False, tat + increment - limit - now
+            self.buckets[key] = max(tat, now) + increment
+            return True, 0
+
+    def refund(self, key, increment):
+        with self.lock:
+            if key in self.buckets:
+                self.buckets[key] -= increment
+
+    def prune(self, now):
+        with self.lock:
+            expired = [key for key, tat in self.buckets.items() if tat < now]
+            for key in expired:
+                del self.buckets[key]
+            return len(expired)
+
+
+_stores = {}
+
+
+def get_bucket_store():
+    path = getattr(settings, 'THROTTLE_BUCKET_STORE', 'users.throttler.DatabaseBucketStore')
+    if path not in _stores:
+        _stores[path] = import_string(path)()
+    return _stores[path]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    # Limits per scope come from THROTTLE_BUCKETS, for example
+    #   'login': [{'rate': '10/minute', 'burst': 5}, {'rate': '100/day', 'burst': 20}]
+    # where every entry is its own bucket and a request has to fit in all of them.
+    scope = None
+    timer = time.time
+    # a request costing more than the smallest burst could never be let through, it gets a 400 instead
+    cost_exceeded_message = 'This request counts as {cost} against a limit of {burst} at once.'
+
+    def __init__(self):
+        self.retry_after = None
+
+    def get_limits(self):
+        config = getattr(settings, 'THROTTLE_BUCKETS', {}).get(self.scope)
+        if config is None:
+            raise ImproperlyConfigured(f"No THROTTLE_BUCKETS entry for scope '{self.scope}'")
+        if isinstance(config, dict):
+            config = [config]
+        limits = []
+        for limit in config:
+            num, period = parse_rate(limit['rate'])
+            interval = period / num
+            limits.append((limit['rate'], interval, limit.get('burst', num) * interval))
+        return limits
 
     def get_cache_key(self, request, view):
+        # one bucket per user, anonymous callers by client address
         if request.user.is_authenticated:
-            return f"{self.scope}:{request.user.id}"
-        else:
-            return self.get_ident(request)
+            return f"{request.user.id}"
+        return self.get_ident(request)
+
+    def get_cost(self, request, view):
+        return 1
 
     def allow_request(self, request, view):
-        if request.method == 'GET':
+        cost = self.get_cost(request, view)
+        if cost <= 0:
             return True
-        return super().allow_request(request, view)
\ No newline at end of file
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        limits = self.get_limits()
+        burst = min(round(limit / interval) for _, interval, limit in limits)
+        if cost > burst:
+            raise ValidationError(self.cost_exceeded_message.format(cost=cost, burst=burst))
+
+        store = get_bucket_store()
+        now = self.timer()
+        consumed = []
+        for rate, interval, limit in limits:
+            bucket_key = f'{self.scope}:{rate}:{key}'
+            allowed, retry_after = store.consume(bucket_key, cost * interval, limit, now)
+            if not allowed:
+                for consumed_key, increment in consumed:
+                    store.refund(consumed_key, increment)
+                self.retry_after = retry_after
+                return False
+            consumed.append((bucket_key, cost * interval))
+        return True
+
+    def wait(self):
+        return self.retry_after
+
+
+class FriendRequestThrottle(TokenBucketThrottle):
+    scope = 'friend_request'
+    cost_exceeded_message = 'At most {burst} friend requests can be sent at once, this request sends {cost}.'
+
+    def get_cost(self, request, view):
+        if request.method == 'GET':
+            return 0
+        # bulk views count every friend request they send, not just the call
+        if hasattr(view, 'get_throttle_cost'):
+            return view.get_throttle_cost(request)
+        return 1
+
+
+class AnonymousPostThrottle(TokenBucketThrottle):
+    # keyed on the client address, for endpoints used before there is a user
+
+    def get_cache_key(self, request, view):
+        return self.get_ident(request)
+
+    def get_cost(self, request, view):
+        return 1 if request.method == 'POST' else 0
+
+
+class LoginThrottle(AnonymousPostThrottle):
+    scope = 'login'
+
+
+class RegisterThrottle(AnonymousPostThrottle):
+    scope = 'register'
@@ -1,20 +1,44 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework import routers
 from .views import SignUpAPIView
 from .views import LoginAPIView, LogoutAPIView
 from .views import FriendListAPIView, UserAPIView, UserListAPIView, APIBaseView, FriendRequestAPIView, FriendRequestDetailAPIView
+from .views import FriendSuggestionsAPIView, MutualFriendsAPIView
+from .views import CacheStatsAPIView, FriendRequestBulkAPIView, MetricsAPIView, ExportAPIView
+from .async_views import AsyncUserListAPIView, AsyncUserAPIView
+from .async_views import AsyncFriendListAPIView, AsyncFriendRequestAPIView
+from .async_views import FriendRequestEventStreamView
 #
 # router = routers.DefaultRouter()
 # router.register(r'', FriendsAPIView)
 
-urlpatterns = [
-    path('register/', SignUpAPIView.as_view(), name='register'),
-    path('login/', LoginAPIView.as_view(), name='login'),
-    path('logout/', LogoutAPIView.as_view(), name='logout'),
-    path('', APIBaseView.as_view(), name='root'),
-    path('users/', UserListAPIView.as_view(), name='user-list'),
-    path('users/<int:pk>/', UserAPIView.as_view(), name='user-detail'),
-    path('users/<int:pk>/friends/', FriendListAPIView.as_view(), name='friend-list'),
-    path('users/requests/', FriendRequestAPIView.as_view(), name='friend-create'),
-    path('users/requests/<int:pk>',FriendRequestDetailAPIView.as_view(), name='friendrequest-detail'),
-]
\ No newline at end of file
+def build_urlpatterns(async_views=False):
+    # async_views swaps the four read endpoints for their native async versions (users/async_views.py)
+    if async_views:
+        user_list, user_detail = AsyncUserListAPIView, AsyncUserAPIView
+        friend_list, friend_requests = AsyncFriendListAPIView, AsyncFriendRequestAPIView
+    else:
+        user_list, user_detail = UserListAPIView, UserAPIView
+        friend_list, friend_requests = FriendListAPIView, FriendRequestAPIView
+    return [
+        path('register/', SignUpAPIView.as_view(), name='register'),
+        path('login/', LoginAPIView.as_view(), name='login'),
+        path('logout/', LogoutAPIView.as_view(), name='logout'),
+        path('', APIBaseView.as_view(), name='root'),
+        path('users/', user_list.as_view(), name='user-list'),
+        path('users/<int:pk>/', user_detail.as_view(), name='user-detail'),
+        path('users/<int:pk>/friends/', friend_list.as_view(), name='friend-list'),
+        path('users/<int:pk>/suggestions/', FriendSuggestionsAPIView.as_view(), name='friend-suggestions'),
+        path('users/<int:pk>/mutual/<int:other_pk>/', MutualFriendsAPIView.as_view(), name='mutual-friends'),
+        path('users/<int:pk>/export/<str:kind>/', ExportAPIView.as_view(), name='user-export'),
+        path('users/requests/', friend_requests.as_view(), name='friend-create'),
+        path('users/requests/bulk/', FriendRequestBulkAPIView.as_view(), name='friend-request-bulk'),
+        path('users/requests/events/', FriendRequestEventStreamView.as_view(), name='friend-request-events'),
+        path('users/requests/<int:pk>',FriendRequestDetailAPIView.as_view(), name='friendrequest-detail'),
+        path('cache/stats/', CacheStatsAPIView.as_view(), name='cache-stats'),
+        path('metrics/', MetricsAPIView.as_view(), name='metrics'),
+    ]
+
+
+urlpatterns = build_urlpatterns(getattr(settings, 'USERS_ASYNC_VIEWS', False))
@@ -1,24 +1,64 @@
 from django.contrib.auth import logout
+from django.db import transaction
 from django.db.models import Q
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import permissions
 from rest_framework import generics
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework import filters
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import ValidationError
 from rest_framework.reverse import reverse
 from .models import User
 from .models import FriendRequest
+from .models import ArchivedFriendRequest
+from .authentication import issue_token
+from .authentication import revoke_tokens
 from .throttler import FriendRequestThrottle
+from .throttler import LoginThrottle
+from .throttler import RegisterThrottle
+from .cache import cache_stats
+from .cache import cached_response_data
+from .conditional import friend_list_etag
+from .conditional import friend_list_state
+from .conditional import friend_request_etag
+from .conditional import not_modified
+from .conditional import set_validators
+from .conditional import user_etag
+from .export import EXPORT_FORMATS
+from .export import USER_EXPORTS
+from .export import aexport_chunks
+from .export import export_chunks
+from .graph import friend_suggestions
+from .graph import mutual_friends
+from .metrics import registry
+from .outbox import EVENT_ACCEPTED
+from .outbox import EVENT_REJECTED
+from .pagination import ClampedPageNumberPagination
+from .pagination import clamp_page_size
+from .pagination import KeysetPagination
+from .pagination import wants_cursor_pagination
+from .search import get_search_backend
+from .signals import friend_requests_bulk_changed
 from .serializers import UserSerializer
 from .serializers import FriendRequestSerializer
+from .serializers import FriendRequestRowSerializer
+from .serializers import FriendRequestBulkSerializer
+from .serializers import UserRowSerializer
 from .serializers import UserLoginSerializer
 from .serializers import UserLogoutSerializer
 
 
 class SignUpAPIView(APIView):
     serializer_class = UserSerializer
+    throttle_classes = [RegisterThrottle]
     queryset = User.objects.all()
 
     def post(self, request):
@@ -34,6 +74,7 @@ class SignUpAPIView(APIView):
 
 class LoginAPIView(APIView):
     serializer_class = UserLoginSerializer
+    throttle_classes = [LoginThrottle]
 
     def post(self, request, *args, **kwargs):
         context = {
@@ -43,17 +84,25 @@ class LoginAPIView(APIView):
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
         serializer = UserSerializer(user, context=context)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        # for API clients, sent as "Authorization: Token <token>" instead of the session cookie
+        data = dict(serializer.data, token=issue_token(user))
+        return Response(data, status=status.HTTP_200_OK)
 
 class LogoutAPIView(APIView):
     serializer_class = UserLogoutSerializer
     def post(self, request, *args, **kwargs):
         if request.user.is_authenticated:
+            revoke_tokens(request.user)
             logout(request)
             return Response({'message': 'User logged out'}, status=status.HTTP_204_NO_CONTENT)
 
 class APIBaseView(APIView):
     def get(self, request, format=None):
+        user_id = request.user.id if request.user.is_authenticated else 0
+        data = cached_response_data('root', user_id, request, lambda: self.links(request, format))
+        return Response(data, status=status.HTTP_200_OK)
+
+    def links(self, request, format=None):
         kwargs = {
             'pk': request.user.id,
         }
@@ -69,41 +118,53 @@ class APIBaseView(APIView):
                 'login': reverse('login', request=request, format=format),
                 'register': reverse('register', request=request, format=format),
             }
-        return Response(data, status=status.HTTP_200_OK)
+        return data
+
+
+class MetricsAPIView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class CacheStatsAPIView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(cache_stats(), status=status.HTTP_200_OK)
 
 class UserListAPIView(generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [RegisterThrottle]
     filter_backends = [filters.SearchFilter]
     search_fields = ['email', 'first_name', 'last_name']
-    pagination_class = PageNumberPagination
-    display_edit_forms = True
+    pagination_class = ClampedPageNumberPagination
     serializer_class = UserSerializer
     queryset = User.objects.all()
 
     def get(self, request, *args, **kwargs):
         # http://127.0.0.1:8000/api/users/?search=shahid&page_size=5
-        users = User.objects.all().exclude(id=request.user.id).order_by('-created_on')
+        # http://127.0.0.1:8000/api/users/?search=shahid&paginate=cursor
+        users = self.user_queryset(request)
 
         search_query = request.query_params.get('search', '').strip().lower()
-        page_size = request.query_params.get('page_size', 10)
         if search_query:
-            email_exacting_users = users.filter(email__iexact=search_query)
-            if email_exacting_users.exists():
-                users = email_exacting_users
-            else:
-                db_search_query = Q(email__icontains=search_query) | Q(first_name__icontains=search_query) | Q(last_name__icontains=search_query)
-                users = users.filter(db_search_query)
+            users = get_search_backend().search(users, search_query)
 
-        paginator = self.pagination_class()
-        paginator.page_size = page_size
+        users = users.values(*UserRowSerializer.values_fields)
+        paginator = KeysetPagination() if wants_cursor_pagination(request) else self.pagination_class()
         page = paginator.paginate_queryset(users, request)
         context = {
             'request': request,
-            'display_edit_forms': True
         }
-        serializer = UserSerializer(page, context=context, many=True)
+        serializer = UserRowSerializer(page, context=context)
         return paginator.get_paginated_response(serializer.data)
 
+    @staticmethod
+    def user_queryset(request):
+        return User.objects.all().exclude(id=request.user.id).order_by('-created_on', '-id')
+
     def post(self, request, *args, **kwargs):
         context = {
             'request': request
@@ -120,26 +181,115 @@ class UserAPIView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = UserSerializer
     queryset = User.objects.all()
     def get(self, request, *args, **kwargs):
-        user = User.objects.get(id=kwargs.get('pk'))
+        user = get_object_or_404(User, id=kwargs.get('pk'))
+        etag = user_etag(request, user)
+        response = not_modified(request, etag, user.modified_on)
+        if response is not None:
+            return response
         context = {
             'request': request,
         }
         serializer = UserSerializer(user, context=context)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return set_validators(Response(serializer.data, status=status.HTTP_200_OK), etag, user.modified_on)
 
 
 class FriendListAPIView(APIView):
     login_url = '/users/login/'
     redirect_field_name = 'next'
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = ClampedPageNumberPagination
 
     def get(self, request, *args, **kwargs):
-        friends = request.user.friends()
+        # polled constantly by the mobile clients, most polls end at the aggregate query with a 304
+        etag = friend_list_etag(request, friend_list_state(request.user))
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+        data = cached_response_data('friend-list', request.user.id, request, lambda: self.list_friends(request),
+                                    variant=etag)
+        return set_validators(Response(data, status=status.HTTP_200_OK), etag)
+
+    def list_friends(self, request):
+        friends = request.user.friends().values(*UserRowSerializer.values_fields)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(friends, request)
         context = {
             'request': request,
         }
-        serializer = UserSerializer(friends, context=context, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        serializer = UserRowSerializer(page, context=context)
+        return paginator.get_paginated_response(serializer.data).data
+
+
+class FriendSuggestionsAPIView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        # http://localhost:8000/api/users/1/suggestions/?limit=10
+        user_id = kwargs.get('pk')
+        if user_id != request.user.id and not request.user.is_staff:
+            raise PermissionDenied('You can only see your own friend suggestions.')
+        limit = clamp_page_size(request.query_params.get('limit'))
+        ranked = friend_suggestions(user_id, limit)
+        users = User.objects.filter(id__in=[suggested_id for suggested_id, _ in ranked])
+        rows = {row['id']: row for row in users.values(*UserRowSerializer.values_fields)}
+        rows = [dict(rows[suggested_id], mutual_friends=count) for suggested_id, count in ranked if suggested_id in rows]
+        context = {
+            'request': request,
+        }
+        data = UserRowSerializer(rows, context=context).data
+        for item, row in zip(data, rows):
+            item['mutual_friends'] = row['mutual_friends']
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class MutualFriendsAPIView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = ClampedPageNumberPagination
+
+    def get(self, request, *args, **kwargs):
+        # http://localhost:8000/api/users/1/mutual/2/
+        user_id = kwargs.get('pk')
+        other_id = kwargs.get('other_pk')
+        if request.user.id not in (user_id, other_id) and not request.user.is_staff:
+            raise PermissionDenied('You can only see the friends you have in common with someone.')
+        if user_id == other_id:
+            # a user has every friend in common with themselves
+            raise ValidationError({'other_pk': ['Choose a user other than pk.']})
+        friend_ids = mutual_friends(user_id, other_id)
+        users = User.objects.filter(id__in=friend_ids).order_by('id').values(*UserRowSerializer.values_fields)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(users, request)
+        context = {
+            'request': request,
+        }
+        serializer = UserRowSerializer(page, context=context)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class ExportAPIView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        # http://localhost:8000/api/users/1/export/friends/?output=csv
+        # http://localhost:8000/api/users/1/export/friend-requests/
+        user_id = kwargs.get('pk')
+        if user_id != request.user.id and not request.user.is_staff:
+            raise PermissionDenied('You can only export your own data.')
+        kind = kwargs.get('kind')
+        if kind not in USER_EXPORTS:
+            raise NotFound(f'Unknown export, choose one of {", ".join(USER_EXPORTS)}.')
+        export_format = request.query_params.get('output', 'ndjson').strip().lower()
+        if export_format not in EXPORT_FORMATS:
+            raise ValidationError({'output': [f'Choose one of {", ".join(EXPORT_FORMATS)}.']})
+
+        # under ASGI the rows are read through the async ORM, so the stream does not hold a thread
+        if isinstance(request._request, ASGIRequest):
+            chunks = aexport_chunks(kind, export_format, user_id)
+        else:
+            chunks = export_chunks(kind, export_format, user_id)
+        response = StreamingHttpResponse(chunks, content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = f'attachment; filename="user-{user_id}-{kind}.{export_format}"'
+        return response
 
 
 class FriendRequestDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
@@ -149,7 +299,6 @@ class FriendRequestDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
-        print(self.request.method)
         if self.request.method in ['GET', 'PUT', 'PATCH']:
             context['read_only_fields'] = []
         else:
@@ -163,12 +312,17 @@ class FriendRequestDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
         return FriendRequestSerializer(*args, **kwargs)
 
     def get(self, request, *args, **kwargs):
-        friend_request = FriendRequest.objects.get(id=kwargs.get('pk'))
+        friend_request = get_object_or_404(FriendRequest, id=kwargs.get('pk'))
+        etag = friend_request_etag(request, friend_request)
+        response = not_modified(request, etag, friend_request.modified_on)
+        if response is not None:
+            return response
         context = {
             'request': request,
         }
         serializer = FriendRequestSerializer(friend_request, context=context)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return set_validators(Response(serializer.data, status=status.HTTP_200_OK), etag,
+                              friend_request.modified_on)
 
     def partial_update(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -189,9 +343,26 @@ class FriendRequestAPIView(generics.ListCreateAPIView):
     queryset = FriendRequest.objects.all().order_by('-created_on')
     serializer_class = FriendRequestSerializer
     throttle_classes = [FriendRequestThrottle]
+    pagination_class = ClampedPageNumberPagination
 
     def get(self, request, *args, **kwargs):
         # http://localhost:8000/api/users/friends/?state=accepted
+        data = cached_response_data('friend-requests', request.user.id, request,
+                                    lambda: self.list_friend_requests(request))
+        return Response(data, status=status.HTTP_200_OK)
+
+    def list_friend_requests(self, request):
+        friend_requests = self.friend_request_queryset(request)
+        paginator = KeysetPagination() if wants_cursor_pagination(request) else self.pagination_class()
+        page = paginator.paginate_queryset(friend_requests, request)
+        context = {
+            'request': request,
+        }
+        serializer = FriendRequestRowSerializer(page, context=context)
+        return paginator.get_paginated_response(serializer.data).data
+
+    @staticmethod
+    def friend_request_queryset(request):
         state_query = request.query_params.get('state', '').strip().lower()
         query = Q(sender=request.user) | Q(receiver=request.user)
         if state_query == 'pending':
@@ -200,14 +371,7 @@ class FriendRequestAPIView(generics.ListCreateAPIView):
             friend_requests = FriendRequest.objects.filter(query, is_accepted=True)
         else:
             friend_requests = FriendRequest.objects.filter(query)
-        print(query)
-        paginator = self.pagination_class()
-        page = paginator.paginate_queryset(friend_requests, request)
-        context = {
-            'request': request,
-        }
-        serializer = FriendRequestSerializer(page, context=context, many=True)
-        return paginator.get_paginated_response(serializer.data)
+        return friend_requests.order_by('-created_on', '-id').values(*FriendRequestRowSerializer.values_fields)
 
     def post(self, request, *args, **kwargs):
         context = {
@@ -220,6 +384,116 @@ class FriendRequestAPIView(generics.ListCreateAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class FriendRequestBulkAPIView(APIView):
+    # Create, accept or reject up to FRIEND_REQUEST_BULK_MAX friend requests in one call.
+    # All items are validated with set-based queries, written in one transaction, and reported
+    # back one result per item. Created requests count against FriendRequestThrottle one by one, a
+    # create with more receivers than its burst is rejected with a 400.
+    permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [FriendRequestThrottle]
+    serializer_class = FriendRequestBulkSerializer
 
+    def get_throttle_cost(self, request):
+        data = request.data if isinstance(request.data, dict) else {}
+        receivers = data.get('receivers')
+        if data.get('action') != 'create' or not isinstance(receivers, list):
+            return 0
+        return len(set(map(str, receivers)))
 
+    def post(self, request, *args, **kwargs):
+        # http://localhost:8000/api/users/requests/bulk/ {"action": "create", "receivers": [2, 3]}
+        # http://localhost:8000/api/users/requests/bulk/ {"action": "accept", "requests": [7, 8]}
+        serializer = self.serializer_class(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        action = serializer.validated_data['action']
+        ids = serializer.validated_data['ids']
+        if action == 'create':
+            results = self.create_requests(request, ids)
+        else:
+            results = self.answer_requests(request, ids, accept=action == 'accept')
+        return Response({'action': action, 'results': results}, status=status.HTTP_200_OK)
+
+    def create_requests(self, request, receiver_ids):
+        sender = request.user
+        existing_users = set(User.objects.filter(id__in=receiver_ids).values_list('id', flat=True))
+        pairs = FriendRequest.objects.filter(
+            Q(sender=sender, receiver_id__in=receiver_ids) | Q(sender_id__in=receiver_ids, receiver=sender)
+        ).values_list('sender_id', 'receiver_id')
+        already_requested = {receiver_id if sender_id == sender.id else sender_id for sender_id, receiver_id in pairs}
+        # cancelled requests moved to the archive still block the pair, see FriendRequest.pair_taken
+        archived_pairs = ArchivedFriendRequest.objects.filter(
+            Q(user_low=sender.id, user_high__in=receiver_ids) | Q(user_low__in=receiver_ids, user_high=sender.id),
+            is_cancelled=True,
+        ).values_list('user_low', 'user_high')
+        already_requested.update(user_high if user_low == sender.id else user_low for user_low, user_high in archived_pairs)
+
+        errors = {}
+        for receiver_id in receiver_ids:
+            if receiver_id == sender.id:
+                errors[receiver_id] = 'Sender and receiver cannot be the same user.'
+            elif receiver_id not in existing_users:
+                errors[receiver_id] = 'User does not exist.'
+            elif receiver_id in already_requested:
+                errors[receiver_id] = 'A friend request between these users already exists.'
+
+        to_create = [receiver_id for receiver_id in receiver_ids if receiver_id not in errors]
+        with transaction.atomic():
+            FriendRequest.objects.bulk_create(
+                [FriendRequest(sender=sender, receiver_id=receiver_id) for receiver_id in to_create],
+                ignore_conflicts=True,
+            )
+            # bulk_create does not return primary keys on every backend
+            created = list(FriendRequest.objects.filter(sender=sender, receiver_id__in=to_create))
+            friend_requests_bulk_changed.send(sender=FriendRequest, friend_requests=created)
+
+        serialized = self.serialize(request, created)
+        created_ids = {friend_request.receiver_id: friend_request.id for friend_request in created}
+        results = []
+        for receiver_id in receiver_ids:
+            if receiver_id in created_ids:
+                results.append({'receiver': receiver_id, 'status': 'created',
+                                'friend_request': serialized[created_ids[receiver_id]]})
+            else:
+                error = errors.get(receiver_id, 'A friend request between these users already exists.')
+                results.append({'receiver': receiver_id, 'status': 'error', 'error': error})
+        return results
+
+    def answer_requests(self, request, request_ids, accept):
+        now = timezone.now()
+        errors = {}
+        changed = []
+        with transaction.atomic():
+            friend_requests = FriendRequest.objects.select_for_update().in_bulk(request_ids)
+            for request_id in request_ids:
+                friend_request = friend_requests.get(request_id)
+                if friend_request is None or friend_request.receiver_id != request.user.id:
+                    errors[request_id] = 'Not found.'
+                elif friend_request.is_cancelled:
+                    errors[request_id] = 'This friend request was cancelled by the sender.'
+                elif bool(friend_request.is_accepted) != accept:
+                    friend_request.is_accepted = accept
+                    friend_request.modified_on = now
+                    changed.append(friend_request)
+            FriendRequest.objects.bulk_update(changed, ['is_accepted', 'modified_on'])
+            friend_requests_bulk_changed.send(sender=FriendRequest, friend_requests=changed,
+                                              event=EVENT_ACCEPTED if accept else EVENT_REJECTED)
+
+        serialized = self.serialize(request, friend_requests.values())
+        changed_ids = {friend_request.id for friend_request in changed}
+        results = []
+        for request_id in request_ids:
+            if request_id in errors:
+                results.append({'id': request_id, 'status': 'error', 'error': errors[request_id]})
+            else:
+                # already in the asked state, for example rejecting a pending request
+                state = ('accepted' if accept else 'rejected') if request_id in changed_ids else 'unchanged'
+                results.append({'id': request_id, 'status': state, 'friend_request': serialized[request_id]})
+        return results
+
+    def serialize(self, request, friend_requests):
+        friend_requests = list(friend_requests)
+        rows = [{field: getattr(friend_request, field) for field in FriendRequestRowSerializer.values_fields}
+                for friend_request in friend_requests]
+        data = FriendRequestRowSerializer(rows, context={'request': request}).data
+        return {friend_request.id: item for friend_request, item in zip(friend_requests, data)}
 